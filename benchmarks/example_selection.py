@@ -0,0 +1,136 @@
+"""
+Compares the classification prompt with all examples of Beispiele.xlsx to the
+prompt with only the examples most similar to the text (BM25).
+
+Measures the index build time, the time to select the examples and render the prompt,
+and the prompt size in tokens. The workbook can be scaled up with synthetic
+examples to see how both approaches behave with thousands of rows.
+No requests are sent to Azure.
+
+    python benchmarks/example_selection.py --rows 5000 --k 3
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.pipelines.prompts import PromptTemplate
+from utils.pipelines.retrieval import BM25Index
+from utils.pipelines.tokens import get_token_counter
+
+
+def load_desinfo():
+    spec = importlib.util.spec_from_file_location("desinfo", os.path.join(ROOT, "pipelines", "desinfo.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def scale_examples(examples: dict, rows: int, seed: int = 0) -> dict:
+    """adds synthetic examples, mixing the words of the examples of the same strategy, until there are rows examples"""
+    rng = random.Random(seed)
+    scaled = {strategy: list(category_examples) for strategy, category_examples in examples.items()}
+    strategies = list(scaled)
+    total = sum(len(category_examples) for category_examples in scaled.values())
+    while total < rows:
+        strategy = strategies[total % len(strategies)]
+        words = " ".join(rng.sample(examples[strategy], min(3, len(examples[strategy])))).split()
+        rng.shuffle(words)
+        scaled[strategy].append(" ".join(words[: rng.randint(8, 30)]))
+        total += 1
+    return scaled
+
+
+def percentiles(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    return {
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": samples[len(samples) // 2] * 1000,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workbook", default=os.path.join(ROOT, "Beispiele.xlsx"))
+    parser.add_argument("--rows", type=int, default=0, help="scale the workbook to this many examples")
+    parser.add_argument("--k", type=int, default=3, help="similar examples per strategy")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--encoding", default="o200k_base", help="tiktoken encoding, empty to estimate")
+    parser.add_argument("--download-encoding", action="store_true", help="let tiktoken download the encoding")
+    args = parser.parse_args()
+
+    desinfo = load_desinfo()
+    count = get_token_counter(args.encoding, allow_download=args.download_encoding)
+    examples = desinfo.read_strategy_examples(args.workbook)
+    if args.rows:
+        examples = scale_examples(examples, args.rows)
+    rows = sum(len(category_examples) for category_examples in examples.values())
+
+    rng = random.Random(1)
+    queries = [
+        " ".join(rng.sample([example for category in examples.values() for example in category], 3))
+        for _ in range(args.queries)
+    ]
+
+    start = time.perf_counter()
+    full = PromptTemplate(
+        "identify_strategies",
+        desinfo.IDENTIFY_STRATEGIES_PROMPT,
+        STRATEGY_EXAMPLES=desinfo.format_strategy_examples(examples),
+    )
+    all_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = {strategy: BM25Index(category_examples) for strategy, category_examples in examples.items()}
+    similar = PromptTemplate("identify_strategies_similar", desinfo.IDENTIFY_STRATEGIES_PROMPT)
+    similar_build = time.perf_counter() - start
+
+    all_latency, all_tokens, similar_latency, similar_tokens = [], [], [], []
+    for query in queries:
+        start = time.perf_counter()
+        prompt = full.render(TEXT=query)
+        all_latency.append(time.perf_counter() - start)
+        all_tokens.append(count(prompt))
+
+        start = time.perf_counter()
+        selected = {
+            strategy: [strategy_index.documents[i] for i in strategy_index.top_k(query, args.k)]
+            for strategy, strategy_index in index.items()
+        }
+        prompt = similar.render(STRATEGY_EXAMPLES=desinfo.format_strategy_examples(selected), TEXT=query)
+        similar_latency.append(time.perf_counter() - start)
+        similar_tokens.append(count(prompt))
+
+    print(
+        json.dumps(
+            {
+                "rows": rows,
+                "queries": len(queries),
+                "all": {
+                    "build_ms": all_build * 1000,
+                    **percentiles(all_latency),
+                    "prompt_tokens": statistics.fmean(all_tokens),
+                },
+                "similar": {
+                    "k": args.k,
+                    "build_ms": similar_build * 1000,
+                    **percentiles(similar_latency),
+                    "prompt_tokens": statistics.fmean(similar_tokens),
+                },
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""
+Local stand-in for the Azure OpenAI chat completions API, so the pipeline can be load tested
+without spending tokens.
+
+Answers /openai/deployments/{deployment}/chat/completions for every deployment, streamed and not
+streamed. Tool calls (as sent by instructor) are answered with arguments generated from the JSON
+schema of the tool, so the structured responses validate. The time to the first token is drawn from
+a latency distribution, the remaining tokens follow at a fixed rate, and a share of the requests can
+be answered with 429 or 500.
+
+    python benchmarks/mock_azure.py --port 8010 --latency lognormal:0.4:0.5 --tokens-per-second 80 --rate-limit-rate 0.05
+
+Latency distributions: fixed:<seconds>, uniform:<low>:<high>, normal:<mean>:<stddev>, lognormal:<median>:<sigma>.
+GET /stats returns the number of requests, errors and tokens.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+
+from dataclasses import dataclass, field
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "Hier wird möglicherweise eine Behauptung aufgestellt, die ohne Belege als Tatsache dargestellt wird. "
+    "Prüfe, ob die genannte Quelle tatsächlich Fachwissen zu diesem Thema hat und ob andere Studien "
+    "zu demselben Ergebnis kommen."
+).split()
+
+
+@dataclass
+class LatencyDistribution:
+    kind: str = "fixed"
+    params: tuple[float, ...] = (0.0,)
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        kind, *params = spec.split(":")
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(params) != expected[kind]:
+            raise ValueError(f"Invalid latency distribution {spec}, see --help")
+        return cls(kind, tuple(float(param) for param in params))
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = rng.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            value = rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return max(value, 0.0)
+
+
+@dataclass
+class MockSettings:
+    latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    # generated tokens per second after the first one, 0 sends everything at once
+    tokens_per_second: float = 0.0
+    completion_tokens: int = 60
+    # at most this many items per list of a structured response (e.g. strategies)
+    max_items: int = 3
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    retry_after: float = 1.0
+    # tokens per streamed chunk
+    chunk_tokens: int = 3
+    seed: Optional[int] = None
+
+
+@dataclass
+class MockStats:
+    requests: int = 0
+    streamed: int = 0
+    tool_calls: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def message_text(messages: list[dict]) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            content = " ".join(item.get("text", "") for item in content if isinstance(item, dict))
+        parts.append(content)
+    return "\n".join(parts)
+
+
+def source_sentences(messages: list[dict]) -> list[str]:
+    """sentences of the analysed text, which structured responses quote as passages"""
+    prompt = message_text(messages[-1:])
+    match = re.search(r"\[TEXT\]\s*\n(.*?)(?:\n\s*\n|$)", prompt, re.DOTALL)
+    text = match.group(1) if match else prompt
+    sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", text) if len(sentence.strip()) > 10]
+    return sentences or [text.strip()[:200] or "Text"]
+
+
+class StructuredGenerator:
+    """Generates an instance of the JSON schema of a tool, with passages quoted from the prompt."""
+
+    def __init__(self, schema: dict, messages: list[dict], rng: random.Random, max_items: int):
+        self.defs = schema.get("$defs", {})
+        self.rng = rng
+        self.max_items = max_items
+        self.sentences = source_sentences(messages)
+        # batched explanations need exactly one item per numbered passage,
+        # merged explanations one item per strategy of the passage
+        self.passages = len(re.findall(r"Textpassage \d+:", message_text(messages)))
+        listed = re.search(r"potenziellen Strategien (.+?) identifiziert wurden", message_text(messages))
+        self.strategies = [strategy.strip() for strategy in listed.group(1).split(",")] if listed else []
+
+    def generate(self, schema: dict, name: str = "", index: int = 0):
+        if "$ref" in schema:
+            return self.generate(self.defs[schema["$ref"].split("/")[-1]], name, index)
+        if "enum" in schema:
+            if index < len(self.strategies) and self.strategies[index] in schema["enum"]:
+                return self.strategies[index]
+            return self.rng.choice(schema["enum"])
+        if "anyOf" in schema:
+            return self.generate(schema["anyOf"][0], name, index)
+
+        kind = schema.get("type")
+        if kind == "object":
+            return {
+                key: self.generate(value, key, index)
+                for key, value in schema.get("properties", {}).items()
+                if key in schema.get("required", schema.get("properties", {}))
+            }
+        if kind == "array":
+            length = self.passages or len(self.strategies) or self.rng.randint(0, self.max_items)
+            return [self.generate(schema.get("items", {}), name, i) for i in range(length)]
+        if kind == "integer":
+            return index
+        if kind == "number":
+            return float(index)
+        if kind == "boolean":
+            return False
+        if name == "content":
+            return self.rng.choice(self.sentences)
+        return " ".join(WORDS[: self.rng.randint(8, len(WORDS))])
+
+
+class MockAzure:
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.stats = MockStats()
+        self.rng = random.Random(settings.seed)
+
+    def free_text(self) -> str:
+        tokens = max(1, int(self.rng.gauss(self.settings.completion_tokens, self.settings.completion_tokens / 4)))
+        return " ".join(WORDS[i % len(WORDS)] for i in range(tokens))
+
+    def error(self) -> Optional[JSONResponse]:
+        draw = self.rng.random()
+        if draw < self.settings.rate_limit_rate:
+            self.stats.rate_limited += 1
+            return JSONResponse(
+                {"error": {"code": "429", "message": "Requests to the mock deployment have exceeded the rate limit."}},
+                status_code=429,
+                headers={"retry-after": str(self.settings.retry_after)},
+            )
+        if draw < self.settings.rate_limit_rate + self.settings.server_error_rate:
+            self.stats.server_errors += 1
+            return JSONResponse({"error": {"code": "InternalServerError", "message": "Mock server error"}}, status_code=500)
+        return None
+
+    async def complete(self, deployment: str, body: dict):
+        self.stats.requests += 1
+        if (error := self.error()) is not None:
+            return error
+
+        messages = body.get("messages", [])
+        prompt_tokens = count_tokens(message_text(messages))
+        tool = (body.get("tools") or [{}])[0].get("function")
+        if tool is not None:
+            self.stats.tool_calls += 1
+            generator = StructuredGenerator(tool.get("parameters", {}), messages, self.rng, self.settings.max_items)
+            output = json.dumps(generator.generate(tool.get("parameters", {})), ensure_ascii=False)
+        else:
+            output = self.free_text()
+        completion_tokens = count_tokens(output)
+        self.stats.prompt_tokens += prompt_tokens
+        self.stats.completion_tokens += completion_tokens
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+        first_token = self.settings.latency.sample(self.rng)
+        if body.get("stream"):
+            self.stats.streamed += 1
+            await asyncio.sleep(first_token)
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            return StreamingResponse(
+                self.stream(deployment, output, tool, usage if include_usage else None),
+                media_type="text/event-stream",
+            )
+
+        await asyncio.sleep(first_token + self.generation_time(completion_tokens))
+        if tool is not None:
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{uuid.uuid4().hex[:24]}",
+                        "type": "function",
+                        "function": {"name": tool["name"], "arguments": output},
+                    }
+                ],
+            }
+        else:
+            message = {"role": "assistant", "content": output}
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [
+                {"index": 0, "message": message, "finish_reason": "tool_calls" if tool is not None else "stop"}
+            ],
+            "usage": usage,
+        }
+
+    def generation_time(self, tokens: int) -> float:
+        return tokens / self.settings.tokens_per_second if self.settings.tokens_per_second > 0 else 0.0
+
+    async def stream(self, deployment: str, output: str, tool: Optional[dict], usage: Optional[dict]):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(choices: list, **extra) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": deployment,
+                "choices": choices,
+                **extra,
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        # azure starts with the results of the prompt filter, without choices
+        yield chunk([], prompt_filter_results=[])
+        if tool is not None:
+            yield chunk(
+                [
+                    {
+                        "index": 0,
+                        "delta": {
+                            "role": "assistant",
+                            "tool_calls": [
+                                {
+                                    "index": 0,
+                                    "id": f"call_{uuid.uuid4().hex[:24]}",
+                                    "type": "function",
+                                    "function": {"name": tool["name"], "arguments": ""},
+                                }
+                            ],
+                        },
+                        "finish_reason": None,
+                    }
+                ]
+            )
+        else:
+            yield chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+
+        step = max(self.settings.chunk_tokens, 1) * 4
+        for start in range(0, len(output), step):
+            piece = output[start : start + step]
+            if tool is not None:
+                delta = {"tool_calls": [{"index": 0, "function": {"arguments": piece}}]}
+            else:
+                delta = {"content": piece}
+            yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+            await asyncio.sleep(self.generation_time(count_tokens(piece)))
+
+        yield chunk([{"index": 0, "delta": {}, "finish_reason": "tool_calls" if tool is not None else "stop"}])
+        if usage is not None:
+            yield chunk([], usage=usage)
+        yield "data: [DONE]\n\n"
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    app = FastAPI()
+    mock = MockAzure(settings)
+
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str, request: Request):
+        return await mock.complete(deployment, await request.json())
+
+    @app.get("/stats")
+    async def stats():
+        return mock.stats.__dict__
+
+    @app.get("/health")
+    async def health():
+        return {"status": True}
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """the settings of the mock, shared with the load test that starts it"""
+    parser.add_argument("--latency", default="lognormal:0.4:0.5", help="time to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="0 sends all tokens at once")
+    parser.add_argument("--completion-tokens", type=int, default=60, help="mean length of free text answers")
+    parser.add_argument("--max-items", type=int, default=3, help="maximum number of strategies per text")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after header of the 429 responses")
+    parser.add_argument("--seed", type=int)
+
+
+def settings_from_arguments(args) -> MockSettings:
+    return MockSettings(
+        latency=LatencyDistribution.parse(args.latency),
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        max_items=args.max_items,
+        rate_limit_rate=args.rate_limit_rate,
+        server_error_rate=args.server_error_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(settings_from_arguments(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
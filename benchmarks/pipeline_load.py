@@ -0,0 +1,297 @@
+"""
+End-to-end load test of DesinfoNavigator without Azure: starts the mock Azure server
+(benchmarks/mock_azure.py) and main.py with the desinfo pipeline pointed at it, then sends
+chat completions to /v1/chat/completions at several concurrency levels.
+
+Reports per level the p50/p95/p99 latency, the time to the first byte of the answer,
+the requests per second and the errors as JSON. With --output the result is appended as a line
+to a JSON lines file, so runs can be compared over time.
+
+    python benchmarks/pipeline_load.py --concurrency 1 4 16 --requests 48 --output benchmarks/results.jsonl
+    python benchmarks/pipeline_load.py --rate-limit-rate 0.1 --deployments 2 --env DESINFO_ROUTER_HEDGE=true
+
+The settings of the mock (latency distribution, token rate, 429 injection) are the same as for mock_azure.py.
+Valves of the pipeline are set with --env DESINFO_<VALVE>=<value>; the result and explanation caches and the
+near duplicate index are off unless --keep-cache is given.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.mock_azure import add_arguments
+from config import API_KEY
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_texts(workbook: str, count: int, seed: int = 0) -> list[str]:
+    """distinct texts mixing two or three statements of the examples workbook"""
+    try:
+        from utils.pipelines.triage import read_workbook_texts
+
+        statements = read_workbook_texts(workbook)
+    except (ImportError, OSError, KeyError, ValueError):
+        statements = []
+    statements = statements or [
+        "Ein bekannter Physiker sagt, dass es keinen menschengemachten Klimawandel gibt.",
+        "Das Klima hat sich schon immer verändert, also ist auch die heutige Erwärmung natürlich.",
+        "Die Regierung verschweigt die wahren Daten, weil sie davon profitiert.",
+    ]
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.sample(statements, min(rng.randint(2, 3), len(statements)))) + f" ({number})"
+        for number in range(count)
+    ]
+
+
+def percentile(samples: list[float], quantile: float):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * quantile))]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "p50_ms": None if not samples else percentile(samples, 0.5) * 1000,
+        "p95_ms": None if not samples else percentile(samples, 0.95) * 1000,
+        "p99_ms": None if not samples else percentile(samples, 0.99) * 1000,
+        "mean_ms": None if not samples else sum(samples) / len(samples) * 1000,
+    }
+
+
+class Server:
+    """A server started as a subprocess, its output goes to a log file."""
+
+    def __init__(self, name: str, command: list[str], url: str, env: dict, log_dir: str):
+        self.name = name
+        self.url = url
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self.log = open(self.log_path, "w")
+        self.process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    async def wait_until_ready(self, path: str, timeout: float = 60.0) -> None:
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    break
+                try:
+                    response = await client.get(self.url + path, headers={"Authorization": f"Bearer {API_KEY}"})
+                    if response.status_code == 200:
+                        return
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.2)
+        self.stop()
+        with open(self.log_path) as log:
+            print(log.read()[-4000:], file=sys.stderr)
+        raise SystemExit(f"{self.name} did not start, see its output above")
+
+    def stop(self) -> None:
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+async def send(client: httpx.AsyncClient, url: str, model: str, text: str, stream: bool) -> dict:
+    body = {"model": model, "messages": [{"role": "user", "content": text}], "stream": stream}
+    start = time.perf_counter()
+    first_byte = None
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            async for chunk in response.aiter_bytes():
+                if chunk and first_byte is None:
+                    first_byte = time.perf_counter() - start
+            if response.status_code != 200:
+                return {"error": f"HTTP {response.status_code}"}
+    except httpx.HTTPError as e:
+        return {"error": type(e).__name__}
+    return {"latency": time.perf_counter() - start, "ttfb": first_byte}
+
+
+async def run_level(
+    client: httpx.AsyncClient, url: str, model: str, texts: list[str], concurrency: int, stream: bool
+) -> dict:
+    queue: asyncio.Queue = asyncio.Queue()
+    for text in texts:
+        queue.put_nowait(text)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            results.append(await send(client, url, model, queue.get_nowait(), stream))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    completed = [result for result in results if "latency" in result]
+    errors: dict[str, int] = {}
+    for result in results:
+        if "error" in result:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "completed": len(completed),
+        "errors": errors,
+        "duration_s": elapsed,
+        "requests_per_second": len(completed) / elapsed if elapsed else None,
+        "latency": summarize([result["latency"] for result in completed]),
+        "ttfb": summarize([result["ttfb"] for result in completed if result["ttfb"] is not None]),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main_async(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix="desinfo-benchmark-")
+    mock_port, pipelines_port = free_port(), free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    pipelines_url = f"http://127.0.0.1:{pipelines_port}"
+
+    mock_command = [sys.executable, os.path.join("benchmarks", "mock_azure.py"), "--port", str(mock_port)]
+    for option in ("latency", "tokens_per_second", "completion_tokens", "max_items", "rate_limit_rate",
+                   "server_error_rate", "retry_after", "seed"):
+        if getattr(args, option) is not None:
+            mock_command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+
+    # the pipeline is loaded from a copy, main.py moves pipelines that fail to load
+    pipelines_dir = os.path.join(work_dir, "pipelines")
+    os.makedirs(pipelines_dir)
+    shutil.copy(os.path.join(ROOT, "pipelines", f"{args.pipeline}.py"), pipelines_dir)
+
+    env = {
+        **os.environ,
+        "PIPELINES_DIR": pipelines_dir,
+        "BATCHES_DIR": os.path.join(work_dir, "batches"),
+        "AZURE_OPENAI_ENDPOINT": mock_url,
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "OPENAI_API_VERSION": os.getenv("OPENAI_API_VERSION", "2024-06-01"),
+        "AZURE_OPENAI_DEPLOYMENT": "mock",
+        "DESINFO_STRATEGY_EXAMPLES_PATH": os.path.abspath(args.workbook),
+    }
+    env.pop("AZURE_OPENAI_DEPLOYMENTS", None)
+    if args.deployments > 1:
+        env["AZURE_OPENAI_DEPLOYMENTS"] = json.dumps(
+            [{"endpoint": mock_url, "deployment": f"mock-{i}"} for i in range(args.deployments)]
+        )
+    if not args.keep_cache:
+        env["DESINFO_RESULT_CACHE_BACKEND"] = "none"
+        env["DESINFO_EXPLANATION_CACHE_BACKEND"] = "none"
+        # the texts mix the same statements, so most of them are near duplicates of each other
+        env["DESINFO_NEAR_DUPLICATE_BACKEND"] = "none"
+    for setting in args.env:
+        key, _, value = setting.partition("=")
+        env[key] = value
+
+    mock = Server("mock_azure", mock_command, mock_url, env, work_dir)
+    pipelines = Server(
+        "pipelines",
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(pipelines_port),
+         "--log-level", "warning"],
+        pipelines_url,
+        env,
+        work_dir,
+    )
+    try:
+        await mock.wait_until_ready("/health")
+        await pipelines.wait_until_ready("/v1/models")
+
+        texts = read_texts(args.workbook, args.requests * len(args.concurrency) + args.warmup, args.seed or 0)
+        url = f"{pipelines_url}/v1/chat/completions"
+        levels = []
+        async with httpx.AsyncClient(
+            headers={"Authorization": f"Bearer {API_KEY}"},
+            timeout=args.timeout,
+            limits=httpx.Limits(max_connections=max(args.concurrency) * 2),
+        ) as client:
+            # the first requests load the workbook and build the prompts
+            await run_level(client, url, args.pipeline, texts[: args.warmup], 1, args.stream)
+            texts = texts[args.warmup :]
+            for i, concurrency in enumerate(args.concurrency):
+                level_texts = texts[i * args.requests : (i + 1) * args.requests]
+                levels.append(await run_level(client, url, args.pipeline, level_texts, concurrency, args.stream))
+                print(f"concurrency {concurrency}: {levels[-1]['requests_per_second']:.2f} requests/s", file=sys.stderr)
+            mock_stats = (await client.get(f"{mock_url}/stats")).json()
+    finally:
+        pipelines.stop()
+        mock.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "timestamp": time.time(),
+        "commit": git_commit(),
+        "pipeline": args.pipeline,
+        "stream": args.stream,
+        "settings": {
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "completion_tokens": args.completion_tokens,
+            "max_items": args.max_items,
+            "rate_limit_rate": args.rate_limit_rate,
+            "server_error_rate": args.server_error_rate,
+            "deployments": args.deployments,
+            "env": args.env,
+            "keep_cache": args.keep_cache,
+        },
+        "levels": levels,
+        "mock": mock_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", default="desinfo")
+    parser.add_argument("--workbook", default=os.path.join(ROOT, "Beispiele.xlsx"), help="source of the texts")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="request answers without streaming")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--deployments", type=int, default=1, help="mock deployments the router spreads the calls over")
+    parser.add_argument("--keep-cache", action="store_true", help="keep the caches and the near duplicate index on")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for main.py, e.g. a DESINFO_ valve")
+    parser.add_argument("--output", help="JSON lines file the result is appended to")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as file:
+            file.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,3 +13,16 @@ except ImportError:
 
 API_KEY = os.getenv("PIPELINES_API_KEY", "0p3n-w3bu!")
 PIPELINES_DIR = os.getenv("PIPELINES_DIR", "./pipelines")
+
+# Files and batches of the /v1/batches API
+BATCHES_DIR = os.getenv("BATCHES_DIR", "./batches")
+# Requests of all batches running at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+# Batch requests wait while this many interactive chat completions are running (0 disables the wait),
+# but at most BATCH_MAX_DELAY seconds
+BATCH_INTERACTIVE_THRESHOLD = int(os.getenv("BATCH_INTERACTIVE_THRESHOLD", 1))
+BATCH_MAX_DELAY = float(os.getenv("BATCH_MAX_DELAY", 30))
+
+# Records the time and tokens of every stage of a chat completion, logged as JSON records and
+# returned as Server-Timing header (or as SSE comment at the end of streamed answers)
+TRACING = os.getenv("PIPELINES_TRACING", "false").lower() == "true"
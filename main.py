@@ -1,18 +1,26 @@
-from fastapi import FastAPI, Request, Depends, status, HTTPException, UploadFile, File
+from fastapi import FastAPI, Request, Depends, status, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
 
 
-from starlette.responses import StreamingResponse, Response
-from pydantic import BaseModel, ConfigDict
-from typing import List, Union, Generator, Iterator
+from starlette.responses import StreamingResponse, Response, FileResponse, JSONResponse
+from pydantic import BaseModel, ConfigDict, ValidationError
+from typing import List, Optional, Union, Generator, Iterator, AsyncGenerator, AsyncIterator
 
 
 from utils.pipelines.auth import bearer_security, get_current_user
 from utils.pipelines.main import get_last_user_message, stream_message_template
 from utils.pipelines.misc import convert_to_raw_url
+from utils.pipelines import tracing
+from utils.pipelines.batches import (
+    BATCH_ENDPOINTS,
+    BatchRunner,
+    BatchStore,
+    InteractiveTraffic,
+    InteractiveTrafficMiddleware,
+)
 
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 from concurrent.futures import ThreadPoolExecutor
 from schemas import FilterForm, OpenAIChatCompletionForm
 from urllib.parse import urlparse
@@ -21,6 +29,7 @@ import shutil
 import aiohttp
 import os
 import importlib.util
+import inspect
 import logging
 import time
 import json
@@ -29,11 +38,22 @@ import sys
 import subprocess
 
 
-from config import API_KEY, PIPELINES_DIR
+from config import (
+    API_KEY,
+    PIPELINES_DIR,
+    BATCHES_DIR,
+    BATCH_CONCURRENCY,
+    BATCH_INTERACTIVE_THRESHOLD,
+    BATCH_MAX_DELAY,
+    TRACING,
+)
 
 if not os.path.exists(PIPELINES_DIR):
     os.makedirs(PIPELINES_DIR)
 
+if TRACING:
+    tracing.configure_logging()
+
 
 PIPELINES = {}
 PIPELINE_MODULES = {}
@@ -247,7 +267,9 @@ async def reload():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await on_startup()
+    batch_runner.start()
     yield
+    await batch_runner.stop()
     await on_shutdown()
 
 
@@ -267,6 +289,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# batches only run requests while the interactive chat completions leave room for them
+interactive_traffic = InteractiveTraffic(
+    threshold=BATCH_INTERACTIVE_THRESHOLD, max_delay=BATCH_MAX_DELAY
+)
+app.add_middleware(
+    InteractiveTrafficMiddleware,
+    traffic=interactive_traffic,
+    paths=("/v1/chat/completions", "/chat/completions"),
+)
+
 
 @app.middleware("http")
 async def check_url(request: Request, call_next):
@@ -589,6 +621,28 @@ async def update_valves(pipeline_id: str, form_data: dict):
     return pipeline.valves
 
 
+@app.get("/v1/{pipeline_id}/stats")
+@app.get("/{pipeline_id}/stats")
+async def get_stats(pipeline_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+
+    if pipeline_id not in PIPELINE_MODULES:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Pipeline {pipeline_id} not found",
+        )
+
+    pipeline = PIPELINE_MODULES[pipeline_id]
+
+    if hasattr(pipeline, "stats") is False:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Stats for {pipeline_id} not found",
+        )
+
+    return pipeline.stats()
+
+
 @app.post("/v1/{pipeline_id}/filter/inlet")
 @app.post("/{pipeline_id}/filter/inlet")
 async def filter_inlet(pipeline_id: str, form_data: FilterForm):
@@ -653,6 +707,86 @@ async def filter_outlet(pipeline_id: str, form_data: FilterForm):
         )
 
 
+def stream_line(model: str, line) -> str:
+    if isinstance(line, BaseModel):
+        line = line.model_dump_json()
+        line = f"data: {line}"
+
+    try:
+        line = line.decode("utf-8")
+    except:
+        pass
+
+    logging.info(f"stream_content:Generator:{line}")
+
+    if line.startswith("data:"):
+        return f"{line}\n\n"
+    else:
+        line = stream_message_template(model, line)
+        return f"data: {json.dumps(line)}\n\n"
+
+
+def finish_message(model: str) -> dict:
+    return {
+        "id": f"{model}-{str(uuid.uuid4())}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+def completion_message(model: str, message: str) -> dict:
+    return {
+        "id": f"{model}-{str(uuid.uuid4())}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": message,
+                },
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+        ],
+    }
+
+
+def get_pipe(model: str):
+    pipeline = app.state.PIPELINES[model]
+    pipeline_id = model
+
+    if pipeline["type"] == "manifold":
+        manifold_id, pipeline_id = pipeline_id.split(".", 1)
+        pipe = PIPELINE_MODULES[manifold_id].pipe
+    else:
+        pipe = PIPELINE_MODULES[pipeline_id].pipe
+
+    return pipe, pipeline_id
+
+
+def is_async_pipe(pipe) -> bool:
+    return inspect.iscoroutinefunction(pipe) or inspect.isasyncgenfunction(pipe)
+
+
+async def call_async_pipe(pipe, **kwargs):
+    res = pipe(**kwargs)
+    if inspect.isawaitable(res):
+        res = await res
+    return res
+
+
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
 async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
@@ -668,20 +802,16 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
             detail=f"Pipeline {form_data.model} not found",
         )
 
-    def job():
-        print(form_data.model)
+    pipe, pipeline_id = get_pipe(form_data.model)
 
-        pipeline = app.state.PIPELINES[form_data.model]
-        pipeline_id = form_data.model
+    # async pipes run on the event loop, so they don't occupy a threadpool worker
+    if is_async_pipe(pipe):
+        return await async_job(form_data, pipe, pipeline_id, user_message, messages)
 
+    def job():
+        print(form_data.model)
         print(pipeline_id)
 
-        if pipeline["type"] == "manifold":
-            manifold_id, pipeline_id = pipeline_id.split(".", 1)
-            pipe = PIPELINE_MODULES[manifold_id].pipe
-        else:
-            pipe = PIPELINE_MODULES[pipeline_id].pipe
-
         if form_data.stream:
 
             def stream_content():
@@ -701,40 +831,10 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
 
                 if isinstance(res, Iterator):
                     for line in res:
-                        if isinstance(line, BaseModel):
-                            line = line.model_dump_json()
-                            line = f"data: {line}"
-
-                        try:
-                            line = line.decode("utf-8")
-                        except:
-                            pass
-
-                        logging.info(f"stream_content:Generator:{line}")
-
-                        if line.startswith("data:"):
-                            yield f"{line}\n\n"
-                        else:
-                            line = stream_message_template(form_data.model, line)
-                            yield f"data: {json.dumps(line)}\n\n"
+                        yield stream_line(form_data.model, line)
 
                 if isinstance(res, str) or isinstance(res, Generator):
-                    finish_message = {
-                        "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": form_data.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "logprobs": None,
-                                "finish_reason": "stop",
-                            }
-                        ],
-                    }
-
-                    yield f"data: {json.dumps(finish_message)}\n\n"
+                    yield f"data: {json.dumps(finish_message(form_data.model))}\n\n"
                     yield f"data: [DONE]"
 
             return StreamingResponse(stream_content(), media_type="text/event-stream")
@@ -763,22 +863,285 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
                         message = f"{message}{stream}"
 
                 logging.info(f"stream:false:{message}")
-                return {
-                    "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": form_data.model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": message,
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop",
-                        }
-                    ],
-                }
+                return completion_message(form_data.model, message)
 
     return await run_in_threadpool(job)
+
+
+@contextmanager
+def trace_request(pipeline_id: str):
+    """traces the stages of a chat completion if PIPELINES_TRACING is enabled, yields None otherwise"""
+    if not TRACING:
+        yield None
+        return
+    with tracing.trace(pipeline_id) as trace:
+        yield trace
+
+
+async def async_job(
+    form_data: OpenAIChatCompletionForm,
+    pipe,
+    pipeline_id: str,
+    user_message: str,
+    messages: List[dict],
+):
+    kwargs = {
+        "user_message": user_message,
+        "model_id": pipeline_id,
+        "messages": messages,
+        "body": form_data.model_dump(),
+    }
+
+    if form_data.stream:
+
+        async def stream_content():
+            with trace_request(pipeline_id) as trace:
+                res = await call_async_pipe(pipe, **kwargs)
+                logging.info(f"stream:true:{res}")
+
+                if isinstance(res, str):
+                    message = stream_message_template(form_data.model, res)
+                    logging.info(f"stream_content:str:{message}")
+                    yield f"data: {json.dumps(message)}\n\n"
+
+                if isinstance(res, AsyncIterator):
+                    async for line in res:
+                        yield stream_line(form_data.model, line)
+                elif isinstance(res, Iterator):
+                    async for line in iterate_in_threadpool(res):
+                        yield stream_line(form_data.model, line)
+
+                if isinstance(res, (str, Generator, AsyncGenerator)):
+                    # headers are sent before the stages ran, so the timing follows as SSE comment
+                    if trace is not None:
+                        yield f": server-timing {trace.server_timing()}\n\n"
+                    yield f"data: {json.dumps(finish_message(form_data.model))}\n\n"
+                    yield f"data: [DONE]"
+
+        return StreamingResponse(stream_content(), media_type="text/event-stream")
+    else:
+        with trace_request(pipeline_id) as trace:
+            res = await call_async_pipe(pipe, **kwargs)
+            logging.info(f"stream:false:{res}")
+
+            if isinstance(res, dict):
+                response = res
+            elif isinstance(res, BaseModel):
+                response = res.model_dump()
+            else:
+                message = ""
+
+                if isinstance(res, str):
+                    message = res
+
+                if isinstance(res, AsyncIterator):
+                    async for stream in res:
+                        message = f"{message}{stream}"
+                elif isinstance(res, Generator):
+                    async for stream in iterate_in_threadpool(res):
+                        message = f"{message}{stream}"
+
+                logging.info(f"stream:false:{message}")
+                response = completion_message(form_data.model, message)
+
+        if trace is not None:
+            return JSONResponse(response, headers={"Server-Timing": trace.server_timing()})
+        return response
+
+
+async def run_batch_request(url: str, body: dict) -> tuple[int, dict]:
+    """runs a line of a batch like a non-streaming request to the chat completions endpoint"""
+    try:
+        form_data = OpenAIChatCompletionForm(**{**body, "stream": False})
+        response = await generate_openai_chat_completion(form_data)
+        if isinstance(response, JSONResponse):
+            # traced responses carry the Server-Timing header
+            response = json.loads(response.body)
+        return status.HTTP_200_OK, response
+    except ValidationError as e:
+        return status.HTTP_400_BAD_REQUEST, {
+            "error": {"message": str(e), "type": "invalid_request_error"}
+        }
+    except HTTPException as e:
+        return e.status_code, {
+            "error": {"message": e.detail, "type": "invalid_request_error"}
+        }
+
+
+batch_store = BatchStore(BATCHES_DIR)
+batch_runner = BatchRunner(
+    batch_store,
+    run_batch_request,
+    concurrency=BATCH_CONCURRENCY,
+    traffic=interactive_traffic,
+)
+
+
+def check_api_key(user: str):
+    if user != API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API key",
+        )
+
+
+@app.post("/v1/files")
+@app.post("/files")
+async def upload_file(
+    file: UploadFile = File(...),
+    purpose: str = Form(...),
+    user: str = Depends(get_current_user),
+):
+    check_api_key(user)
+
+    if purpose != "batch":
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Only files with the purpose batch are supported.",
+        )
+
+    # streamed to disk, batch files can be large. The copy runs in the threadpool,
+    # so that reading the spooled upload and writing it don't block the event loop
+    temporary_path = os.path.join(BATCHES_DIR, f"upload-{uuid.uuid4().hex}")
+
+    def store_upload() -> dict:
+        try:
+            with open(temporary_path, "wb") as buffer:
+                shutil.copyfileobj(file.file, buffer)
+            return batch_store.create_file(file.filename, purpose, path=temporary_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    return await run_in_threadpool(store_upload)
+
+
+@app.get("/v1/files")
+@app.get("/files")
+async def list_files(
+    purpose: Optional[str] = None, user: str = Depends(get_current_user)
+):
+    check_api_key(user)
+    return {"object": "list", "data": batch_store.list_files(purpose)}
+
+
+def get_file_or_404(file_id: str) -> dict:
+    file = batch_store.get_file(file_id)
+    if file is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"File {file_id} not found",
+        )
+    return file
+
+
+@app.get("/v1/files/{file_id}")
+@app.get("/files/{file_id}")
+async def get_file(file_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+    return get_file_or_404(file_id)
+
+
+@app.get("/v1/files/{file_id}/content")
+@app.get("/files/{file_id}/content")
+async def get_file_content(file_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+    get_file_or_404(file_id)
+    return FileResponse(
+        batch_store.content_path(file_id), media_type="application/jsonl"
+    )
+
+
+@app.delete("/v1/files/{file_id}")
+@app.delete("/files/{file_id}")
+async def delete_file(file_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+    return {
+        "id": file_id,
+        "object": "file",
+        "deleted": batch_store.delete_file(file_id),
+    }
+
+
+class CreateBatchForm(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[dict] = None
+
+
+@app.post("/v1/batches")
+@app.post("/batches")
+async def create_batch(
+    form_data: CreateBatchForm, user: str = Depends(get_current_user)
+):
+    check_api_key(user)
+
+    if form_data.endpoint not in BATCH_ENDPOINTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Batches are only supported for {', '.join(BATCH_ENDPOINTS)}",
+        )
+    get_file_or_404(form_data.input_file_id)
+
+    try:
+        batch = batch_store.create_batch(
+            form_data.input_file_id,
+            form_data.endpoint,
+            form_data.completion_window,
+            form_data.metadata,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    batch_runner.submit(batch["id"])
+    return batch
+
+
+@app.get("/v1/batches")
+@app.get("/batches")
+async def list_batches(
+    limit: int = 20, after: Optional[str] = None, user: str = Depends(get_current_user)
+):
+    check_api_key(user)
+
+    batches = batch_store.list_batches()
+    if after is not None:
+        ids = [batch["id"] for batch in batches]
+        batches = batches[ids.index(after) + 1 :] if after in ids else []
+
+    return {
+        "object": "list",
+        "data": batches[:limit],
+        "first_id": batches[0]["id"] if batches else None,
+        "last_id": batches[:limit][-1]["id"] if batches else None,
+        "has_more": len(batches) > limit,
+    }
+
+
+@app.get("/v1/batches/{batch_id}")
+@app.get("/batches/{batch_id}")
+async def get_batch(batch_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+
+    batch = batch_store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Batch {batch_id} not found",
+        )
+    return batch
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+@app.post("/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, user: str = Depends(get_current_user)):
+    check_api_key(user)
+
+    batch = batch_runner.cancel(batch_id)
+    if batch is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Batch {batch_id} not found",
+        )
+    return batch
@@ -2,18 +2,143 @@ from __future__ import annotations
 
 import instructor
 import pandas as pd
-from typing import List, Union, Generator, Iterator
-from pydantic import BaseModel, Field
-from openai import AzureOpenAI
+from typing import List, AsyncGenerator, AsyncIterator, Awaitable, Callable, Iterable, TypeVar
+from pydantic import BaseModel, Field, PrivateAttr, ValidationInfo, model_validator
+from openai import AsyncAzureOpenAI
+import asyncio
+import bisect
+import functools
+import json
+import logging
 import os
+import re
+import threading
+import time
 from enum import Enum
 
+from utils.pipelines.cache import ResultCache, content_key, create_cache, normalize_text
+from utils.pipelines.near_duplicates import NearDuplicateIndex
+from utils.pipelines.paragraphs import contiguous_runs, diff_paragraphs, is_revision, paragraph_key, split_paragraphs
+from utils.pipelines.passages import PassageLocator, PassageSpan
+from utils.pipelines.prompts import PromptRegistry, PromptTemplate
+from utils.pipelines.retrieval import BM25Index
+from utils.pipelines.router import Deployment, DeploymentRouter
+from utils.pipelines.tasks import (
+    AUTOCOMPLETE_GENERATION,
+    EMOJI_GENERATION,
+    QUERY_GENERATION,
+    TAGS_GENERATION,
+    TITLE_GENERATION,
+    detect_task,
+    get_chat_history,
+    wants_json,
+)
+from utils.pipelines.tokens import TokenMetrics, get_token_counter
+from utils.pipelines.tracing import activate, span, start_span
+from utils.pipelines.triage import ResultLog, TriageModel
+
 deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+# tiktoken encoding used to measure prompts, empty to always use the offline estimate
+TOKEN_ENCODING = os.getenv("DESINFO_TOKEN_ENCODING", "o200k_base")
+# the encoding is only used if it is in the tiktoken cache, unless downloading it is allowed
+TOKEN_ENCODING_DOWNLOAD = os.getenv("DESINFO_TOKEN_ENCODING_DOWNLOAD", "false").lower() == "true"
+
+T = TypeVar("T")
 
 
 class Pipeline:
     class Valves(BaseModel):
-        pass
+        # Maximum number of explanation requests sent to Azure at the same time.
+        # 1 generates the explanations one after another.
+        EXPLANATION_CONCURRENCY: int = 8
+        # "per_passage" requests one explanation per passage,
+        # "batched" requests the explanations of all passages with a single structured call.
+        EXPLANATION_MODE: str = "per_passage"
+        # Falls back to one call per passage if the batched call fails.
+        EXPLANATION_BATCH_FALLBACK: bool = True
+        # Streams the extraction of the strategies and starts the explanation of every passage as soon as
+        # the model has written it, instead of after the whole extraction. Not used with "batched" explanations.
+        PIPELINED_EXTRACTION: bool = True
+        # Texts longer than CHUNK_SIZE characters are split into overlapping chunks,
+        # whose strategies are extracted in parallel. 0 always sends the whole text.
+        CHUNK_SIZE: int = 6000
+        CHUNK_OVERLAP: int = 400
+        CHUNK_CONCURRENCY: int = 4
+        # The passages quoted by the model are located in the text to merge duplicates and quote the original wording.
+        # Quotes that aren't found exactly are aligned word by word, with at least this share of unchanged words.
+        PASSAGE_MIN_SCORE: float = 0.6
+        # Workbook with the example statements for every PLURV category.
+        STRATEGY_EXAMPLES_PATH: str = "./Beispiele.xlsx"
+        # Maximum number of examples per PLURV category in the classification prompt, 0 sends all.
+        EXAMPLES_PER_CATEGORY: int = 0
+        # Examples are pruned until the classification prompt has at most this many tokens, 0 disables the budget.
+        PROMPT_TOKEN_BUDGET: int = 0
+        # Sends only the examples per PLURV category most similar to the text (BM25), 0 sends the examples as configured above.
+        SIMILAR_EXAMPLES_PER_CATEGORY: int = 0
+        # Cache for complete reports of already analysed texts: "memory", "sqlite", "redis" or "none".
+        RESULT_CACHE_BACKEND: str = "memory"
+        # Path of the sqlite database or url of the redis server (requires the redis package).
+        RESULT_CACHE_URL: str = ""
+        RESULT_CACHE_MAX_SIZE: int = 1024
+        # Seconds until a cached report expires, 0 keeps it until it is evicted.
+        RESULT_CACHE_TTL: int = 86400
+        # Cache for the explanations of single passages: "memory", "sqlite", "redis" or "none".
+        # Uses RESULT_CACHE_URL as location.
+        EXPLANATION_CACHE_BACKEND: str = "memory"
+        # "context" keys the explanation on the passage and the whole text,
+        # "passage" only on the passage, which gives more hits for slightly edited texts.
+        EXPLANATION_CACHE_MODE: str = "context"
+        EXPLANATION_CACHE_MAX_SIZE: int = 8192
+        EXPLANATION_CACHE_TTL: int = 86400
+        # Index of recently analysed texts (MinHash LSH over word shingles): a text whose estimated Jaccard similarity
+        # to an analysed one is at least NEAR_DUPLICATE_THRESHOLD gets that analysis, re-anchored to its passages,
+        # without calling the LLM. "memory", "sqlite" (also kept on disk, uses RESULT_CACHE_URL as location) or "none".
+        NEAR_DUPLICATE_BACKEND: str = "memory"
+        NEAR_DUPLICATE_THRESHOLD: float = 0.9
+        NEAR_DUPLICATE_MAX_SIZE: int = 2048
+        NEAR_DUPLICATE_TTL: int = 86400
+        # Store for the findings of every conversation, follow-ups are answered from them
+        # instead of resending the report: "memory", "sqlite", "redis" or "none". Uses RESULT_CACHE_URL as location.
+        CONVERSATION_STORE_BACKEND: str = "memory"
+        CONVERSATION_STORE_MAX_SIZE: int = 4096
+        CONVERSATION_STORE_TTL: int = 604800
+        # Follow-ups contain the last messages verbatim, older ones are summarized.
+        FOLLOW_UP_RECENT_MESSAGES: int = 6
+        # A follow-up that is a new version of the analysed text (edited or extended) is analysed again, but only
+        # its paragraphs without cached findings are classified. "memory", "sqlite", "redis" or "none" caches the
+        # findings and explanations per paragraph, uses RESULT_CACHE_URL as location.
+        INCREMENTAL_ANALYSIS: bool = True
+        PARAGRAPH_CACHE_BACKEND: str = "memory"
+        PARAGRAPH_CACHE_MAX_SIZE: int = 8192
+        PARAGRAPH_CACHE_TTL: int = 86400
+        # JSON lines file the findings of every analysed text are appended to, empty disables the log.
+        # The log is the training data of the triage model (python -m utils.pipelines.triage).
+        RESULT_LOG_PATH: str = ""
+        # Triage model trained offline; texts it considers benign are answered without calling the LLM.
+        TRIAGE_MODEL_PATH: str = ""
+        # Minimum probability of a text being benign to skip the LLM.
+        TRIAGE_THRESHOLD: float = 0.95
+        # The deployments are read from AZURE_OPENAI_DEPLOYMENTS (a JSON list of objects with
+        # endpoint, deployment and optionally api_key and api_version), or the single AZURE_OPENAI_* deployment.
+        # A deployment failing this many times in a row with 429/5xx is skipped for ROUTER_COOLDOWN seconds.
+        ROUTER_FAILURE_THRESHOLD: int = 3
+        ROUTER_COOLDOWN: int = 30
+        # Sends a duplicate to the next deployment when a call takes longer than the ROUTER_HEDGE_QUANTILE latency.
+        ROUTER_HEDGE: bool = False
+        ROUTER_HEDGE_QUANTILE: float = 0.95
+        # Tier of the deployments used by each stage, set per deployment with "tier" in AZURE_OPENAI_DEPLOYMENTS.
+        # Unknown tiers use the "default" tier.
+        TIER_CLASSIFICATION: str = "default"
+        # Texts with at least TIER_LARGE_MIN_TOKENS tokens (0 disables), or with a triage probability
+        # within TIER_AMBIGUOUS_BAND of 0.5 (0 disables), are classified by TIER_CLASSIFICATION_LARGE.
+        TIER_CLASSIFICATION_LARGE: str = "default"
+        TIER_LARGE_MIN_TOKENS: int = 0
+        TIER_AMBIGUOUS_BAND: float = 0.0
+        TIER_EXPLANATION: str = "default"
+        TIER_FOLLOW_UP: str = "default"
+        # Task requests of Open WebUI (chat titles, tags, autocompletion) are answered with a single call of
+        # this tier and never analysed. Without deployments of this tier, titles and tags are built from the report.
+        TIER_TASK: str = "small"
 
     def __init__(self):
         # Optionally, you can set the id and name of the pipeline.
@@ -24,23 +149,357 @@ class Pipeline:
 
         # The name of the pipeline.
         self.name = "DesinfoNavigator"
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
+        self.valves = self.Valves(
+            **{
+                "EXPLANATION_CONCURRENCY": int(
+                    os.getenv("DESINFO_EXPLANATION_CONCURRENCY", 8)
+                ),
+                "EXPLANATION_MODE": os.getenv("DESINFO_EXPLANATION_MODE", "per_passage"),
+                "EXPLANATION_BATCH_FALLBACK": os.getenv(
+                    "DESINFO_EXPLANATION_BATCH_FALLBACK", "true"
+                ).lower()
+                == "true",
+                "PIPELINED_EXTRACTION": os.getenv("DESINFO_PIPELINED_EXTRACTION", "true").lower() == "true",
+                "CHUNK_SIZE": int(os.getenv("DESINFO_CHUNK_SIZE", 6000)),
+                "CHUNK_OVERLAP": int(os.getenv("DESINFO_CHUNK_OVERLAP", 400)),
+                "CHUNK_CONCURRENCY": int(os.getenv("DESINFO_CHUNK_CONCURRENCY", 4)),
+                "PASSAGE_MIN_SCORE": float(os.getenv("DESINFO_PASSAGE_MIN_SCORE", 0.6)),
+                "STRATEGY_EXAMPLES_PATH": os.getenv(
+                    "DESINFO_STRATEGY_EXAMPLES_PATH", "./Beispiele.xlsx"
+                ),
+                "EXAMPLES_PER_CATEGORY": int(os.getenv("DESINFO_EXAMPLES_PER_CATEGORY", 0)),
+                "PROMPT_TOKEN_BUDGET": int(os.getenv("DESINFO_PROMPT_TOKEN_BUDGET", 0)),
+                "SIMILAR_EXAMPLES_PER_CATEGORY": int(os.getenv("DESINFO_SIMILAR_EXAMPLES_PER_CATEGORY", 0)),
+                "RESULT_CACHE_BACKEND": os.getenv("DESINFO_RESULT_CACHE_BACKEND", "memory"),
+                "RESULT_CACHE_URL": os.getenv("DESINFO_RESULT_CACHE_URL", ""),
+                "RESULT_CACHE_MAX_SIZE": int(
+                    os.getenv("DESINFO_RESULT_CACHE_MAX_SIZE", 1024)
+                ),
+                "RESULT_CACHE_TTL": int(os.getenv("DESINFO_RESULT_CACHE_TTL", 86400)),
+                "EXPLANATION_CACHE_BACKEND": os.getenv(
+                    "DESINFO_EXPLANATION_CACHE_BACKEND", "memory"
+                ),
+                "EXPLANATION_CACHE_MODE": os.getenv(
+                    "DESINFO_EXPLANATION_CACHE_MODE", "context"
+                ),
+                "EXPLANATION_CACHE_MAX_SIZE": int(
+                    os.getenv("DESINFO_EXPLANATION_CACHE_MAX_SIZE", 8192)
+                ),
+                "EXPLANATION_CACHE_TTL": int(
+                    os.getenv("DESINFO_EXPLANATION_CACHE_TTL", 86400)
+                ),
+                "NEAR_DUPLICATE_BACKEND": os.getenv("DESINFO_NEAR_DUPLICATE_BACKEND", "memory"),
+                "NEAR_DUPLICATE_THRESHOLD": float(os.getenv("DESINFO_NEAR_DUPLICATE_THRESHOLD", 0.9)),
+                "NEAR_DUPLICATE_MAX_SIZE": int(os.getenv("DESINFO_NEAR_DUPLICATE_MAX_SIZE", 2048)),
+                "NEAR_DUPLICATE_TTL": int(os.getenv("DESINFO_NEAR_DUPLICATE_TTL", 86400)),
+                "CONVERSATION_STORE_BACKEND": os.getenv(
+                    "DESINFO_CONVERSATION_STORE_BACKEND", "memory"
+                ),
+                "CONVERSATION_STORE_MAX_SIZE": int(
+                    os.getenv("DESINFO_CONVERSATION_STORE_MAX_SIZE", 4096)
+                ),
+                "CONVERSATION_STORE_TTL": int(
+                    os.getenv("DESINFO_CONVERSATION_STORE_TTL", 604800)
+                ),
+                "FOLLOW_UP_RECENT_MESSAGES": int(
+                    os.getenv("DESINFO_FOLLOW_UP_RECENT_MESSAGES", 6)
+                ),
+                "INCREMENTAL_ANALYSIS": os.getenv("DESINFO_INCREMENTAL_ANALYSIS", "true").lower() == "true",
+                "PARAGRAPH_CACHE_BACKEND": os.getenv("DESINFO_PARAGRAPH_CACHE_BACKEND", "memory"),
+                "PARAGRAPH_CACHE_MAX_SIZE": int(os.getenv("DESINFO_PARAGRAPH_CACHE_MAX_SIZE", 8192)),
+                "PARAGRAPH_CACHE_TTL": int(os.getenv("DESINFO_PARAGRAPH_CACHE_TTL", 86400)),
+                "RESULT_LOG_PATH": os.getenv("DESINFO_RESULT_LOG_PATH", ""),
+                "TRIAGE_MODEL_PATH": os.getenv("DESINFO_TRIAGE_MODEL_PATH", ""),
+                "TRIAGE_THRESHOLD": float(os.getenv("DESINFO_TRIAGE_THRESHOLD", 0.95)),
+                "ROUTER_FAILURE_THRESHOLD": int(os.getenv("DESINFO_ROUTER_FAILURE_THRESHOLD", 3)),
+                "ROUTER_COOLDOWN": int(os.getenv("DESINFO_ROUTER_COOLDOWN", 30)),
+                "ROUTER_HEDGE": os.getenv("DESINFO_ROUTER_HEDGE", "false").lower() == "true",
+                "ROUTER_HEDGE_QUANTILE": float(os.getenv("DESINFO_ROUTER_HEDGE_QUANTILE", 0.95)),
+                "TIER_CLASSIFICATION": os.getenv("DESINFO_TIER_CLASSIFICATION", "default"),
+                "TIER_CLASSIFICATION_LARGE": os.getenv("DESINFO_TIER_CLASSIFICATION_LARGE", "default"),
+                "TIER_LARGE_MIN_TOKENS": int(os.getenv("DESINFO_TIER_LARGE_MIN_TOKENS", 0)),
+                "TIER_AMBIGUOUS_BAND": float(os.getenv("DESINFO_TIER_AMBIGUOUS_BAND", 0.0)),
+                "TIER_EXPLANATION": os.getenv("DESINFO_TIER_EXPLANATION", "default"),
+                "TIER_FOLLOW_UP": os.getenv("DESINFO_TIER_FOLLOW_UP", "default"),
+                "TIER_TASK": os.getenv("DESINFO_TIER_TASK", "small"),
+            }
+        )
+        # all calls go through a router per tier, with a single deployment it only adds the circuit breaker
+        self.routers = create_routers(read_deployments())
+        self.llm = self.routers.get("default") or next(iter(self.routers.values()))
+        self._setup_router()
+        self.strategy_examples = strategy_example_provider
+        self.strategy_examples.load(self.valves.STRATEGY_EXAMPLES_PATH)
+        self.token_metrics = TokenMetrics()
+        self.result_cache: ResultCache | None = None
+        self.explanation_cache: ExplanationCache | None = None
+        self.near_duplicates: NearDuplicateIndex | None = None
+        self.paragraph_cache: ResultCache | None = None
+        self.conversations: ConversationStore | None = None
+        # summaries are updated after the answer was sent, the tasks are kept until they are done
+        self._summary_tasks: set[asyncio.Task] = set()
+        self._setup_caches()
+        self.result_log: ResultLog | None = None
+        self.triage_model: TriageModel | None = None
+        self._setup_triage()
+
+    def _close_caches(self):
+        if self.result_cache is not None:
+            self.result_cache.close()
+            self.result_cache = None
+        if self.explanation_cache is not None:
+            self.explanation_cache.close()
+            self.explanation_cache = None
+        if self.near_duplicates is not None:
+            self.near_duplicates.close()
+            self.near_duplicates = None
+        if self.paragraph_cache is not None:
+            self.paragraph_cache.close()
+            self.paragraph_cache = None
+        if self.conversations is not None:
+            self.conversations.close()
+            self.conversations = None
+
+    def _setup_caches(self):
+        self._close_caches()
+        self.result_cache = create_cache(
+            self.valves.RESULT_CACHE_BACKEND,
+            max_size=self.valves.RESULT_CACHE_MAX_SIZE,
+            ttl=self.valves.RESULT_CACHE_TTL,
+            url=self.valves.RESULT_CACHE_URL,
+            namespace="desinfo_results",
+        )
+        explanation_cache = create_cache(
+            self.valves.EXPLANATION_CACHE_BACKEND,
+            max_size=self.valves.EXPLANATION_CACHE_MAX_SIZE,
+            ttl=self.valves.EXPLANATION_CACHE_TTL,
+            url=self.valves.RESULT_CACHE_URL,
+            namespace="desinfo_explanations",
+        )
+        if explanation_cache is not None:
+            self.explanation_cache = ExplanationCache(
+                explanation_cache,
+                passage_only=self.valves.EXPLANATION_CACHE_MODE == "passage",
+                model=self.tier_models(self.valves.TIER_EXPLANATION),
+            )
+        self.near_duplicates = create_near_duplicate_index(
+            self.valves.NEAR_DUPLICATE_BACKEND,
+            threshold=self.valves.NEAR_DUPLICATE_THRESHOLD,
+            max_size=self.valves.NEAR_DUPLICATE_MAX_SIZE,
+            ttl=self.valves.NEAR_DUPLICATE_TTL,
+            url=self.valves.RESULT_CACHE_URL,
+        )
+        self.paragraph_cache = create_cache(
+            self.valves.PARAGRAPH_CACHE_BACKEND,
+            max_size=self.valves.PARAGRAPH_CACHE_MAX_SIZE,
+            ttl=self.valves.PARAGRAPH_CACHE_TTL,
+            url=self.valves.RESULT_CACHE_URL,
+            namespace="desinfo_paragraphs",
+        )
+        conversation_cache = create_cache(
+            self.valves.CONVERSATION_STORE_BACKEND,
+            max_size=self.valves.CONVERSATION_STORE_MAX_SIZE,
+            ttl=self.valves.CONVERSATION_STORE_TTL,
+            url=self.valves.RESULT_CACHE_URL,
+            namespace="desinfo_conversations",
+        )
+        if conversation_cache is not None:
+            self.conversations = ConversationStore(conversation_cache)
+
+    def _setup_triage(self):
+        self.result_log = ResultLog(self.valves.RESULT_LOG_PATH) if self.valves.RESULT_LOG_PATH else None
+        self.triage_model = None
+        if self.valves.TRIAGE_MODEL_PATH:
+            try:
+                self.triage_model = TriageModel.load(self.valves.TRIAGE_MODEL_PATH)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Triage model {self.valves.TRIAGE_MODEL_PATH} could not be loaded, triage is disabled: {e}")
 
-        self.llm = AzureOpenAI(max_retries=5, api_key=api_key, azure_endpoint=endpoint)
-        self.strategy_examples = get_strategy_examples()
+    def _setup_router(self):
+        for router in self.routers.values():
+            router.failure_threshold = self.valves.ROUTER_FAILURE_THRESHOLD
+            router.cooldown = self.valves.ROUTER_COOLDOWN
+            router.hedge = self.valves.ROUTER_HEDGE
+            router.hedge_quantile = self.valves.ROUTER_HEDGE_QUANTILE
+
+    def tier(self, name: str) -> DeploymentRouter:
+        """the router of a tier, the default one if no deployment has that tier"""
+        return self.routers.get(name, self.llm)
+
+    def tier_models(self, name: str) -> str:
+        """the deployments of a tier, part of the cache keys so that switching a tier invalidates them"""
+        return ",".join(sorted(deployment.model or "" for deployment in self.tier(name).deployments))
+
+    def triage_score(self, text: str) -> float | None:
+        """probability of the triage model that the text contains strategies, None without a triage model"""
+        if self.triage_model is None:
+            return None
+        with span("triage"):
+            return self.triage_model.score(text)
+
+    def classification_tier(self, text: str, triage_score: float | None = None) -> str:
+        """
+        long texts, and texts the triage model is unsure about, are classified by the large tier.
+        triage_score is scored again if it isn't passed.
+        """
+        if self.valves.TIER_LARGE_MIN_TOKENS > 0:
+            count_tokens = get_token_counter(TOKEN_ENCODING, TOKEN_ENCODING_DOWNLOAD)
+            if count_tokens(text) >= self.valves.TIER_LARGE_MIN_TOKENS:
+                return self.valves.TIER_CLASSIFICATION_LARGE
+        if self.triage_model is not None and self.valves.TIER_AMBIGUOUS_BAND > 0:
+            if triage_score is None:
+                triage_score = self.triage_score(text)
+            if abs(triage_score - 0.5) <= self.valves.TIER_AMBIGUOUS_BAND:
+                return self.valves.TIER_CLASSIFICATION_LARGE
+        return self.valves.TIER_CLASSIFICATION
+
+    def stats(self) -> dict:
+        """the metrics served by the stats endpoint of main.py"""
+        return {"tokens": self.token_metrics.snapshot(), "usage": self.usage(), "caches": self.cache_stats()}
+
+    def usage(self) -> dict:
+        """latency and token usage per tier"""
+        return {name: router.metrics.snapshot() for name, router in self.routers.items()}
+
+    def cache_stats(self) -> dict:
+        """hits of the report and paragraph caches and the near duplicate index"""
+        stats = {}
+        if self.result_cache is not None:
+            stats["results"] = {"hits": self.result_cache.hits, "misses": self.result_cache.misses}
+        if self.paragraph_cache is not None:
+            stats["paragraphs"] = {"hits": self.paragraph_cache.hits, "misses": self.paragraph_cache.misses}
+        if self.near_duplicates is not None:
+            stats["near_duplicates"] = self.near_duplicates.snapshot()
+        return stats
 
     async def on_startup(self):
         # This function is called when the server is started.
-        pass
+        # The valves from valves.json are only applied after __init__.
+        self.strategy_examples.load(self.valves.STRATEGY_EXAMPLES_PATH)
+        self._setup_caches()
+        self._setup_triage()
+        self._setup_router()
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        self.llm.close()
+        for router in self.routers.values():
+            await router.close()
+        self._close_caches()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
-        pass
+        self.strategy_examples.load(self.valves.STRATEGY_EXAMPLES_PATH, force=True)
+        self._setup_caches()
+        self._setup_triage()
+        self._setup_router()
+
+    def analysis_settings(self, user_message: str, tier: str | None = None) -> list[str]:
+        """
+        the settings an analysis depends on, a stored analysis is only reused with the same ones.
+        tier is the classification tier of the text, it is chosen again if it isn't passed.
+        """
+        return [
+            get_prompt_templates_version(self.strategy_examples),
+            deployment or "",
+            # the settings choosing the examples of the classification prompt
+            f"{self.valves.EXAMPLES_PER_CATEGORY}:{self.valves.PROMPT_TOKEN_BUDGET}:{self.valves.SIMILAR_EXAMPLES_PER_CATEGORY}",
+            self.tier_models(tier or self.classification_tier(user_message)),
+            self.tier_models(self.valves.TIER_EXPLANATION),
+        ]
+
+    def result_cache_key(self, user_message: str, settings: list[str] | None = None) -> str:
+        # the report is cached together with its findings, which follow-ups refer to
+        settings = settings or self.analysis_settings(user_message)
+        return content_key("analysis", *settings, normalize_text(user_message))
+
+    async def find_near_duplicate(
+        self, user_message: str, settings: list[str] | None = None
+    ) -> list[AppliedStrategy] | None:
+        """
+        the findings of an analysed near duplicate of the text, with their explanations and re-anchored to
+        the passages of the text. None if there is none, or if one of its passages isn't in the text anymore.
+        """
+        if self.near_duplicates is None:
+            return None
+        with span("near_duplicate") as near_duplicate_span:
+            scope = content_key(*(settings or self.analysis_settings(user_message)))
+            if self.near_duplicates.blocking:
+                match = await asyncio.to_thread(self.near_duplicates.query, user_message, scope=scope)
+            else:
+                match = self.near_duplicates.query(user_message, scope=scope)
+            if match is None:
+                return None
+            strategies = [AppliedStrategy.from_stored(finding) for finding in json.loads(match.value)]
+            AppliedStrategy.locate(strategies, PassageLocator(user_message, min_score=self.valves.PASSAGE_MIN_SCORE))
+            near_duplicate_span.set(similarity=round(match.similarity, 3))
+            # the edit may have changed what the analysis was about
+            if any(strategy.location is None for strategy in strategies):
+                self.near_duplicates.reject(match)
+                near_duplicate_span.set(rejected=True)
+                return None
+        return strategies
+
+    async def remember_analysis(
+        self, user_message: str, strategies: list[AppliedStrategy], settings: list[str] | None = None
+    ) -> None:
+        """adds the findings of a complete report to the near duplicate index"""
+        if self.near_duplicates is None or any(strategy.explanation is None for strategy in strategies):
+            return
+        add = functools.partial(
+            self.near_duplicates.add,
+            user_message,
+            json.dumps([strategy.to_stored() for strategy in strategies], ensure_ascii=False),
+            scope=content_key(*(settings or self.analysis_settings(user_message))),
+        )
+        if self.near_duplicates.blocking:
+            await asyncio.to_thread(add)
+        else:
+            add()
+
+    async def remember_conversation(
+        self, body: dict, messages: list[dict], text: str, report: str, strategies: list[AppliedStrategy]
+    ) -> None:
+        """stores the findings of the analysed text, which the follow-ups of the chat refer to"""
+        if self.conversations is None:
+            return
+        # without a chat id the conversation is identified by the text and this report
+        chat = conversation_id(body, messages, report=report)
+        if chat is not None:
+            await self.conversations.aset(chat, Conversation(text=text, findings=strategies))
+
+    def paragraph_cache_key(self, paragraph: str) -> str:
+        return content_key("paragraph", *self.analysis_settings(paragraph), paragraph_key(paragraph))
+
+    async def remember_paragraphs(self, text: str, strategies: list[AppliedStrategy]) -> None:
+        """
+        caches the findings of a complete report per paragraph (the one its passage starts in), for later
+        versions of the text. Nothing is cached if a passage wasn't located, its paragraph is unknown.
+        """
+        if self.paragraph_cache is None or any(
+            strategy.explanation is None or strategy.location is None for strategy in strategies
+        ):
+            return
+        paragraphs = split_paragraphs(text)
+        starts = [paragraph.start for paragraph in paragraphs]
+        findings: list[list[dict]] = [[] for _ in paragraphs]
+        for strategy in strategies:
+            findings[max(bisect.bisect_right(starts, strategy.location.start) - 1, 0)].append(strategy.to_stored())
+        for paragraph, paragraph_findings in zip(paragraphs, findings):
+            await self.paragraph_cache.aset(
+                self.paragraph_cache_key(text[paragraph.start : paragraph.end]),
+                json.dumps(paragraph_findings, ensure_ascii=False),
+            )
+
+    def find_revised_text(self, messages: list[dict]) -> str | None:
+        """the analysed text of which the last message is a new version, None for an ordinary follow-up"""
+        text = message_text(messages[-1])
+        # analysed texts are the user messages answered with a report, the newest is compared first
+        for message, answer in reversed(list(zip(messages[:-2], messages[1:-1]))):
+            if message.get("role") != "user" or not is_report(message_text(answer)):
+                continue
+            if is_revision(message_text(message), text):
+                return message_text(message)
+        return None
 
     async def inlet(self, body: dict, user: dict) -> dict:
         # This function is called before the OpenAI API request is made. You can modify the form data before it is sent to the OpenAI API.
@@ -50,30 +509,360 @@ class Pipeline:
         # This function is called after the OpenAI API response is completed. You can modify the messages after they are received from the OpenAI API.
         return body
 
-    def pipe(
+    def is_benign(self, text: str, triage_score: float | None = None) -> bool:
+        """
+        the triage model is confident that the text contains no strategies, so the LLM is skipped.
+        triage_score is scored again if it isn't passed.
+        """
+        if self.triage_model is None:
+            return False
+        if triage_score is None:
+            triage_score = self.triage_score(text)
+        benign = 1 - triage_score
+        if benign >= self.valves.TRIAGE_THRESHOLD:
+            logging.info(f"triage: benign with probability {benign:.3f}, skipping the LLM")
+            return True
+        return False
+
+    def explanation_streams(self, text: str) -> ExplanationStreams | None:
+        """starts the explanations while the strategies are still extracted, unless they are batched into one call"""
+        if not self.valves.PIPELINED_EXTRACTION or self.valves.EXPLANATION_MODE == "batched":
+            return None
+        return ExplanationStreams(
+            text,
+            self.tier(self.valves.TIER_EXPLANATION),
+            max_concurrency=self.valves.EXPLANATION_CONCURRENCY,
+            explanation_cache=self.explanation_cache,
+        )
+
+    async def identify(
+        self,
+        text: str,
+        on_strategy: Callable[[AppliedStrategy], None] | None = None,
+        tier: str | None = None,
+    ) -> list[AppliedStrategy]:
+        """
+        identifies the strategies of a text with the settings of the valves.
+        on_strategy is called with every strategy as soon as it is known.
+        tier is the classification tier of the text, it is chosen again if it isn't passed.
+        """
+        tier = tier or self.classification_tier(text)
+        with span("identify", tier=tier) as identify_span:
+            strategies = await identify_strategies_chunked(
+                text,
+                openai_client=self.tier(tier),
+                strategy_examples=self.strategy_examples,
+                chunk_size=self.valves.CHUNK_SIZE,
+                chunk_overlap=self.valves.CHUNK_OVERLAP,
+                max_concurrency=self.valves.CHUNK_CONCURRENCY,
+                examples_per_category=self.valves.EXAMPLES_PER_CATEGORY,
+                token_budget=self.valves.PROMPT_TOKEN_BUDGET,
+                token_metrics=self.token_metrics,
+                similar_examples=self.valves.SIMILAR_EXAMPLES_PER_CATEGORY,
+                passage_min_score=self.valves.PASSAGE_MIN_SCORE,
+                on_strategy=on_strategy,
+            )
+            identify_span.set(strategies=len(strategies))
+        if self.result_log is not None:
+            self.result_log.append(
+                text,
+                [{"strategy": strategy.strategy.name, "content": strategy.content} for strategy in strategies],
+                deployment=deployment,
+                tier=tier,
+                prompt_version=get_prompt_templates_version(self.strategy_examples),
+            )
+        return strategies
+
+    async def analyze(self, text: str, report: bool = True) -> dict:
+        """
+        analyses a single text outside of a chat, e.g. for the corpus runner (python -m utils.pipelines.corpus).
+        returns the ampel, the findings and optionally the full report.
+        """
+        triage_score = self.triage_score(text)
+        triaged = self.is_benign(text, triage_score)
+        explanations = self.explanation_streams(text) if report and not triaged else None
+        try:
+            strategies = (
+                []
+                if triaged
+                else await self.identify(
+                    text,
+                    on_strategy=explanations.start if explanations is not None else None,
+                    tier=self.classification_tier(text, triage_score),
+                )
+            )
+            result = {
+                "ampel": get_ampel(strategies),
+                "triaged": triaged,
+                "findings": [
+                    {
+                        "strategy": strategy.strategy.name,
+                        "content": strategy.content,
+                        "start": strategy.location.start if strategy.location is not None else None,
+                        "end": strategy.location.end if strategy.location is not None else None,
+                    }
+                    for strategy in strategies
+                ],
+            }
+            if report:
+                result["report"] = await AppliedStrategy.construct_answer_from_list(
+                    strategies,
+                    text,
+                    self.tier(self.valves.TIER_EXPLANATION),
+                    max_concurrency=self.valves.EXPLANATION_CONCURRENCY,
+                    explanation_cache=self.explanation_cache,
+                    batched=self.valves.EXPLANATION_MODE == "batched",
+                    batch_fallback=self.valves.EXPLANATION_BATCH_FALLBACK,
+                    explanations=explanations,
+                )
+        finally:
+            if explanations is not None:
+                explanations.cancel()
+        return result
+
+    async def pipe(
         self, user_message: str, model_id: str, messages: List[dict], body: dict
-    ) -> Union[str, Generator, Iterator]:
-        # If you'd like to check for title generation, you can add the following check
-        if body.get("title", False):
-            print("Title Generation Request")
+    ) -> AsyncGenerator[str, None]:
+        # async so that main.py awaits it on the event loop instead of blocking a threadpool worker
+        task = detect_task(body, user_message)
+        if task is not None:
+            yield await self.answer_task(task, user_message, messages)
+            return
 
         if is_first_message(messages):
-            strategies: list[AppliedStrategy] = identify_strategies(
-                user_message, openai_client=self.llm
+            # scored and chosen once, the cache keys, the triage and the classification all depend on them
+            triage_score = self.triage_score(user_message)
+            tier = self.classification_tier(user_message, triage_score)
+            settings = self.analysis_settings(user_message, tier)
+            cache_key = self.result_cache_key(user_message, settings)
+            if self.result_cache is not None:
+                cached = await self.result_cache.aget(cache_key)
+                if cached is not None:
+                    analysis = json.loads(cached)
+                    yield analysis["report"]
+                    strategies = [AppliedStrategy.from_stored(finding) for finding in analysis["findings"]]
+                    await self.remember_conversation(body, messages, user_message, analysis["report"], strategies)
+                    return
+
+            # the findings of a near duplicate come with their explanations, so the report needs no calls
+            strategies = await self.find_near_duplicate(user_message, settings)
+            if strategies is None and self.is_benign(user_message, triage_score):
+                report = await AppliedStrategy.construct_answer_from_list([], user_message, self.llm)
+                yield report
+                await self.remember_conversation(body, messages, user_message, report, [])
+                return
+
+            # with pipelined extraction the explanations are already generated while the
+            # remaining strategies are extracted
+            explanations = self.explanation_streams(user_message) if strategies is None else None
+            try:
+                if strategies is None:
+                    strategies = await self.identify(
+                        user_message,
+                        on_strategy=explanations.start if explanations is not None else None,
+                        tier=tier,
+                    )
+                # the header and short summary are sent as soon as the strategies are known,
+                # the explanations follow token by token
+                answer = []
+                report_span = start_span("report", strategies=len(strategies))
+                async for piece in AppliedStrategy.iter_answer_from_list(
+                    strategies=strategies,
+                    original_text=user_message,
+                    openai_client=self.tier(self.valves.TIER_EXPLANATION),
+                    max_concurrency=self.valves.EXPLANATION_CONCURRENCY,
+                    stream=body.get("stream", True),
+                    explanation_cache=self.explanation_cache,
+                    batched=self.valves.EXPLANATION_MODE == "batched",
+                    batch_fallback=self.valves.EXPLANATION_BATCH_FALLBACK,
+                    explanations=explanations,
+                ):
+                    answer.append(piece)
+                    yield piece
+                report_span.end()
+            finally:
+                if explanations is not None:
+                    explanations.cancel()
+
+            # only complete reports are cached, an aborted stream never gets here
+            report = "".join(answer)
+            if self.result_cache is not None:
+                await self.result_cache.aset(
+                    cache_key,
+                    json.dumps(
+                        {"report": report, "findings": [strategy.to_stored() for strategy in strategies]},
+                        ensure_ascii=False,
+                    ),
+                )
+            await self.remember_conversation(body, messages, user_message, report, strategies)
+            await self.remember_analysis(user_message, strategies, settings)
+            await self.remember_paragraphs(user_message, strategies)
+        else:
+            previous_text = self.find_revised_text(messages) if self.valves.INCREMENTAL_ANALYSIS else None
+            if previous_text is not None:
+                async for piece in self.reanalyze(user_message, previous_text, messages, body):
+                    yield piece
+            else:
+                async for piece in self.follow_up(messages, body):
+                    yield piece
+
+    async def reanalyze(
+        self, user_message: str, previous_text: str, messages: list[dict], body: dict
+    ) -> AsyncIterator[str]:
+        """
+        analyses a new version of an analysed text: the findings of the paragraphs that are unchanged from the
+        analysed version come from the stored conversation, those of paragraphs analysed before from the
+        paragraph cache, only the other paragraphs are classified (consecutive ones together)
+        """
+        paragraphs = split_paragraphs(user_message)
+        unchanged = diff_paragraphs(previous_text, user_message)
+        chat = conversation_id(body, messages)
+        conversation = (
+            await self.conversations.aget(chat) if self.conversations is not None and chat is not None else None
+        )
+        stored = (
+            findings_by_paragraph(
+                conversation.text,
+                conversation.findings,
+                PassageLocator(conversation.text, min_score=self.valves.PASSAGE_MIN_SCORE),
             )
-            result = AppliedStrategy.construct_answer_from_list(
-                strategies=strategies,
-                original_text=user_message,
-                openai_client=self.llm,
+            if conversation is not None
+            else None
+        )
+        known: list[list[AppliedStrategy] | None] = []
+        for paragraph, is_unchanged in zip(paragraphs, unchanged):
+            text = user_message[paragraph.start : paragraph.end]
+            findings = stored.get(paragraph_key(text)) if stored is not None and is_unchanged else None
+            if findings is None and self.paragraph_cache is not None:
+                value = await self.paragraph_cache.aget(self.paragraph_cache_key(text))
+                if value is not None:
+                    findings = [AppliedStrategy.from_stored(finding) for finding in json.loads(value)]
+            known.append(findings)
+        runs = contiguous_runs([index for index, findings in enumerate(known) if findings is None])
+        changed = unchanged.count(False)
+        classified = sum(last - first + 1 for first, last in runs)
+
+        with span("reanalyze", paragraphs=len(paragraphs), changed=changed, classified=classified):
+            run_strategies = await gather_with_concurrency(
+                [self.identify(user_message[paragraphs[first].start : paragraphs[last].end]) for first, last in runs],
+                max_concurrency=self.valves.CHUNK_CONCURRENCY,
             )
+        run_findings = {first: strategies for (first, _), strategies in zip(runs, run_strategies)}
+        strategies = [
+            strategy
+            for index, findings in enumerate(known)
+            for strategy in (findings if findings is not None else run_findings.get(index, []))
+        ]
+        AppliedStrategy.locate(strategies, PassageLocator(user_message, min_score=self.valves.PASSAGE_MIN_SCORE))
+        # a passage across the border of a run may have been found twice
+        strategies = merge_strategies(strategies)
+
+        if self.conversations is not None and chat is not None:
+            # follow-ups refer to the new version from now on, the summary was about the old one
+            await self.conversations.aset(chat, Conversation(text=user_message, findings=strategies))
+
+        report_span = start_span("report", strategies=len(strategies))
+        async for piece in AppliedStrategy.iter_answer_from_list(
+            strategies=strategies,
+            original_text=user_message,
+            openai_client=self.tier(self.valves.TIER_EXPLANATION),
+            max_concurrency=self.valves.EXPLANATION_CONCURRENCY,
+            stream=body.get("stream", True),
+            explanation_cache=self.explanation_cache,
+            batched=self.valves.EXPLANATION_MODE == "batched",
+            batch_fallback=self.valves.EXPLANATION_BATCH_FALLBACK,
+        ):
+            yield piece
+        report_span.end()
+        yield (
+            f"\n\n_Neue Fassung des Textes: {changed} von {len(paragraphs)} Absätzen sind neu oder geändert, "
+            f"{classified} wurden neu analysiert._"
+        )
+        await self.remember_paragraphs(user_message, strategies)
+
+    async def answer_task(self, task: str, user_message: str, messages: list[dict]) -> str:
+        """answers a task request of Open WebUI with a single call of the task tier, or without the model"""
+        router = self.routers.get(self.valves.TIER_TASK)
+        with span("task", task=task):
+            if router is not None:
+                try:
+                    completion = await router.chat.completions.create(
+                        model=deployment, messages=messages, temperature=0
+                    )
+                    return completion.choices[0].message.content or ""
+                except Exception as e:
+                    print(f"Task request {task} failed, answering without the model: {e}")
+            return build_task_answer(task, user_message)
+
+    async def follow_up(self, messages: list[dict], body: dict) -> AsyncIterator[str]:
+        """
+        answers a follow-up from the stored findings, the last messages and a summary of the older ones,
+        instead of resending the text and the long report with every turn
+        """
+        conversation = None
+        chat = conversation_id(body, messages)
+        if self.conversations is not None and chat is not None:
+            conversation = await self.conversations.aget(chat)
+
+        if conversation is None:
+            # the findings are unknown (e.g. evicted), so the whole history is needed
+            follow_up_messages = messages
         else:
-            # follow up
-            completion = self.llm.chat.completions.create(
-                model=deployment, messages=messages
+            follow_up_messages = build_follow_up_messages(
+                conversation, messages, recent_messages=self.valves.FOLLOW_UP_RECENT_MESSAGES
             )
-            result = completion.choices[0].message.content
 
-        return result
+        follow_up_span = start_span("follow_up", stored=conversation is not None)
+        with activate(follow_up_span):
+            stream = await self.tier(self.valves.TIER_FOLLOW_UP).chat.completions.create(
+                model=deployment, messages=follow_up_messages, stream=True
+            )
+        deltas = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        follow_up_span.end()
+
+        if conversation is not None:
+            history = messages[2:] + [{"role": "assistant", "content": "".join(deltas)}]
+            task = asyncio.create_task(
+                self.summarize_conversation(
+                    chat, conversation, history, recent_messages=self.valves.FOLLOW_UP_RECENT_MESSAGES
+                )
+            )
+            self._summary_tasks.add(task)
+            task.add_done_callback(self._summary_tasks.discard)
+
+    async def summarize_conversation(
+        self, chat: str, conversation: Conversation, history: list[dict], recent_messages: int
+    ) -> None:
+        """folds the messages that dropped out of the recent ones into the summary of the conversation"""
+        older = history[: max(len(history) - recent_messages, 0)]
+        summary, summarized_messages = conversation.summary_of(history)
+        if len(older) <= summarized_messages:
+            return
+        try:
+            prompt = get_prompt_templates(self.strategy_examples)["summarize_conversation"].render(
+                SUMMARY=summary or "-",
+                MESSAGES=format_messages(older[summarized_messages:]),
+            )
+            with span("summarize_conversation"):
+                completion = await self.tier(self.valves.TIER_FOLLOW_UP).chat.completions.create(
+                    model=deployment,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=0,
+                )
+        except Exception as e:
+            # the next follow-up sends the messages verbatim instead
+            print(f"Summarizing the conversation failed: {e}")
+            return
+
+        conversation.summary = completion.choices[0].message.content
+        conversation.summarized_messages = len(older)
+        conversation.summarized_key = messages_key(older)
+        if self.conversations is not None:
+            await self.conversations.aset(chat, conversation)
 
 
 fake_experts_desc = "Eine unqualifizierte Person oder Institution wird als Quelle glaubwürdiger Informationen präsentiert."
@@ -83,6 +872,114 @@ cherry_picking_desc = "Sorgfältige Auswahl von Daten, die eine Position zu best
 conspiracy_theory_desc = "Eine Verschwörung zur Umsetzung eines üblen Plans vermuten, wie das Verbergen der Wahrheit oder das Weitergeben von Falschinformationen."
 
 
+# The prompts are compiled once by build_prompt_templates, $PLACEHOLDER_<NAME> marks the fields.
+IDENTIFY_STRATEGIES_SYSTEM_PROMPT = "Du bist ein sorgfältiger Desinformation-Experte, welcher aus Texten die verwendeten Strategien für Desinformation identifiziert."
+
+IDENTIFY_STRATEGIES_PROMPT = """
+    Deine Aufgabe ist es, aus dem [TEXT] Strategien für Desinformationen zu identifizieren und zusammen mit den zugehörigen Textstellen zu extrahieren.
+    Beachte, dass die gleiche Strategie an mehreren Stellen im [TEXT] vorkommen kann.
+    Außerdem kann die gleiche Textstelle auch mehrere Strategien umfassen.
+    
+    Hier sind Beispiele für die verschiedenen Strategien des Desinformation:
+    $PLACEHOLDER_STRATEGY_EXAMPLES
+
+    [TEXT]
+    $PLACEHOLDER_TEXT
+
+    Verwendete Strategien des [TEXT]s mit zugehörigen Textstellen:
+    """
+
+ACTION_SYSTEM_PROMPT = "Du bist ein Experte, das darauf spezialisiert ist, Menschen beim Hinterfragen von Argumenten zu unterstützen."
+
+ACTION_PROMPT = """
+        Du erhältst einen originalen Text und eine Textpassage daraus.
+        Für diese Testpassage wurde identifiziert, dass eventuell die Strategie $PLACEHOLDER_STRATEGY zur Verbreitung von Desinfomration verwendet wurde.
+        Die Strategie $PLACEHOLDER_STRATEGY umfasst dabei folgendes: $PLACEHOLDER_STRATEGY_DESCRIPTION
+
+        Deine Aufgaben:
+            Erläutere in Bezug auf die Textpassage, wie die Strategie $PLACEHOLDER_STRATEGY möglicherweise angewendet wurde (maximal 2 prägnante Sätze).
+            Gib zuzsätzlich konkrete Handlungsanweisungen, wie überprüft werden kann, ob die Strategie $PLACEHOLDER_STRATEGY tatsächlich angewendet wurde (maximal ein prägnanter Satz).
+            Verwende dabei einfache Alltagssprache.
+            Statt "In der Textpassage" kannst du einfach mit "Hier" Bezug zur Passage nehmen.
+            Berücksichtige unbedingt, dass noch nicht bestätigt ist, dass die Strategie $PLACEHOLDER_STRATEGY wirklich angewendet wurde. Formuliere dementsprechend Teile passend im Konjunktiv.
+
+        Input:
+            Originaler Text: $PLACEHOLDER_TEXT
+            Textpassage, bei der die potenzielle Strategie $PLACEHOLDER_STRATEGY identifiziert wurde: $PLACEHOLDER_PASSAGE
+        
+        Prägnante Erläuterung der potenziellen Strategie $PLACEHOLDER_STRATEGY in Bezug auf die Textpassage + konkrete Handlungsanweisungen, um dies zu überprüfen:
+        """
+
+MERGED_ACTION_PROMPT = """
+        Du erhältst einen originalen Text und eine Textpassage daraus.
+        Für diese Textpassage wurde identifiziert, dass eventuell mehrere Strategien zur Verbreitung von Desinformation verwendet wurden.
+        Die Strategien umfassen dabei folgendes:
+        $PLACEHOLDER_DESCRIPTIONS
+
+        Deine Aufgaben für jede dieser Strategien:
+            Erläutere in Bezug auf die Textpassage, wie die Strategie möglicherweise angewendet wurde (maximal 2 prägnante Sätze).
+            Gib zusätzlich konkrete Handlungsanweisungen, wie überprüft werden kann, ob die Strategie tatsächlich angewendet wurde (maximal ein prägnanter Satz).
+            Verwende dabei einfache Alltagssprache.
+            Statt "In der Textpassage" kannst du einfach mit "Hier" Bezug zur Passage nehmen.
+            Berücksichtige unbedingt, dass noch nicht bestätigt ist, dass die Strategie wirklich angewendet wurde. Formuliere dementsprechend Teile passend im Konjunktiv.
+
+        Input:
+            Originaler Text: $PLACEHOLDER_TEXT
+            Textpassage, bei der die potenziellen Strategien $PLACEHOLDER_STRATEGIES identifiziert wurden: $PLACEHOLDER_PASSAGE
+
+        Prägnante Erläuterung jeder potenziellen Strategie in Bezug auf die Textpassage + konkrete Handlungsanweisungen, um dies zu überprüfen:
+        """
+
+BATCHED_ACTION_PROMPT = """
+        Du erhältst einen originalen Text und nummerierte Textpassagen daraus.
+        Für jede Textpassage wurde identifiziert, dass eventuell die angegebene Strategie zur Verbreitung von Desinfomration verwendet wurde.
+        Die Strategien umfassen dabei folgendes:
+        $PLACEHOLDER_DESCRIPTIONS
+
+        Deine Aufgaben für jede Textpassage:
+            Erläutere in Bezug auf die Textpassage, wie die Strategie möglicherweise angewendet wurde (maximal 2 prägnante Sätze).
+            Gib zuzsätzlich konkrete Handlungsanweisungen, wie überprüft werden kann, ob die Strategie tatsächlich angewendet wurde (maximal ein prägnanter Satz).
+            Verwende dabei einfache Alltagssprache.
+            Statt "In der Textpassage" kannst du einfach mit "Hier" Bezug zur Passage nehmen.
+            Berücksichtige unbedingt, dass noch nicht bestätigt ist, dass die Strategie wirklich angewendet wurde. Formuliere dementsprechend Teile passend im Konjunktiv.
+
+        Input:
+            Originaler Text: $PLACEHOLDER_TEXT
+            Textpassagen:
+        $PLACEHOLDER_PASSAGES
+
+        Prägnante Erläuterung der potenziellen Strategie + konkrete Handlungsanweisungen für jede Textpassage:
+        """
+
+FOLLOW_UP_SYSTEM_PROMPT = "Du bist ein Desinformation-Experte, welcher Rückfragen zur Analyse eines Textes auf Strategien für Desinformation beantwortet."
+
+FOLLOW_UP_CONTEXT_PROMPT = """
+    Der [TEXT] wurde auf Strategien für Desinformation untersucht.
+
+    [TEXT]
+    $PLACEHOLDER_TEXT
+
+    Gefundene Strategien mit zugehörigen Textstellen:
+    $PLACEHOLDER_FINDINGS
+
+    Zusammenfassung der bisherigen Rückfragen:
+    $PLACEHOLDER_SUMMARY
+    """
+
+SUMMARIZE_CONVERSATION_PROMPT = """
+    Fasse die [BISHERIGE ZUSAMMENFASSUNG] und das [GESPRÄCH] über die Analyse eines Textes in wenigen Sätzen zusammen.
+    Behalte alle Fragen, Antworten und Festlegungen, die für weitere Rückfragen wichtig sind.
+
+    [BISHERIGE ZUSAMMENFASSUNG]
+    $PLACEHOLDER_SUMMARY
+
+    [GESPRÄCH]
+    $PLACEHOLDER_MESSAGES
+
+    Zusammenfassung:
+    """
+
+
 class Strategy(str, Enum):
     f"""
     Pseudo-Experten: {fake_experts_desc}
@@ -98,20 +995,21 @@ class Strategy(str, Enum):
     CONSPIRACY_THEORIES = "Verschwörungsmythen"
 
     def get_description(self) -> str:
-        if self == Strategy.FAKE_EXPERTS:
-            return fake_experts_desc
-        elif self == Strategy.LOGICAL_FALLACIES:
-            return logical_fallacies_desc
-        elif self == Strategy.IMPOSSIBLE_EXPECTATIONS:
-            return impossible_expecations_desc
-        elif self == Strategy.CHERRY_PICKING:
-            return cherry_picking_desc
-        elif self == Strategy.CONSPIRACY_THEORIES:
-            return conspiracy_theory_desc
-        else:
+        try:
+            return strategy_descriptions[self]
+        except KeyError:
             raise NotImplementedError(f"{self} not implemented.")
 
 
+strategy_descriptions: dict[Strategy, str] = {
+    Strategy.FAKE_EXPERTS: fake_experts_desc,
+    Strategy.LOGICAL_FALLACIES: logical_fallacies_desc,
+    Strategy.IMPOSSIBLE_EXPECTATIONS: impossible_expecations_desc,
+    Strategy.CHERRY_PICKING: cherry_picking_desc,
+    Strategy.CONSPIRACY_THEORIES: conspiracy_theory_desc,
+}
+
+
 class AppliedStrategy(BaseModel):
     strategy: Strategy = Field(
         description="Die Strategie der Desinformation, welche möglicherweise angewendet wurde."
@@ -119,6 +1017,51 @@ class AppliedStrategy(BaseModel):
     content: str = Field(
         description="Der Textstelle des Textes, bei der möglicherweise die Strategie der Desinformation angewendet wurde."
     )
+    # where the passage is in the analysed text, not part of the schema sent to the model
+    _location: PassageSpan | None = PrivateAttr(default=None)
+    # the explanation of the report, once it was generated or if it is reused from a near duplicate
+    _explanation: str | None = PrivateAttr(default=None)
+
+    @property
+    def location(self) -> PassageSpan | None:
+        return self._location
+
+    @property
+    def explanation(self) -> str | None:
+        return self._explanation
+
+    def to_stored(self) -> dict:
+        return {"strategy": self.strategy.name, "content": self.content, "explanation": self._explanation}
+
+    @classmethod
+    def from_stored(cls, finding: dict) -> AppliedStrategy:
+        strategy = cls(strategy=Strategy[finding["strategy"]], content=finding["content"])
+        strategy._explanation = finding.get("explanation")
+        return strategy
+
+    @property
+    def passage_id(self) -> str:
+        """strategies with the same passage id quote the same passage"""
+        if self._location is not None:
+            return f"{self._location.start}:{self._location.end}"
+        return passage_key(self.content)
+
+    def quote(self, original_text: str) -> str:
+        """the passage as written in the text if it was located, otherwise as quoted by the model"""
+        if self._location is None:
+            return self.content
+        return " ".join(original_text[self._location.start : self._location.end].split())
+
+    @classmethod
+    def locate(cls, strategies: list[AppliedStrategy], locator: PassageLocator) -> None:
+        """finds the passages of all strategies in the text of the locator in one pass"""
+        with span("locate_passages", passages=len(strategies)) as locate_span:
+            for strategy, location in zip(strategies, locator.locate_all([strategy.content for strategy in strategies])):
+                strategy._location = location
+            locate_span.set(
+                exact=sum(1 for strategy in strategies if strategy.location is not None and strategy.location.exact),
+                missing=sum(1 for strategy in strategies if strategy.location is None),
+            )
 
     @classmethod
     def return_example_list(cls) -> list[AppliedStrategy]:
@@ -133,137 +1076,1208 @@ class AppliedStrategy(BaseModel):
             ),
         ]
 
-    def create_action(self, original_text: str, openai_client: AzureOpenAI) -> str:
-        system_prompt = "Du bist ein Experte, das darauf spezialisiert ist, Menschen beim Hinterfragen von Argumenten zu unterstützen."
+    def _action_messages(self, original_text: str) -> list[dict]:
+        template = get_prompt_templates()[f"create_action/{self.strategy.name}"]
+        prompt = template.render(TEXT=original_text.replace("\n", " "), PASSAGE=self.content)
 
-        text = original_text.replace("\n", " ")
-        prompt = f"""
-        Du erhältst einen originalen Text und eine Textpassage daraus.
-        Für diese Testpassage wurde identifiziert, dass eventuell die Strategie {self.strategy.value} zur Verbreitung von Desinfomration verwendet wurde.
-        Die Strategie {self.strategy.value} umfasst dabei folgendes: {self.strategy.get_description()}
+        return [
+            {"role": "system", "content": ACTION_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
 
-        Deine Aufgaben:
-            Erläutere in Bezug auf die Textpassage, wie die Strategie {self.strategy.value} möglicherweise angewendet wurde (maximal 2 prägnante Sätze).
-            Gib zuzsätzlich konkrete Handlungsanweisungen, wie überprüft werden kann, ob die Strategie {self.strategy.value} tatsächlich angewendet wurde (maximal ein prägnanter Satz).
-            Verwende dabei einfache Alltagssprache.
-            Statt "In der Textpassage" kannst du einfach mit "Hier" Bezug zur Passage nehmen.
-            Berücksichtige unbedingt, dass noch nicht bestätigt ist, dass die Strategie {self.strategy.value} wirklich angewendet wurde. Formuliere dementsprechend Teile passend im Konjunktiv.
+    async def create_action(
+        self,
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        explanation_cache: ExplanationCache | None = None,
+        check_cache: bool = True,
+    ) -> str:
+        """the action for the strategy; check_cache is False if the caller already missed the explanation cache"""
+        with span("create_action", strategy=self.strategy.name) as action_span:
+            if explanation_cache is not None and check_cache:
+                cached = await explanation_cache.aget(self, original_text)
+                if cached is not None:
+                    action_span.set(cached=True)
+                    return cached
 
-        Input:
-            Originaler Text: {text}
-            Textpassage, bei der die potenzielle Strategie {self.strategy.value} identifiziert wurde: {self.content}
-        
-        Prägnante Erläuterung der potenziellen Strategie {self.strategy.value} in Bezug auf die Textpassage + konkrete Handlungsanweisungen, um dies zu überprüfen:
-        """
+            completion = await openai_client.chat.completions.create(
+                model=deployment,
+                messages=self._action_messages(original_text),
+            )
+        action = completion.choices[0].message.content
 
-        completion = openai_client.chat.completions.create(
-            model=deployment,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
+        if explanation_cache is not None and completion.choices[0].finish_reason == "stop" and action:
+            await explanation_cache.aset(self, original_text, action)
+        return action
+
+    async def stream_action(
+        self,
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        explanation_cache: ExplanationCache | None = None,
+    ) -> AsyncIterator[str]:
+        """same as create_action, but yields the answer token by token"""
+        action_span = start_span("create_action", strategy=self.strategy.name)
+        if explanation_cache is not None:
+            cached = await explanation_cache.aget(self, original_text)
+            if cached is not None:
+                action_span.set(cached=True)
+                action_span.end()
+                yield cached
+                return
+
+        with activate(action_span):
+            stream = await openai_client.chat.completions.create(
+                model=deployment,
+                messages=self._action_messages(original_text),
+                stream=True,
+            )
+        deltas = []
+        finish_reason = None
+        async for chunk in stream:
+            # azure sends chunks without choices, e.g. for the content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                deltas.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            if chunk.choices and getattr(chunk.choices[0], "finish_reason", None):
+                finish_reason = chunk.choices[0].finish_reason
+        action_span.end()
+
+        # explanations cut off by the length limit or the content filter are not cached
+        action = "".join(deltas)
+        if explanation_cache is not None and finish_reason == "stop" and action:
+            await explanation_cache.aset(self, original_text, action)
+
+    @classmethod
+    async def create_actions(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        explanation_cache: ExplanationCache | None = None,
+        batched: bool = False,
+        batch_fallback: bool = True,
+    ) -> list[str]:
+        """creates the actions for all strategies, keeping the order of the input list"""
+        if batched and len(strategies) > 1:
+            try:
+                return await cls.create_actions_batched(
+                    strategies,
+                    original_text=original_text,
+                    openai_client=openai_client,
+                    explanation_cache=explanation_cache,
+                )
+            except Exception as e:
+                if not batch_fallback:
+                    raise
+                print(f"Batched explanation failed, falling back to one call per passage: {e}")
+
+        # a passage flagged with several strategies is explained with a single call
+        groups = cls.group_by_passage(strategies)
+        group_actions = await gather_with_concurrency(
+            [
+                cls.create_actions_merged(
+                    group,
+                    original_text=original_text,
+                    openai_client=openai_client,
+                    explanation_cache=explanation_cache,
+                )
+                for group in groups
             ],
+            max_concurrency=max_concurrency,
         )
+        actions = {
+            id(strategy): action
+            for group, actions in zip(groups, group_actions)
+            for strategy, action in zip(group, actions)
+        }
+        return [actions[id(strategy)] for strategy in strategies]
 
-        return completion.choices[0].message.content
+    @classmethod
+    async def create_actions_merged(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        explanation_cache: ExplanationCache | None = None,
+    ) -> list[str]:
+        """
+        creates the actions for several strategies of the same passage with a single structured call,
+        so the original text and the passage are only sent once
+        """
+        actions: list[str | None] = [None] * len(strategies)
+        if explanation_cache is not None:
+            actions = [await explanation_cache.aget(strategy, original_text) for strategy in strategies]
+        missing = [i for i, action in enumerate(actions) if action is None]
+        if len(missing) == 1:
+            i = missing[0]
+            actions[i] = await strategies[i].create_action(
+                original_text=original_text,
+                openai_client=openai_client,
+                explanation_cache=explanation_cache,
+                check_cache=False,
+            )
+        if len(missing) <= 1:
+            return actions
+
+        missing_strategies = list(dict.fromkeys(strategies[i].strategy for i in missing))
+        prompt = get_prompt_templates()["create_actions_merged"].render(
+            DESCRIPTIONS="\n".join(
+                f"\t{strategy.value}: {strategy.get_description()}" for strategy in missing_strategies
+            ),
+            STRATEGIES=", ".join(strategy.value for strategy in missing_strategies),
+            TEXT=original_text.replace("\n", " "),
+            PASSAGE=strategies[missing[0]].content,
+        )
+
+        client = structured_client(openai_client)
+        with span("create_actions_merged", strategies=len(missing_strategies)):
+            completion: StrategyExplanations = await client.chat.completions.create(
+                model=deployment,
+                response_model=StrategyExplanations,
+                messages=[
+                    {"role": "system", "content": ACTION_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                # lets instructor retry until every strategy is explained exactly once
+                validation_context={"strategies": missing_strategies},
+            )
+
+        explanations = {explanation.strategy: explanation.explanation for explanation in completion.explanations}
+        for i in missing:
+            actions[i] = explanations[strategies[i].strategy]
+            if explanation_cache is not None:
+                await explanation_cache.aset(strategies[i], original_text, actions[i])
+        return actions
+
+    @classmethod
+    async def create_actions_batched(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        explanation_cache: ExplanationCache | None = None,
+    ) -> list[str]:
+        """
+        creates the actions for all strategies with a single structured call,
+        so the original text is only sent once instead of once per passage
+        """
+        actions: list[str | None] = [None] * len(strategies)
+        if explanation_cache is not None:
+            actions = [await explanation_cache.aget(strategy, original_text) for strategy in strategies]
+        missing = [i for i, action in enumerate(actions) if action is None]
+        if not missing:
+            return actions
+
+        used_strategies = list(dict.fromkeys(strategies[i].strategy for i in missing))
+        descriptions = "\n".join(
+            f"\t{strategy.value}: {strategy.get_description()}" for strategy in used_strategies
+        )
+        passages = "\n".join(
+            f"\tTextpassage {number}: {strategies[i].content}\n\t\tPotenzielle Strategie: {strategies[i].strategy.value}"
+            for number, i in enumerate(missing)
+        )
+        prompt = get_prompt_templates()["create_actions_batched"].render(
+            DESCRIPTIONS=descriptions,
+            TEXT=original_text.replace("\n", " "),
+            PASSAGES=passages,
+        )
+
+        client = structured_client(openai_client)
+        with span("create_actions_batched", passages=len(missing)):
+            completion: PassageExplanations = await client.chat.completions.create(
+                model=deployment,
+                response_model=PassageExplanations,
+                messages=[
+                    {"role": "system", "content": ACTION_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+                # lets instructor retry until there is exactly one explanation per passage
+                validation_context={"passage_count": len(missing)},
+            )
+
+        for explanation in completion.explanations:
+            i = missing[explanation.index]
+            actions[i] = explanation.explanation
+            if explanation_cache is not None:
+                await explanation_cache.aset(strategies[i], original_text, explanation.explanation)
+        return actions
+
+    @classmethod
+    async def stream_actions(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        explanation_cache: ExplanationCache | None = None,
+    ) -> AsyncIterator[AsyncIterator[str]]:
+        """
+        streams the actions for all strategies, keeping the order of the input list.
+        All actions are requested at once (bounded by max_concurrency); the deltas of
+        actions further down the list are buffered until it is their turn.
+        Strategies of the same passage share a single call.
+        """
+        if len(strategies) <= 1:
+            for strategy in strategies:
+                yield strategy.stream_action(
+                    original_text=original_text,
+                    openai_client=openai_client,
+                    explanation_cache=explanation_cache,
+                )
+            return
+
+        explanations = ExplanationStreams(
+            original_text,
+            openai_client,
+            max_concurrency=max_concurrency,
+            explanation_cache=explanation_cache,
+        )
+        for strategy in strategies:
+            explanations.start(strategy)
+        try:
+            for strategy in strategies:
+                yield explanations.stream(strategy)
+        finally:
+            # the client may disconnect before everything was consumed
+            explanations.cancel()
+
+    @classmethod
+    def group_by_passage(cls, strategies: list[AppliedStrategy]) -> list[list[AppliedStrategy]]:
+        """strategies of the same passage (see passage_id), in the order of their first occurrence"""
+        passage_map: dict[str, list[AppliedStrategy]] = {}
+        for strategy in strategies:
+            passage_map.setdefault(strategy.passage_id, []).append(strategy)
+        return list(passage_map.values())
 
     @classmethod
-    def stringify_long(cls, strategies: list[AppliedStrategy], original_text: str, openai_client: AzureOpenAI) -> str:
+    def group_by_strategy(cls, strategies: list[AppliedStrategy]) -> dict[Strategy, list[AppliedStrategy]]:
         strategy_map: dict[Strategy, list[AppliedStrategy]] = {}
         for strategy in strategies:
             if strategy.strategy not in strategy_map:
                 strategy_map[strategy.strategy] = []
             strategy_map[strategy.strategy].append(strategy)
-        texts = []
-        for strategy, applied_strategies in strategy_map.items():
-            texts.append(f"### {strategy.value}")
+        return strategy_map
+
+    @classmethod
+    async def iter_long(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        stream: bool = False,
+        explanation_cache: ExplanationCache | None = None,
+        batched: bool = False,
+        batch_fallback: bool = True,
+        explanations: ExplanationStreams | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        yields the long answer piece by piece, joined it equals stringify_long.
+        explanations started during the extraction are taken from explanations.
+        """
+        strategy_map = cls.group_by_strategy(strategies)
+
+        # the actions are requested in the same order in which they are rendered
+        ordered_strategies = [
+            applied_strategy
+            for applied_strategies in strategy_map.values()
+            for applied_strategy in applied_strategies
+        ]
+        # known explanations (e.g. of a near duplicate or an unchanged paragraph) aren't generated again
+        known = {id(strategy) for strategy in ordered_strategies if strategy.explanation is not None}
+        unexplained = [strategy for strategy in ordered_strategies if id(strategy) not in known]
+        if not unexplained:
+            actions = iter_as_async([])
+        elif explanations is not None:
+            actions = iter_as_async([explanations.stream(strategy) for strategy in unexplained])
+        # a batched call returns all actions at once, so there is nothing to stream
+        elif stream and not batched:
+            actions = cls.stream_actions(
+                unexplained,
+                original_text=original_text,
+                openai_client=openai_client,
+                max_concurrency=max_concurrency,
+                explanation_cache=explanation_cache,
+            )
+        else:
+            actions = iter_as_async(
+                [
+                    iter_as_async([action])
+                    for action in await cls.create_actions(
+                        unexplained,
+                        original_text=original_text,
+                        openai_client=openai_client,
+                        max_concurrency=max_concurrency,
+                        explanation_cache=explanation_cache,
+                        batched=batched,
+                        batch_fallback=batch_fallback,
+                    )
+                ]
+            )
+
+        for i, (strategy, applied_strategies) in enumerate(strategy_map.items()):
+            yield ("\n" if i else "") + f"### {strategy.value}"
             for applied_strategy in applied_strategies:
-                texts.append(f"> {applied_strategy.content}\n\n{applied_strategy.create_action(original_text=original_text, openai_client=openai_client)}")
-            texts.append("\n\n")
-        return "\n".join(texts)
-    
+                yield f"\n> {applied_strategy.quote(original_text)}\n\n"
+                if id(applied_strategy) in known:
+                    yield applied_strategy.explanation
+                    continue
+                deltas = []
+                async for delta in await anext(actions):
+                    deltas.append(delta)
+                    yield delta
+                applied_strategy._explanation = "".join(deltas)
+            yield "\n\n\n"
+
+    @classmethod
+    async def stringify_long(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        explanation_cache: ExplanationCache | None = None,
+        batched: bool = False,
+        batch_fallback: bool = True,
+    ) -> str:
+        return "".join(
+            [
+                piece
+                async for piece in cls.iter_long(
+                    strategies,
+                    original_text,
+                    openai_client,
+                    max_concurrency=max_concurrency,
+                    explanation_cache=explanation_cache,
+                    batched=batched,
+                    batch_fallback=batch_fallback,
+                )
+            ]
+        )
+
     @classmethod
     def stringify_short(cls, strategies: list[AppliedStrategy]) -> str:
         #group for strategy
-        strategy_map: dict[Strategy, list[AppliedStrategy]] = {}
-        for strategy in strategies:
-            if strategy.strategy not in strategy_map:
-                strategy_map[strategy.strategy] = []
-            strategy_map[strategy.strategy].append(strategy)
+        strategy_map = cls.group_by_strategy(strategies)
         return "\n".join([f"\t- {strategy.value} ({len(applied_strategies)}x)" for strategy, applied_strategies in strategy_map.items()])
 
     @classmethod
-    def construct_answer_from_list(
+    async def iter_answer_from_list(
         cls,
         strategies: list[AppliedStrategy],
         original_text: str,
-        openai_client: AzureOpenAI,
-    ) -> str:
-        individual_strategies_long = AppliedStrategy.stringify_long(strategies, original_text, openai_client)
-        individual_strategies_short = AppliedStrategy.stringify_short(strategies=strategies)
-
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        stream: bool = False,
+        explanation_cache: ExplanationCache | None = None,
+        batched: bool = False,
+        batch_fallback: bool = True,
+        explanations: ExplanationStreams | None = None,
+    ) -> AsyncIterator[str]:
+        """yields the answer section by section, the header and short summary come first"""
         if len(strategies) == 0:
-            return f"# {get_ampel(strategies)}\n\nEs wurden keine Anzeichen auf Strategien für Desinformation gefunden."
+            yield f"# {get_ampel(strategies)}\n\nEs wurden keine Anzeichen auf Strategien für Desinformation gefunden."
+            return
 
-        return f"""# {get_ampel(strategies)}
+        individual_strategies_short = AppliedStrategy.stringify_short(strategies=strategies)
+        yield f"""# {get_ampel(strategies)}
 
 ## Es liegen ggf. folgende Strategien von Desinformation vor
 {individual_strategies_short}
 
 ## Individuelle Textstellen
-{individual_strategies_long}"""
+"""
+        async for piece in AppliedStrategy.iter_long(
+            strategies,
+            original_text,
+            openai_client,
+            max_concurrency=max_concurrency,
+            stream=stream,
+            explanation_cache=explanation_cache,
+            batched=batched,
+            batch_fallback=batch_fallback,
+            explanations=explanations,
+        ):
+            yield piece
+
+    @classmethod
+    async def construct_answer_from_list(
+        cls,
+        strategies: list[AppliedStrategy],
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        explanation_cache: ExplanationCache | None = None,
+        batched: bool = False,
+        batch_fallback: bool = True,
+        explanations: ExplanationStreams | None = None,
+    ) -> str:
+        return "".join(
+            [
+                piece
+                async for piece in cls.iter_answer_from_list(
+                    strategies,
+                    original_text,
+                    openai_client,
+                    max_concurrency=max_concurrency,
+                    explanation_cache=explanation_cache,
+                    batched=batched,
+                    batch_fallback=batch_fallback,
+                    explanations=explanations,
+                )
+            ]
+        )
 
 
 AppliedStrategy.model_rebuild()
 
 
+class ExplanationStreams:
+    """
+    Generates the explanations of passages in the background, at most max_concurrency calls at once.
+    An explanation is started as soon as its passage is known, e.g. while the extraction is still
+    streaming, and its deltas are buffered until the report reaches the passage.
+    Strategies of a passage whose call has not started yet join that call.
+    """
+
+    _finished = object()
+
+    def __init__(
+        self,
+        original_text: str,
+        openai_client: AsyncAzureOpenAI,
+        max_concurrency: int = 1,
+        explanation_cache: ExplanationCache | None = None,
+    ):
+        self.original_text = original_text
+        self.openai_client = openai_client
+        self.explanation_cache = explanation_cache
+        self._semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        # keyed by the id of the strategy, the strategies are kept alive by the list of the caller
+        self._deltas: dict[int, asyncio.Queue] = {}
+        # the strategies of every passage whose call is still waiting to start
+        self._pending: dict[str, list[AppliedStrategy]] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self, strategy: AppliedStrategy) -> None:
+        if id(strategy) in self._deltas:
+            return
+        self._deltas[id(strategy)] = asyncio.Queue()
+        key = strategy.passage_id
+        if key in self._pending:
+            self._pending[key].append(strategy)
+            return
+        group = self._pending[key] = [strategy]
+        self._tasks.append(asyncio.create_task(self._produce(key, group)))
+
+    async def _produce(self, key: str, group: list[AppliedStrategy]) -> None:
+        try:
+            async with self._semaphore:
+                # strategies of this passage known from now on get a call of their own
+                del self._pending[key]
+                if len(group) == 1:
+                    async for delta in group[0].stream_action(
+                        original_text=self.original_text,
+                        openai_client=self.openai_client,
+                        explanation_cache=self.explanation_cache,
+                    ):
+                        self._deltas[id(group[0])].put_nowait(delta)
+                else:
+                    # the structured answer comes at once, there are no deltas to stream
+                    actions = await AppliedStrategy.create_actions_merged(
+                        group,
+                        original_text=self.original_text,
+                        openai_client=self.openai_client,
+                        explanation_cache=self.explanation_cache,
+                    )
+                    for strategy, action in zip(group, actions):
+                        self._deltas[id(strategy)].put_nowait(action)
+        except Exception as e:
+            for strategy in group:
+                self._deltas[id(strategy)].put_nowait(e)
+        for strategy in group:
+            self._deltas[id(strategy)].put_nowait(self._finished)
+
+    async def _consume(self, deltas: asyncio.Queue) -> AsyncIterator[str]:
+        while (delta := await deltas.get()) is not self._finished:
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+
+    def stream(self, strategy: AppliedStrategy) -> AsyncIterator[str]:
+        """the deltas of the explanation of a strategy, started now if it was not started before"""
+        self.start(strategy)
+        return self._consume(self._deltas[id(strategy)])
+
+    def cancel(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+
+class PassageExplanation(BaseModel):
+    index: int = Field(description="Die Nummer der Textpassage.")
+    explanation: str = Field(
+        description="Prägnante Erläuterung der potenziellen Strategie in Bezug auf die Textpassage + konkrete Handlungsanweisungen, um dies zu überprüfen."
+    )
+
+
+class PassageExplanations(BaseModel):
+    explanations: list[PassageExplanation]
+
+    @model_validator(mode="after")
+    def one_explanation_per_passage(self, info: ValidationInfo) -> PassageExplanations:
+        passage_count = (info.context or {}).get("passage_count")
+        if passage_count is not None:
+            indices = sorted(explanation.index for explanation in self.explanations)
+            if indices != list(range(passage_count)):
+                raise ValueError(
+                    f"Es muss genau eine Erläuterung für jede Textpassage 0 bis {passage_count - 1} geben."
+                )
+        return self
+
+
+PassageExplanations.model_rebuild()
+
+
+class StrategyExplanation(BaseModel):
+    strategy: Strategy = Field(description="Die Strategie, die erläutert wird.")
+    explanation: str = Field(
+        description="Prägnante Erläuterung der potenziellen Strategie in Bezug auf die Textpassage + konkrete Handlungsanweisungen, um dies zu überprüfen."
+    )
+
+
+StrategyExplanation.model_rebuild()
+
+
+class StrategyExplanations(BaseModel):
+    explanations: list[StrategyExplanation]
+
+    @model_validator(mode="after")
+    def one_explanation_per_strategy(self, info: ValidationInfo) -> StrategyExplanations:
+        strategies = (info.context or {}).get("strategies")
+        if strategies is not None:
+            explained = sorted(explanation.strategy.value for explanation in self.explanations)
+            if explained != sorted(strategy.value for strategy in strategies):
+                raise ValueError(
+                    f"Es muss genau eine Erläuterung für jede der Strategien {', '.join(strategy.value for strategy in strategies)} geben."
+                )
+        return self
+
+
+StrategyExplanations.model_rebuild()
+
+
+class ExplanationCache:
+    """
+    Memoizes the actions of AppliedStrategy.create_action across submissions.
+    By default the key contains a hash of the original text, since the explanation refers to it.
+    With passage_only the surrounding text is ignored, which gives more hits for edited texts.
+    """
+
+    def __init__(self, cache: ResultCache, passage_only: bool = False, model: str = ""):
+        self.cache = cache
+        self.passage_only = passage_only
+        self.model = model
+
+    def key(self, applied_strategy: AppliedStrategy, original_text: str) -> str:
+        context = "" if self.passage_only else content_key(normalize_text(original_text))
+        return content_key(
+            "action",
+            get_prompt_templates_version(),
+            deployment or "",
+            self.model,
+            applied_strategy.strategy.value,
+            normalize_text(applied_strategy.content),
+            context,
+        )
+
+    def get(self, applied_strategy: AppliedStrategy, original_text: str) -> str | None:
+        return self.cache.get(self.key(applied_strategy, original_text))
+
+    def set(self, applied_strategy: AppliedStrategy, original_text: str, action: str) -> None:
+        self.cache.set(self.key(applied_strategy, original_text), action)
+
+    async def aget(self, applied_strategy: AppliedStrategy, original_text: str) -> str | None:
+        return await self.cache.aget(self.key(applied_strategy, original_text))
+
+    async def aset(self, applied_strategy: AppliedStrategy, original_text: str, action: str) -> None:
+        await self.cache.aset(self.key(applied_strategy, original_text), action)
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+class Conversation(BaseModel):
+    """the analysis of the first message of a conversation, which follow-ups refer to"""
+
+    text: str
+    findings: list[AppliedStrategy]
+    # summary of the first summarized_messages follow-up messages
+    summary: str = ""
+    summarized_messages: int = 0
+    # hash of the summarized messages, so a summary is only used for the messages it was made of
+    summarized_key: str = ""
+
+    def summary_of(self, history: list[dict]) -> tuple[str, int]:
+        """the summary and the number of messages it covers, if it summarizes the first messages of history"""
+        if (
+            self.summarized_messages
+            and self.summarized_messages <= len(history)
+            and messages_key(history[: self.summarized_messages]) == self.summarized_key
+        ):
+            return self.summary, self.summarized_messages
+        return "", 0
+
+
+Conversation.model_rebuild()
+
+
+class ConversationStore:
+    """
+    Keeps the findings of every conversation in a bounded cache.
+    Conversations are identified by conversation_id, never by the analysed text alone, since several
+    chats may analyse the same text.
+    """
+
+    def __init__(self, cache: ResultCache):
+        self.cache = cache
+
+    def key(self, conversation_id: str) -> str:
+        return content_key("conversation", conversation_id)
+
+    def get(self, conversation_id: str) -> Conversation | None:
+        value = self.cache.get(self.key(conversation_id))
+        return Conversation.model_validate_json(value) if value is not None else None
+
+    def set(self, conversation_id: str, conversation: Conversation) -> None:
+        self.cache.set(self.key(conversation_id), conversation.model_dump_json())
+
+    async def aget(self, conversation_id: str) -> Conversation | None:
+        value = await self.cache.aget(self.key(conversation_id))
+        return Conversation.model_validate_json(value) if value is not None else None
+
+    async def aset(self, conversation_id: str, conversation: Conversation) -> None:
+        await self.cache.aset(self.key(conversation_id), conversation.model_dump_json())
+
+    def close(self) -> None:
+        self.cache.close()
+
+
+def message_text(message: dict) -> str:
+    """the text of a message, including the text parts of multimodal messages"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return content
+
+
+def conversation_id(body: dict, messages: list[dict], report: str | None = None) -> str | None:
+    """
+    identity of the chat of a request: the chat id sent by Open WebUI, otherwise a hash of the analysed
+    text and the report answering it (report while the first answer is not part of messages yet).
+    None if neither is known.
+    """
+    for metadata in (body, body.get("metadata") or {}, body.get("__metadata__") or {}):
+        if isinstance(metadata, dict) and metadata.get("chat_id"):
+            return f"chat:{metadata['chat_id']}"
+    if report is None and len(messages) > 1 and messages[1].get("role") == "assistant":
+        report = message_text(messages[1])
+    if not messages or report is None:
+        return None
+    return "messages:" + content_key(normalize_text(message_text(messages[0])), normalize_text(report))
+
+
+def messages_key(messages: list[dict]) -> str:
+    return content_key(*(f"{message['role']}: {normalize_text(message_text(message))}" for message in messages))
+
+
+def format_messages(messages: list[dict]) -> str:
+    roles = {"user": "Nutzer", "assistant": "Assistent"}
+    return "\n".join(f"{roles.get(message['role'], message['role'])}: {message_text(message)}" for message in messages)
+
+
+def build_follow_up_messages(conversation: Conversation, messages: list[dict], recent_messages: int = 6) -> list[dict]:
+    """
+    builds the messages of a follow-up: the text and its findings instead of the report,
+    the summary of older messages, the messages not summarized yet and the last recent_messages messages
+    """
+    # the first two messages are the analysed text and the report
+    history = messages[2:]
+    older = history[: max(len(history) - recent_messages, 0)]
+    summary, summarized_messages = conversation.summary_of(history)
+    findings = "\n".join(f"- {finding.strategy.value}: {finding.content}" for finding in conversation.findings)
+    context = get_prompt_templates()["follow_up"].render(
+        TEXT=conversation.text,
+        FINDINGS=findings or "Keine",
+        SUMMARY=summary or "-",
+    )
+    return [
+        {"role": "system", "content": FOLLOW_UP_SYSTEM_PROMPT},
+        {"role": "system", "content": context},
+        # messages that dropped out of the recent ones while their summary is still pending
+        *older[summarized_messages:],
+        *history[len(older) :],
+    ]
+
+
 class ExtractedStrategies(BaseModel):
     strategies: list[AppliedStrategy]
 
 
-def identify_strategies(
-    user_message: str, openai_client: AzureOpenAI
+ExtractedStrategies.model_rebuild()
+
+
+def identify_strategies_messages(
+    user_message: str,
+    strategy_examples: StrategyExampleProvider | None = None,
+    examples_per_category: int = 0,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+    similar_examples: int = 0,
+) -> list[dict]:
+    """the messages of the classification prompt, with the examples chosen by the settings"""
+    with span("render_prompt"):
+        templates = get_prompt_templates(strategy_examples)
+        if similar_examples > 0:
+            prompt = render_similar_examples_prompt(
+                templates,
+                user_message,
+                strategy_examples=strategy_examples,
+                examples_per_category=similar_examples,
+                token_budget=token_budget,
+                token_metrics=token_metrics,
+            )
+        else:
+            template = select_identify_template(
+                templates,
+                user_message,
+                examples_per_category=examples_per_category,
+                token_budget=token_budget,
+                token_metrics=token_metrics,
+            )
+            prompt = template.render(TEXT=user_message)
+
+    return [
+        {"role": "system", "content": IDENTIFY_STRATEGIES_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+async def identify_strategies(
+    user_message: str,
+    openai_client: AsyncAzureOpenAI,
+    strategy_examples: StrategyExampleProvider | None = None,
+    examples_per_category: int = 0,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+    similar_examples: int = 0,
 ) -> list[AppliedStrategy]:
     """identifies strategies from a user message"""
 
-    system_prompt = "Du bist ein sorgfältiger Desinformation-Experte, welcher aus Texten die verwendeten Strategien für Desinformation identifiziert."
+    messages = identify_strategies_messages(
+        user_message,
+        strategy_examples=strategy_examples,
+        examples_per_category=examples_per_category,
+        token_budget=token_budget,
+        token_metrics=token_metrics,
+        similar_examples=similar_examples,
+    )
 
-    prompt = """
-    Deine Aufgabe ist es, aus dem [TEXT] Strategien für Desinformationen zu identifizieren und zusammen mit den zugehörigen Textstellen zu extrahieren.
-    Beachte, dass die gleiche Strategie an mehreren Stellen im [TEXT] vorkommen kann.
-    Außerdem kann die gleiche Textstelle auch mehrere Strategien umfassen.
-    
-    Hier sind Beispiele für die verschiedenen Strategien des Desinformation:
-    $PLACEHOLDER_STRATEGY_EXAMPLES
+    client = structured_client(openai_client)
 
-    [TEXT]
-    $PLACEHOLDER_TEXT
+    # instructor retries on validation errors, every attempt counts as a call of the span
+    with span("extract_strategies"):
+        completion: ExtractedStrategies = await client.chat.completions.create(
+            model=deployment,
+            response_model=ExtractedStrategies,
+            messages=messages,
+            temperature=0
+        )
 
-    Verwendete Strategien des [TEXT]s mit zugehörigen Textstellen:
+    return [AppliedStrategy(**strategy.model_dump()) for strategy in completion.strategies]
+
+    # return AppliedStrategy.return_example_list()
+
+
+class StrategyStreamParser:
+    """
+    Collects the streamed arguments of the ExtractedStrategies tool call and returns every
+    strategy as soon as its JSON object is complete, long before the whole list is.
     """
-    prompt = prompt.replace("$PLACEHOLDER_TEXT", user_message)
-    prompt = prompt.replace("$PLACEHOLDER_STRATEGY_EXAMPLES", get_strategy_examples())
 
-    client = instructor.from_openai(openai_client)
+    def __init__(self):
+        self.arguments = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._start = -1
 
-    completion: ExtractedStrategies = client.chat.completions.create(
-        model=deployment,
-        response_model=ExtractedStrategies,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt},
+    def feed(self, delta: str) -> list[AppliedStrategy]:
+        self.arguments += delta
+        strategies = []
+        for i in range(self._position, len(self.arguments)):
+            char = self.arguments[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+                # the root object only has the strategies list, so every object one level below is a strategy
+                if self._depth == 2:
+                    self._start = i
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 1 and self._start >= 0:
+                    strategy = self._validate(self.arguments[self._start : i + 1])
+                    if strategy is not None:
+                        strategies.append(strategy)
+                    self._start = -1
+        self._position = len(self.arguments)
+        return strategies
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.arguments) and self._depth == 0 and not self._in_string
+
+    @staticmethod
+    def _validate(strategy_json: str) -> AppliedStrategy | None:
+        try:
+            return AppliedStrategy.model_validate_json(strategy_json)
+        except ValueError as e:
+            # the other strategies may already be explained, so an invalid one is skipped instead of retried
+            print(f"Skipping an invalid strategy of the streamed extraction: {e}")
+            return None
+
+
+async def iter_strategies(
+    user_message: str,
+    openai_client: AsyncAzureOpenAI,
+    strategy_examples: StrategyExampleProvider | None = None,
+    examples_per_category: int = 0,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+    similar_examples: int = 0,
+) -> AsyncIterator[AppliedStrategy]:
+    """
+    same as identify_strategies, but streams the tool call and yields every strategy as soon as the model
+    has written it. Falls back to identify_strategies if the model answers without the tool call.
+    """
+    messages = identify_strategies_messages(
+        user_message,
+        strategy_examples=strategy_examples,
+        examples_per_category=examples_per_category,
+        token_budget=token_budget,
+        token_metrics=token_metrics,
+        similar_examples=similar_examples,
+    )
+    schema = instructor.openai_schema(ExtractedStrategies).openai_schema
+
+    extract_span = start_span("extract_strategies", streamed=True)
+    with activate(extract_span):
+        stream = await openai_client.chat.completions.create(
+            model=deployment,
+            messages=messages,
+            tools=[{"type": "function", "function": schema}],
+            tool_choice={"type": "function", "function": {"name": schema["name"]}},
+            temperature=0,
+            stream=True,
+        )
+    parser = StrategyStreamParser()
+    async for chunk in stream:
+        tool_calls = getattr(chunk.choices[0].delta, "tool_calls", None) if chunk.choices else None
+        if not tool_calls or not tool_calls[0].function:
+            continue
+        for strategy in parser.feed(tool_calls[0].function.arguments or ""):
+            yield strategy
+    extract_span.end()
+
+    if not parser.arguments:
+        for strategy in await identify_strategies(
+            user_message,
+            openai_client=openai_client,
+            strategy_examples=strategy_examples,
+            examples_per_category=examples_per_category,
+            token_budget=token_budget,
+            token_metrics=token_metrics,
+            similar_examples=similar_examples,
+        ):
+            yield strategy
+    elif not parser.complete:
+        print("The streamed extraction of the strategies was cut off, the report may be incomplete")
+
+
+async def identify_strategies_chunked(
+    user_message: str,
+    openai_client: AsyncAzureOpenAI,
+    strategy_examples: StrategyExampleProvider | None = None,
+    chunk_size: int = 0,
+    chunk_overlap: int = 0,
+    max_concurrency: int = 1,
+    examples_per_category: int = 0,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+    similar_examples: int = 0,
+    passage_min_score: float = 0.6,
+    on_strategy: Callable[[AppliedStrategy], None] | None = None,
+) -> list[AppliedStrategy]:
+    """
+    identifies strategies from a long user message by splitting it into overlapping chunks,
+    extracting the strategies of all chunks in parallel and merging the results.
+    The passages of the strategies are located in the user message (see AppliedStrategy.location).
+    With on_strategy, a single chunk is extracted as a stream and on_strategy is called with every
+    strategy as soon as it is complete; for several chunks it is called once they are merged.
+    """
+    chunks = split_into_chunks(user_message, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    locator = PassageLocator(user_message, min_score=passage_min_score)
+    if len(chunks) == 1 and on_strategy is not None:
+        strategies = []
+        async for strategy in iter_strategies(
+            user_message,
+            openai_client=openai_client,
+            strategy_examples=strategy_examples,
+            examples_per_category=examples_per_category,
+            token_budget=token_budget,
+            token_metrics=token_metrics,
+            similar_examples=similar_examples,
+        ):
+            AppliedStrategy.locate([strategy], locator)
+            on_strategy(strategy)
+            strategies.append(strategy)
+        return strategies
+    if len(chunks) == 1:
+        strategies = await identify_strategies(
+            user_message,
+            openai_client=openai_client,
+            strategy_examples=strategy_examples,
+            examples_per_category=examples_per_category,
+            token_budget=token_budget,
+            token_metrics=token_metrics,
+            similar_examples=similar_examples,
+        )
+        AppliedStrategy.locate(strategies, locator)
+        return strategies
+
+    chunk_strategies = await gather_with_concurrency(
+        [
+            identify_strategies(
+                chunk,
+                openai_client=openai_client,
+                strategy_examples=strategy_examples,
+                examples_per_category=examples_per_category,
+                token_budget=token_budget,
+                token_metrics=token_metrics,
+                similar_examples=similar_examples,
+            )
+            for chunk in chunks
         ],
-        temperature=0
+        max_concurrency=max_concurrency,
     )
+    # a passage may still be replaced by a longer one of the next chunk, so nothing is started before the merge
+    strategies = [strategy for strategies in chunk_strategies for strategy in strategies]
+    AppliedStrategy.locate(strategies, locator)
+    strategies = merge_strategies(strategies)
+    if on_strategy is not None:
+        for strategy in strategies:
+            on_strategy(strategy)
+    return strategies
 
-    return [AppliedStrategy(**strategy.model_dump()) for strategy in completion.strategies]
 
-    # return AppliedStrategy.return_example_list()
+def split_into_chunks(text: str, chunk_size: int = 0, chunk_overlap: int = 0) -> list[str]:
+    """
+    splits a text into chunks of at most chunk_size characters, which overlap by about chunk_overlap characters.
+    Chunks preferably end at paragraphs, then at sentences, then at words. A chunk_size of 0 disables the splitting.
+    """
+    if chunk_size <= 0 or len(text) <= chunk_size:
+        return [text]
+    chunk_overlap = min(max(chunk_overlap, 0), chunk_size // 2)
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        if end >= len(text):
+            chunks.append(text[start:])
+            break
+
+        # only search the second half of the chunk for a boundary, so chunks don't get too small
+        lower = start + chunk_size // 2
+        for separator in ("\n\n", "\n", ". ", "! ", "? ", " "):
+            boundary = text.rfind(separator, lower, end)
+            if boundary != -1:
+                end = boundary + len(separator)
+                break
+        chunks.append(text[start:end])
+
+        # start the next chunk at a sentence or word boundary inside the overlap
+        next_start = end - chunk_overlap
+        if chunk_overlap:
+            for separator in ("\n", ". ", "! ", "? ", " "):
+                boundary = text.find(separator, next_start, end - 1)
+                if boundary != -1:
+                    next_start = boundary + len(separator)
+                    break
+        start = max(next_start, start + 1)
+    return chunks
+
+
+def passage_key(content: str) -> str:
+    """passages that only differ in whitespace and case are the same passage"""
+    return normalize_text(content).casefold()
+
+
+def is_same_passage(location: PassageSpan, other: PassageSpan, min_overlap: float = 0.5) -> bool:
+    """one passage contains the other, or they overlap by at least min_overlap of the shorter one"""
+    return location.overlap(other) >= min_overlap * min(len(location), len(other))
+
+
+def findings_by_paragraph(
+    text: str, strategies: list[AppliedStrategy], locator: PassageLocator
+) -> dict[str, list[AppliedStrategy]] | None:
+    """
+    copies of the findings of text by the paragraph_key of the paragraph their passage starts in.
+    None if a passage isn't found in text, its paragraph is unknown.
+    """
+    paragraphs = split_paragraphs(text)
+    starts = [paragraph.start for paragraph in paragraphs]
+    findings: dict[str, list[AppliedStrategy]] = {
+        paragraph_key(text[paragraph.start : paragraph.end]): [] for paragraph in paragraphs
+    }
+    for strategy, location in zip(strategies, locator.locate_all([strategy.content for strategy in strategies])):
+        if location is None or not paragraphs:
+            return None
+        paragraph = paragraphs[max(bisect.bisect_right(starts, location.start) - 1, 0)]
+        # the copy is located in the new version of the text
+        findings[paragraph_key(text[paragraph.start : paragraph.end])].append(
+            AppliedStrategy.from_stored(strategy.to_stored())
+        )
+    return findings
+
+
+def merge_strategies(strategies: list[AppliedStrategy]) -> list[AppliedStrategy]:
+    """
+    removes duplicates of the same strategy, e.g. from the overlap of two chunks.
+    Of two located passages with the same strategy that overlap mostly, the longer one is kept; passages
+    that weren't located are compared by their text, a passage contained in a longer one is dropped.
+    """
+    merged: list[AppliedStrategy] = []
+    for strategy in strategies:
+        content = passage_key(strategy.content)
+        for i, existing in enumerate(merged):
+            if existing.strategy != strategy.strategy:
+                continue
+            if strategy.location is not None and existing.location is not None:
+                if not is_same_passage(strategy.location, existing.location):
+                    continue
+                if len(strategy.location) > len(existing.location):
+                    merged[i] = strategy
+                break
+            existing_content = passage_key(existing.content)
+            if content in existing_content:
+                break
+            if existing_content in content:
+                merged[i] = strategy
+                break
+        else:
+            merged.append(strategy)
+    return merged
+
+
+def create_near_duplicate_index(
+    backend: str, threshold: float = 0.9, max_size: int = 2048, ttl: int = 0, url: str = ""
+) -> NearDuplicateIndex | None:
+    """the near duplicate index for the backend name "memory" or "sqlite", None for "none" """
+    backend = backend.lower().strip()
+    if backend in ("", "none"):
+        return None
+    if backend not in ("memory", "sqlite"):
+        print(f"Unknown near duplicate backend {backend}, the index is disabled.")
+        return None
+    return NearDuplicateIndex(
+        threshold=threshold,
+        max_size=max_size,
+        ttl=ttl or None,
+        path=(url or "./cache.sqlite3") if backend == "sqlite" else "",
+        table="desinfo_near_duplicates",
+    )
+
+
+def read_deployments() -> list[dict]:
+    """the deployments of AZURE_OPENAI_DEPLOYMENTS, or the single one of AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_DEPLOYMENT"""
+    deployments = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    if deployments:
+        return json.loads(deployments)
+    return [{"endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"), "deployment": deployment}]
+
+
+def create_routers(deployments: list[dict]) -> dict[str, DeploymentRouter]:
+    """a router for every tier of the deployments, deployments without a tier are in the "default" tier"""
+    tiers: dict[str, list[dict]] = {}
+    for config in deployments:
+        tiers.setdefault(config.get("tier", "default"), []).append(config)
+
+    return {
+        tier: DeploymentRouter(
+            [
+                Deployment(
+                    name=config.get("name") or f"{config['endpoint']}/{config['deployment']}",
+                    client=AsyncAzureOpenAI(
+                        # a single deployment keeps retrying itself, several fail over to each other quickly
+                        max_retries=config.get("max_retries", 5 if len(configs) == 1 else 1),
+                        api_key=config.get("api_key") or os.getenv("AZURE_OPENAI_API_KEY"),
+                        api_version=config.get("api_version") or os.getenv("OPENAI_API_VERSION"),
+                        azure_endpoint=config["endpoint"],
+                    ),
+                    model=config["deployment"],
+                )
+                for config in configs
+            ],
+            name=tier,
+            count_tokens=get_token_counter(TOKEN_ENCODING, TOKEN_ENCODING_DOWNLOAD),
+        )
+        for tier, configs in tiers.items()
+    }
+
+
+def structured_client(openai_client: AsyncAzureOpenAI | DeploymentRouter) -> instructor.AsyncInstructor:
+    """instructor client for structured outputs; the router is patched like an AsyncOpenAI client"""
+    if isinstance(openai_client, DeploymentRouter):
+        return instructor.AsyncInstructor(
+            client=openai_client,
+            create=instructor.patch(create=openai_client.create, mode=instructor.Mode.TOOLS),
+            mode=instructor.Mode.TOOLS,
+        )
+    return instructor.from_openai(openai_client)
 
 
 def is_first_message(messages: list[dict]) -> bool:
     return len(messages) == 1
 
 
+async def gather_with_concurrency(coroutines: list[Awaitable[T]], max_concurrency: int = 1) -> list[T]:
+    """awaits all coroutines with at most max_concurrency running at once, keeping their order"""
+    semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+    async def bounded(coroutine: Awaitable[T]) -> T:
+        async with semaphore:
+            return await coroutine
+
+    return list(await asyncio.gather(*[bounded(coroutine) for coroutine in coroutines]))
+
+
+async def iter_as_async(items: Iterable[T]) -> AsyncIterator[T]:
+    for item in items:
+        yield item
+
+
 def get_ampel(strategies: list[AppliedStrategy]) -> str:
     if len(strategies) == 0:
         return "Ampel grün"
@@ -273,8 +2287,47 @@ def get_ampel(strategies: list[AppliedStrategy]) -> str:
         return "Ampel rot"
 
 
-def get_strategy_examples() -> str:
-    df = pd.read_excel("./Beispiele.xlsx", sheet_name="Sheet1")
+AMPEL_EMOJIS = {"Ampel grün": "🟢", "Ampel gelb": "🟡", "Ampel rot": "🔴"}
+
+
+def is_report(content: str) -> bool:
+    return any(content.startswith(f"# {ampel}") for ampel in AMPEL_EMOJIS)
+
+
+def build_task_answer(task: str, prompt: str) -> str:
+    """
+    answers a task request without the model: the title and tags are taken from the ampel and the
+    most frequent strategies of the report in the chat history, autocompletion suggests nothing
+    """
+    history = get_chat_history(prompt)
+    ampel = next((ampel for ampel in AMPEL_EMOJIS if f"# {ampel}" in history), None)
+    counts = {
+        strategy: int(count)
+        for strategy in Strategy
+        for count in re.findall(rf"- {re.escape(strategy.value)} \((\d+)x\)", history)[:1]
+    }
+    top_strategies = [strategy.value for strategy in sorted(counts, key=counts.get, reverse=True)][:2]
+
+    if task == TITLE_GENERATION:
+        if ampel is None:
+            title = "🚦 Desinformation-Analyse"
+        else:
+            title = f"{AMPEL_EMOJIS[ampel]} {ampel}: {', '.join(top_strategies) or 'keine Strategien'}"
+        return json.dumps({"title": title}, ensure_ascii=False) if wants_json(prompt) else title
+    if task == TAGS_GENERATION:
+        tags = ["Desinformation", *([ampel] if ampel else []), *top_strategies]
+        return json.dumps({"tags": tags}, ensure_ascii=False)
+    if task == AUTOCOMPLETE_GENERATION:
+        return json.dumps({"text": ""})
+    if task == QUERY_GENERATION:
+        return json.dumps({"queries": []})
+    if task == EMOJI_GENERATION:
+        return AMPEL_EMOJIS.get(ampel, "🚦")
+    return ""
+
+
+def read_strategy_examples(path: str = "./Beispiele.xlsx") -> dict[Strategy, list[str]]:
+    df = pd.read_excel(path, sheet_name="Sheet1")
     df.sort_values(by="PLURV-Kategorie")
     strategy_description = {
         "P": Strategy.FAKE_EXPERTS,
@@ -284,17 +2337,251 @@ def get_strategy_examples() -> str:
         "V": Strategy.CONSPIRACY_THEORIES
     }
 
+    return {
+        strategy_description[strategy]: df[df["PLURV-Kategorie"] == strategy]["Aussage"].to_list()
+        for strategy in strategy_description.keys()
+    }
+
+
+def format_strategy_examples(
+    strategy_examples: dict[Strategy, list[str]], examples_per_category: int | None = None
+) -> str:
+    """renders the examples for the prompt, optionally only the first examples_per_category of each strategy"""
+
     def get_category_examples():
-        for strategy in strategy_description.keys():
+        for strategy, category_examples in strategy_examples.items():
             examples = "\n".join(
                 [
                     f"\tBeispiel {i}: {example}"
-                    for i, example in enumerate(
-                        df[df["PLURV-Kategorie"] == strategy]["Aussage"]
-                        .to_list()
-                    )
+                    for i, example in enumerate(category_examples[:examples_per_category])
                 ]
             )
-            yield f"Strategie: {strategy_description[strategy]}\n{examples}"
+            yield f"Strategie: {strategy}\n{examples}"
 
     return "---".join(get_category_examples())
+
+
+def get_strategy_examples(path: str = "./Beispiele.xlsx") -> str:
+    return format_strategy_examples(read_strategy_examples(path))
+
+
+class StrategyExampleProvider:
+    """
+    Caches the strategy examples of the workbook.
+    The workbook is only parsed again when its mtime changes or a reload is forced.
+    The mtime is checked at most every check_interval seconds.
+    """
+
+    def __init__(self, path: str = "./Beispiele.xlsx", check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime: int | None = None
+        self._checked = 0.0
+        self._examples: dict[Strategy, list[str]] | None = None
+        self._rendered: str | None = None
+        self._index: dict[Strategy, BM25Index] | None = None
+
+    def load(self, path: str | None = None, force: bool = False) -> str:
+        with self._lock:
+            if path is not None and path != self.path:
+                self.path = path
+                force = True
+            mtime = os.stat(self.path).st_mtime_ns
+            if force or self._examples is None or mtime != self._mtime:
+                with span("load_examples"):
+                    self._examples = read_strategy_examples(self.path)
+                    self._rendered = format_strategy_examples(self._examples)
+                self._index = None
+                self._mtime = mtime
+            self._checked = time.monotonic()
+            return self._rendered
+
+    def _is_current(self) -> bool:
+        # every prompt asks for the examples, the workbook is only stat'ed once per check_interval
+        if self._examples is None:
+            return False
+        if time.monotonic() - self._checked < self.check_interval:
+            return True
+        self._checked = time.monotonic()
+        return os.stat(self.path).st_mtime_ns == self._mtime
+
+    def get(self) -> str:
+        """all examples rendered for the prompt"""
+        if not self._is_current():
+            self.load()
+        return self._rendered
+
+    def examples(self) -> dict[Strategy, list[str]]:
+        """the examples of every strategy; the same object is returned until the workbook changes"""
+        if not self._is_current():
+            self.load()
+        return self._examples
+
+    def index(self) -> dict[Strategy, BM25Index]:
+        """a lexical index over the examples of every strategy, built once per workbook version"""
+        examples = self.examples()
+        with self._lock:
+            if self._index is None or self._examples is not examples:
+                with span("build_index"):
+                    self._index = {
+                        strategy: BM25Index(category_examples)
+                        for strategy, category_examples in examples.items()
+                    }
+            return self._index
+
+    def similar(self, text: str, examples_per_category: int) -> dict[Strategy, list[str]]:
+        """the examples of every strategy most similar to the text, best first"""
+        return {
+            strategy: [index.documents[document_id] for document_id in index.top_k(text, examples_per_category)]
+            for strategy, index in self.index().items()
+        }
+
+
+# the pruned prompt variants are precompiled for every number of examples per strategy up to this one,
+# above it only for every PRUNED_EXAMPLES_STEP examples
+MAX_PRUNED_EXAMPLES = 32
+PRUNED_EXAMPLES_STEP = 8
+
+# shared by the pipeline and all direct callers of identify_strategies
+strategy_example_provider = StrategyExampleProvider()
+
+
+def build_prompt_templates(strategy_examples: dict[Strategy, list[str]]) -> dict[str, PromptTemplate]:
+    """builds the static parts of all prompts, only the user text and the passages are left open"""
+    templates = {
+        "identify_strategies": PromptTemplate(
+            "identify_strategies",
+            IDENTIFY_STRATEGIES_PROMPT,
+            STRATEGY_EXAMPLES=format_strategy_examples(strategy_examples),
+        ),
+        # the examples are selected per request
+        "identify_strategies_similar": PromptTemplate("identify_strategies_similar", IDENTIFY_STRATEGIES_PROMPT),
+        "create_actions_batched": PromptTemplate("create_actions_batched", BATCHED_ACTION_PROMPT),
+        "create_actions_merged": PromptTemplate("create_actions_merged", MERGED_ACTION_PROMPT),
+        "follow_up": PromptTemplate("follow_up", FOLLOW_UP_CONTEXT_PROMPT),
+        "summarize_conversation": PromptTemplate("summarize_conversation", SUMMARIZE_CONVERSATION_PROMPT),
+    }
+    # variants with fewer examples per strategy, to stay below the token budget
+    max_examples = max((len(examples) for examples in strategy_examples.values()), default=0)
+    pruned = [
+        *range(1, min(max_examples, MAX_PRUNED_EXAMPLES + 1)),
+        *range(MAX_PRUNED_EXAMPLES + PRUNED_EXAMPLES_STEP, max_examples, PRUNED_EXAMPLES_STEP),
+    ]
+    for examples_per_category in pruned:
+        templates[f"identify_strategies/{examples_per_category}"] = PromptTemplate(
+            f"identify_strategies/{examples_per_category}",
+            IDENTIFY_STRATEGIES_PROMPT,
+            STRATEGY_EXAMPLES=format_strategy_examples(strategy_examples, examples_per_category),
+        )
+    if max_examples:
+        # the full prompt under the number of examples it really has, so that a limit below it is kept
+        templates[f"identify_strategies/{max_examples}"] = templates["identify_strategies"]
+    for strategy in Strategy:
+        templates[f"create_action/{strategy.name}"] = PromptTemplate(
+            f"create_action/{strategy.name}",
+            ACTION_PROMPT,
+            STRATEGY=strategy.value,
+            STRATEGY_DESCRIPTION=strategy.get_description(),
+        )
+    return templates
+
+
+prompt_registry = PromptRegistry(build_prompt_templates)
+
+
+def get_prompt_templates(
+    strategy_examples: StrategyExampleProvider | None = None,
+) -> dict[str, PromptTemplate]:
+    strategy_examples = strategy_examples or strategy_example_provider
+    return prompt_registry.templates(strategy_examples=strategy_examples.examples())
+
+
+def get_prompt_templates_version(strategy_examples: StrategyExampleProvider | None = None) -> str:
+    """identifies the current prompts, results of other versions must not be reused"""
+    get_prompt_templates(strategy_examples)
+    return prompt_registry.version
+
+
+@functools.lru_cache(maxsize=256)
+def count_template_tokens(template: PromptTemplate) -> int:
+    """tokens of the static part of a template, counted once per template"""
+    count_tokens = get_token_counter(TOKEN_ENCODING, TOKEN_ENCODING_DOWNLOAD)
+    return count_tokens(template.render(**{field: "" for field in template.fields}))
+
+
+def select_identify_template(
+    templates: dict[str, PromptTemplate],
+    user_message: str,
+    examples_per_category: int = 0,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+) -> PromptTemplate:
+    """
+    picks the classification prompt with the most examples per strategy (at most examples_per_category)
+    whose size including the user message stays below token_budget. 0 disables either limit.
+    """
+    full = templates["identify_strategies"]
+    variants = sorted(
+        (
+            (int(name.rsplit("/", 1)[1]), template)
+            for name, template in templates.items()
+            if name.startswith("identify_strategies/")
+        ),
+        key=lambda variant: variant[0],
+        reverse=True,
+    )
+    # the full prompt first, then fewer and fewer examples per strategy
+    candidates = variants or [(0, full)]
+    if examples_per_category > 0:
+        candidates = [
+            (count, template) for count, template in candidates if count <= examples_per_category
+        ] or candidates[-1:]
+    candidates = [template for _, template in candidates]
+
+    count_tokens = get_token_counter(TOKEN_ENCODING, TOKEN_ENCODING_DOWNLOAD)
+    message_tokens = count_tokens(IDENTIFY_STRATEGIES_SYSTEM_PROMPT + user_message)
+    chosen = candidates[-1]
+    for template in candidates:
+        if token_budget <= 0 or count_template_tokens(template) + message_tokens <= token_budget:
+            chosen = template
+            break
+
+    prompt_tokens = count_template_tokens(chosen) + message_tokens
+    if token_metrics is not None:
+        token_metrics.record(prompt_tokens, count_template_tokens(full) + message_tokens)
+    if chosen is not full:
+        logging.info(
+            f"{chosen.id}: {prompt_tokens} prompt tokens, "
+            f"{count_template_tokens(full) - count_template_tokens(chosen)} saved by pruning examples"
+        )
+    return chosen
+
+
+def render_similar_examples_prompt(
+    templates: dict[str, PromptTemplate],
+    user_message: str,
+    strategy_examples: StrategyExampleProvider | None = None,
+    examples_per_category: int = 3,
+    token_budget: int = 0,
+    token_metrics: TokenMetrics | None = None,
+) -> str:
+    """
+    renders the classification prompt with the examples of every strategy most similar to the user message.
+    the least similar examples are dropped while the prompt is above token_budget.
+    """
+    strategy_examples = strategy_examples or strategy_example_provider
+    count = get_token_counter(TOKEN_ENCODING, TOKEN_ENCODING_DOWNLOAD)
+    template = templates["identify_strategies_similar"]
+    selected = strategy_examples.similar(user_message, examples_per_category)
+
+    message_tokens = count(IDENTIFY_STRATEGIES_SYSTEM_PROMPT + user_message)
+    for examples_per_category in range(examples_per_category, 0, -1):
+        examples = format_strategy_examples(selected, examples_per_category)
+        prompt_tokens = count_template_tokens(template) + count(examples) + message_tokens
+        if token_budget <= 0 or prompt_tokens <= token_budget:
+            break
+
+    if token_metrics is not None:
+        token_metrics.record(prompt_tokens, count_template_tokens(templates["identify_strategies"]) + message_tokens)
+    return template.render(STRATEGY_EXAMPLES=examples, TEXT=user_message)
@@ -0,0 +1,143 @@
+import asyncio
+import importlib.util
+import json
+import os
+import sys
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# the pipeline reads its deployment from the environment when it is loaded, no request leaves the tests
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test")
+os.environ.setdefault("OPENAI_API_VERSION", "2024-06-01")
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "test-deployment")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "http://localhost")
+os.environ.setdefault("DESINFO_RESULT_LOG_PATH", "")
+
+from openai import AsyncAzureOpenAI  # noqa: E402
+from openai.types.chat import ChatCompletion  # noqa: E402
+
+
+def load_desinfo():
+    # pipelines are loaded by path like main.py does, they aren't a package
+    spec = importlib.util.spec_from_file_location("desinfo", ROOT / "pipelines" / "desinfo.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def desinfo():
+    return load_desinfo()
+
+
+def completion(content=None, tool_name=None, arguments=None, finish_reason="stop"):
+    message = {"role": "assistant", "content": content}
+    if tool_name is not None:
+        message["tool_calls"] = [
+            {"id": "call", "type": "function", "function": {"name": tool_name, "arguments": arguments}}
+        ]
+    return ChatCompletion.model_validate(
+        {
+            "id": "completion",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "test",
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+        }
+    )
+
+
+def chunk(content=None, finish_reason=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=None), finish_reason=finish_reason)],
+        usage=None,
+    )
+
+
+class FakeClient(AsyncAzureOpenAI):
+    """
+    Stands in for the AsyncAzureOpenAI client of the pipeline. Tool calls extract the phrases of findings
+    found in the [TEXT] of the prompt, other calls answer with answer (or answer(messages) if it is
+    callable) or stream its words. Tool calls of a response model in structured are answered with
+    the arguments structured[name](messages) returns.
+    """
+
+    def __init__(self, findings=None, answer="Antwort.", finish_reason="stop", delay=0.0, structured=None):
+        super().__init__(api_key="test", api_version="2024-06-01", azure_endpoint="http://localhost")
+        self.findings = findings or {}
+        self.structured = structured or {}
+        self.answer = answer
+        self.finish_reason = finish_reason
+        self.delay = delay
+        self.calls = []
+        # calls waiting for their answer, to check the concurrency
+        self.active = 0
+        self.max_active = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model=None, messages=None, stream=False, **kwargs):
+        self.calls.append({"messages": messages, "stream": stream, **kwargs})
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        tools = kwargs.get("tools")
+        if tools and tools[0]["function"]["name"] in self.structured:
+            name = tools[0]["function"]["name"]
+            return completion(tool_name=name, arguments=json.dumps(self.structured[name](messages)))
+        if tools:
+            text = messages[-1]["content"].split("Verwendete Strategien")[0].split("[TEXT]")[-1]
+            arguments = json.dumps(
+                {
+                    "strategies": [
+                        {"strategy": strategy, "content": phrase}
+                        for phrase, strategy in self.findings.items()
+                        if phrase in text
+                    ]
+                }
+            )
+            if stream:
+                return self.stream_tool_call(arguments)
+            return completion(tool_name=tools[0]["function"]["name"], arguments=arguments)
+        answer = self.answer(messages) if callable(self.answer) else self.answer
+        if stream:
+            words = [word + " " for word in answer.split(" ")]
+
+            async def stream_chunks():
+                for word in words[:-1]:
+                    yield chunk(word)
+                yield chunk(words[-1].rstrip(), finish_reason=self.finish_reason)
+
+            return stream_chunks()
+        return completion(answer, finish_reason=self.finish_reason)
+
+    async def stream_tool_call(self, arguments):
+        for start in range(0, len(arguments), 8):
+            tool_call = SimpleNamespace(function=SimpleNamespace(arguments=arguments[start : start + 8]))
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=None, tool_calls=[tool_call]), finish_reason=None)],
+                usage=None,
+            )
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def pipeline(desinfo, client):
+    pipeline = desinfo.Pipeline()
+    for router in pipeline.routers.values():
+        for deployment in router.deployments:
+            deployment.client = client
+    yield pipeline
+    pipeline._close_caches()
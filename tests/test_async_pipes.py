@@ -0,0 +1,77 @@
+import importlib
+
+import pytest
+
+PIPELINES = {
+    "streaming": '''
+import asyncio
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Streaming"
+
+    async def pipe(self, user_message, model_id, messages, body):
+        for word in ["Eine ", "Antwort ", "auf ", user_message]:
+            await asyncio.sleep(0)
+            yield word
+''',
+    "awaited": '''
+class Pipeline:
+    def __init__(self):
+        self.name = "Awaited"
+
+    async def pipe(self, user_message, model_id, messages, body):
+        return f"Eine Antwort auf {user_message}"
+
+    def stats(self):
+        return {"requests": 1}
+''',
+    "blocking": '''
+class Pipeline:
+    def __init__(self):
+        self.name = "Blocking"
+
+    def pipe(self, user_message, model_id, messages, body):
+        return f"Eine Antwort auf {user_message}"
+''',
+}
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    pipelines = tmp_path / "pipelines"
+    pipelines.mkdir()
+    for name, source in PIPELINES.items():
+        (pipelines / f"{name}.py").write_text(source)
+    monkeypatch.setenv("PIPELINES_DIR", str(pipelines))
+    monkeypatch.setenv("BATCHES_DIR", str(tmp_path / "batches"))
+    from fastapi.testclient import TestClient
+
+    import config
+    import main
+
+    importlib.reload(config)
+    main = importlib.reload(main)
+    # the lifespan loads the pipelines of PIPELINES_DIR
+    with TestClient(main.app) as client:
+        client.headers["Authorization"] = f"Bearer {main.API_KEY}"
+        yield client
+
+
+@pytest.mark.parametrize("model", PIPELINES)
+def test_pipes_answer_chat_completions(api, model):
+    body = {"model": model, "messages": [{"role": "user", "content": "Hallo"}]}
+
+    response = api.post("/v1/chat/completions", json={**body, "stream": False})
+    streamed = api.post("/v1/chat/completions", json={**body, "stream": True})
+
+    assert response.json()["choices"][0]["message"]["content"] == "Eine Antwort auf Hallo"
+    assert "Antwort" in streamed.text
+    assert streamed.text.rstrip().endswith("data: [DONE]")
+
+
+def test_pipeline_stats_are_served(api):
+    assert api.get("/v1/awaited/stats").json() == {"requests": 1}
+    assert api.get("/v1/blocking/stats").status_code == 404
+    assert api.get("/v1/awaited/stats", headers={"Authorization": "Bearer falsch"}).status_code == 401
@@ -0,0 +1,104 @@
+import asyncio
+import re
+
+import pytest
+
+from conftest import FakeClient
+
+PASSAGES = [
+    "Ein bekannter Physiker sagt",
+    "Die Regierung verschweigt die wahren Daten",
+    "Das Klima hat sich schon immer verändert",
+]
+TEXT = f"{PASSAGES[0]}, dass es keinen Klimawandel gibt. {PASSAGES[1]}. {PASSAGES[2]}."
+
+
+@pytest.fixture
+def strategies(desinfo):
+    strategy = list(desinfo.Strategy)
+    return [
+        desinfo.AppliedStrategy(strategy=strategy[0], content=PASSAGES[0]),
+        desinfo.AppliedStrategy(strategy=strategy[4], content=PASSAGES[1]),
+        desinfo.AppliedStrategy(strategy=strategy[1], content=PASSAGES[2]),
+    ]
+
+
+def explain_passages(messages):
+    """explains every numbered passage of the batched prompt with the passage itself"""
+    passages = re.findall(r"Textpassage (\d+): (.*)", messages[-1]["content"])
+    return {
+        "explanations": [
+            {"index": int(number), "explanation": f"Erklärung: {passage}"} for number, passage in passages
+        ]
+    }
+
+
+def fail(messages):
+    raise ValueError("batched call failed")
+
+
+def test_batched_explanations_use_a_single_call(desinfo, strategies):
+    client = FakeClient(structured={"PassageExplanations": explain_passages})
+
+    actions = asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client, batched=True))
+
+    assert actions == [f"Erklärung: {passage}" for passage in PASSAGES]
+    assert len(client.calls) == 1
+    assert client.calls[0]["messages"][-1]["content"].count(TEXT) == 1
+
+
+def test_batched_explanations_fall_back_to_one_call_per_passage(desinfo, strategies):
+    client = FakeClient(answer="Erklärung.", structured={"PassageExplanations": fail})
+
+    actions = asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client, batched=True))
+
+    assert actions == ["Erklärung."] * 3
+    # instructor may retry the failed call, every passage is then explained on its own
+    assert [call.get("tools") is None for call in client.calls[-3:]] == [True] * 3
+    assert client.calls[0].get("tools")
+
+
+def test_batched_explanations_raise_without_fallback(desinfo, strategies):
+    client = FakeClient(structured={"PassageExplanations": fail})
+
+    with pytest.raises(ValueError):
+        asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client, batched=True, batch_fallback=False))
+
+
+def explain_strategies(messages):
+    """explains every strategy listed in the merged prompt with its name"""
+    listed = re.search(r"potenziellen Strategien (.+?) identifiziert wurden", messages[-1]["content"]).group(1)
+    return {
+        "explanations": [
+            {"strategy": strategy.strip(), "explanation": f"Erklärung: {strategy.strip()}"}
+            for strategy in listed.split(",")
+        ]
+    }
+
+
+def test_strategies_of_the_same_passage_are_grouped(desinfo):
+    strategy = list(desinfo.Strategy)
+    strategies = [
+        desinfo.AppliedStrategy(strategy=strategy[0], content=PASSAGES[0]),
+        desinfo.AppliedStrategy(strategy=strategy[1], content=PASSAGES[1]),
+        desinfo.AppliedStrategy(strategy=strategy[2], content=PASSAGES[0].upper()),
+    ]
+
+    groups = desinfo.AppliedStrategy.group_by_passage(strategies)
+
+    assert groups == [[strategies[0], strategies[2]], [strategies[1]]]
+
+
+def test_strategies_of_the_same_passage_are_explained_with_one_call(desinfo):
+    strategy = list(desinfo.Strategy)
+    strategies = [
+        desinfo.AppliedStrategy(strategy=strategy[0], content=PASSAGES[0]),
+        desinfo.AppliedStrategy(strategy=strategy[1], content=PASSAGES[1]),
+        desinfo.AppliedStrategy(strategy=strategy[2], content=PASSAGES[0]),
+    ]
+    client = FakeClient(answer="Erklärung.", structured={"StrategyExplanations": explain_strategies})
+
+    actions = asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client))
+
+    assert actions == [f"Erklärung: {strategy[0].value}", "Erklärung.", f"Erklärung: {strategy[2].value}"]
+    assert len(client.calls) == 2
@@ -0,0 +1,196 @@
+import asyncio
+import json
+
+import pytest
+
+from utils.pipelines.batches import BatchRunner, BatchStore, InteractiveTraffic, parse_completion_window
+
+ENDPOINT = "/v1/chat/completions"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BatchStore(str(tmp_path))
+
+
+def request_line(custom_id, url=ENDPOINT):
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": url, "body": {"model": "desinfo"}})
+
+
+def create_batch(store, lines):
+    file = store.create_file("input.jsonl", "batch", "\n".join(lines).encode("utf-8"))
+    return store.create_batch(file["id"], ENDPOINT, "24h")
+
+
+def read_output(store, file_id):
+    with open(store.content_path(file_id), encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+class Handler:
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.calls = []
+
+    async def __call__(self, url, body):
+        self.calls.append(body)
+        if len(self.calls) in self.failing:
+            return 400, {"error": {"message": "invalid"}}
+        return 200, {"choices": [{"message": {"content": "Bericht"}}]}
+
+
+def run(store, handler, concurrency=2):
+    """runs the batches of the store like the server does after a start"""
+
+    async def main():
+        runner = BatchRunner(store, handler, concurrency=concurrency)
+        runner.start()
+        await asyncio.gather(*runner._tasks.values())
+
+    asyncio.run(main())
+
+
+def test_parse_completion_window():
+    assert parse_completion_window("24h") == 86400
+    with pytest.raises(ValueError):
+        parse_completion_window("soon")
+
+
+def test_batch_is_completed_with_output_and_error_files(store):
+    batch = create_batch(store, [request_line("1"), request_line("2"), request_line("3")])
+    handler = Handler(failing={2})
+
+    run(store, handler, concurrency=1)
+
+    batch = store.get_batch(batch["id"])
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 3, "completed": 2, "failed": 1}
+    assert [result["custom_id"] for result in read_output(store, batch["output_file_id"])] == ["1", "3"]
+    assert [result["custom_id"] for result in read_output(store, batch["error_file_id"])] == ["2"]
+
+
+@pytest.mark.parametrize(
+    "lines, code",
+    [
+        ([request_line("1"), "{"], "invalid_json_line"),
+        ([request_line("1", url="/v1/embeddings")], "mismatched_endpoint"),
+        ([request_line("1"), request_line("1")], "duplicate_custom_id"),
+    ],
+)
+def test_invalid_input_fails_the_batch(store, lines, code):
+    batch = create_batch(store, lines)
+    handler = Handler()
+
+    run(store, handler)
+
+    batch = store.get_batch(batch["id"])
+    assert batch["status"] == "failed"
+    assert batch["errors"]["data"][0]["code"] == code
+    assert handler.calls == []
+
+
+def test_cancelled_batch_runs_no_requests(store):
+    batch = create_batch(store, [request_line("1")])
+    BatchRunner(store, Handler()).cancel(batch["id"])
+    handler = Handler()
+
+    run(store, handler)
+
+    assert store.get_batch(batch["id"])["status"] == "cancelled"
+    assert handler.calls == []
+
+
+def test_running_batch_is_cancelled_without_reading_its_file(store, monkeypatch):
+    batch = create_batch(store, [request_line(str(i)) for i in range(6)])
+    handler = Handler()
+    reads = []
+    get_batch = store.get_batch
+    monkeypatch.setattr(store, "get_batch", lambda batch_id: reads.append(batch_id) or get_batch(batch_id))
+
+    async def main():
+        runner = BatchRunner(store, None, concurrency=1)
+
+        async def handle(url, body):
+            if len(handler.calls) == 1:
+                runner.cancel(batch["id"])
+            return await handler(url, body)
+
+        runner.handler = handle
+        runner.start()
+        await asyncio.gather(*runner._tasks.values())
+
+    asyncio.run(main())
+
+    assert len(handler.calls) == 2
+    assert get_batch(batch["id"])["status"] == "cancelled"
+    # read when the batch started and by the cancel, not for every line
+    assert len(reads) == 2
+
+
+def test_resumed_batch_skips_the_answered_lines(store):
+    batch = create_batch(store, [request_line("1"), request_line("2"), request_line("3")])
+    batch["status"] = "in_progress"
+    store.save_batch(batch)
+    answer = {"status_code": 200, "request_id": "batch_req_1", "body": {}}
+    store.append_result(batch["id"], {"id": "batch_req_1", "custom_id": "1", "response": answer, "error": None}, False)
+    store.append_result(batch["id"], {"id": "batch_req_2", "custom_id": "2", "response": None, "error": {}}, True)
+    # the line being written when the server stopped
+    with open(store.results_path(batch["id"]), "a") as file:
+        file.write('{"failed": false, "res')
+    handler = Handler()
+
+    run(store, handler)
+
+    assert len(handler.calls) == 1
+    batch = store.get_batch(batch["id"])
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 3, "completed": 2, "failed": 1}
+    assert sorted(result["custom_id"] for result in read_output(store, batch["output_file_id"])) == ["1", "3"]
+    assert store.read_results(batch["id"]) == ([], [])
+
+
+def test_stopped_batch_continues_where_it_stopped(store):
+    batch = create_batch(store, [request_line(str(i)) for i in range(6)])
+    handler = Handler()
+
+    async def first_run():
+        release = asyncio.Event()
+
+        async def handle(url, body):
+            await handler(url, body)
+            if len(handler.calls) == 3:
+                # the server stops while the third line is in flight
+                await release.wait()
+            return 200, {}
+
+        runner = BatchRunner(store, handle, concurrency=1)
+        runner.start()
+        while len(handler.calls) < 3:
+            await asyncio.sleep(0)
+        await runner.stop()
+
+    asyncio.run(first_run())
+    assert store.get_batch(batch["id"])["status"] == "in_progress"
+
+    run(store, handler)
+
+    # only the line in flight is sent twice
+    assert len(handler.calls) == 7
+    batch = store.get_batch(batch["id"])
+    assert batch["request_counts"] == {"total": 6, "completed": 6, "failed": 0}
+    assert sorted(result["custom_id"] for result in read_output(store, batch["output_file_id"])) == [
+        str(i) for i in range(6)
+    ]
+
+
+def test_interactive_traffic_delays_background_work():
+    traffic = InteractiveTraffic(threshold=1, max_delay=0.05)
+
+    async def main():
+        with traffic.track():
+            waiting = asyncio.ensure_future(traffic.wait_for_capacity())
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+        await asyncio.wait_for(waiting, timeout=1)
+
+    asyncio.run(main())
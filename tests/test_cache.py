@@ -0,0 +1,152 @@
+import asyncio
+import sys
+import threading
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from utils.pipelines.cache import (
+    MemoryCache,
+    RedisCache,
+    SQLiteCache,
+    content_key,
+    create_cache,
+    normalize_text,
+)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}
+        self.threads = set()
+
+    @classmethod
+    def from_url(cls, url, decode_responses=False):
+        return cls()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.threads.add(threading.get_ident())
+        self.values[key] = value
+        self.expiry[key] = ex
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sqlite_cache(tmp_path):
+    cache = SQLiteCache(path=str(tmp_path / "cache.sqlite3"), max_size=2, table="results")
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def redis_cache(monkeypatch):
+    monkeypatch.setitem(sys.modules, "redis", SimpleNamespace(Redis=FakeRedis))
+    return RedisCache(ttl=60, prefix="results:")
+
+
+def test_normalized_texts_share_a_key():
+    assert normalize_text(" Ein Text \n mit  Leerzeichen ") == "Ein Text mit Leerzeichen"
+    assert content_key("ab", "c") != content_key("a", "bc")
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_least_recently_used_entry_is_evicted(backend, tmp_path):
+    cache = create_cache(backend, max_size=2, url=str(tmp_path / "cache.sqlite3"))
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1"
+    # sqlite orders by the access time, which has to differ
+    time.sleep(0.01)
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert (cache.hits, cache.misses) == (3, 1)
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_expired_entries_are_misses(backend, tmp_path):
+    cache = create_cache(backend, ttl=60, url=str(tmp_path / "cache.sqlite3"))
+    cache.set("a", "1")
+    cache.ttl = -1
+
+    assert cache.get("a") is None
+    cache.close()
+
+
+def test_sqlite_cache_survives_a_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = SQLiteCache(path=path, table="results")
+    cache.set("a", "1")
+    cache.close()
+
+    cache = SQLiteCache(path=path, table="results")
+    assert cache.get("a") == "1"
+    # namespaces are separate tables of the same database
+    assert SQLiteCache(path=path, table="explanations").get("a") is None
+    cache.close()
+
+
+def test_redis_cache_prefixes_keys_and_sets_the_ttl(redis_cache):
+    redis_cache.set("a", "1")
+
+    assert redis_cache.get("a") == "1"
+    assert redis_cache._client.expiry == {"results:a": 60}
+
+
+def test_memory_cache_is_used_on_the_event_loop():
+    cache = MemoryCache()
+
+    async def run():
+        await cache.aset("a", "1")
+        return await cache.aget("a")
+
+    assert cache.blocking is False
+    assert asyncio.run(run()) == "1"
+
+
+def test_blocking_backends_run_in_a_worker_thread(sqlite_cache, redis_cache):
+    async def run(cache):
+        await cache.aset("a", "1")
+        return await cache.aget("a"), threading.get_ident()
+
+    value, _ = asyncio.run(run(sqlite_cache))
+    assert value == "1" and sqlite_cache.blocking
+
+    value, loop_thread = asyncio.run(run(redis_cache))
+    assert value == "1"
+    assert loop_thread not in redis_cache._client.threads
+
+
+def test_create_cache_backends(tmp_path):
+    assert create_cache("none") is None
+    assert create_cache("") is None
+    assert create_cache("unknown") is None
+    assert isinstance(create_cache(" Memory "), MemoryCache)
+
+
+def test_resubmitted_text_is_answered_from_the_report_cache(pipeline, client):
+    client.findings = {"Ein bekannter Physiker sagt": "Pseudo-Experten"}
+    text = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+
+    async def run(message):
+        messages = [{"role": "user", "content": message}]
+        return "".join([piece async for piece in pipeline.pipe(message, "desinfo", messages, {"stream": True})])
+
+    report = asyncio.run(run(text))
+    calls = len(client.calls)
+    # only whitespace differs
+    assert asyncio.run(run(f"  {text.replace(' ', '   ')}\n")) == report
+    assert len(client.calls) == calls
+    assert pipeline.cache_stats()["results"]["hits"] == 1
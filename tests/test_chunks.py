@@ -0,0 +1,75 @@
+import asyncio
+
+from conftest import FakeClient
+from utils.pipelines.passages import PassageLocator
+
+SENTENCES = [f"Satz {i} über das Wetter in der Stadt." for i in range(40)]
+TEXT = " ".join(SENTENCES)
+
+
+def test_short_texts_are_not_split(desinfo):
+    assert desinfo.split_into_chunks(TEXT) == [TEXT]
+    assert desinfo.split_into_chunks(TEXT, chunk_size=len(TEXT)) == [TEXT]
+
+
+def test_chunks_cover_the_text_and_end_at_sentences(desinfo):
+    chunks = desinfo.split_into_chunks(TEXT, chunk_size=300, chunk_overlap=0)
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == TEXT
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    assert all(chunk.endswith(". ") for chunk in chunks[:-1])
+
+
+def test_chunks_overlap(desinfo):
+    chunks = desinfo.split_into_chunks(TEXT, chunk_size=300, chunk_overlap=80)
+
+    for chunk, following in zip(chunks, chunks[1:]):
+        # the next chunk starts with a sentence of the end of the previous one
+        assert following.split(".")[0] in chunk[-80:]
+
+
+def test_merge_strategies_keeps_the_longer_passage(desinfo):
+    strategy = list(desinfo.Strategy)
+    strategies = [
+        desinfo.AppliedStrategy(strategy=strategy[0], content="Ein bekannter Physiker"),
+        desinfo.AppliedStrategy(strategy=strategy[0], content="ein  bekannter Physiker sagt"),
+        desinfo.AppliedStrategy(strategy=strategy[1], content="Ein bekannter Physiker"),
+    ]
+
+    merged = desinfo.merge_strategies(strategies)
+
+    assert [(s.strategy, s.content) for s in merged] == [
+        (strategy[0], "ein  bekannter Physiker sagt"),
+        (strategy[1], "Ein bekannter Physiker"),
+    ]
+
+
+def test_merge_strategies_compares_located_passages(desinfo):
+    text = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt. Ein bekannter Physiker lacht."
+    strategy = list(desinfo.Strategy)
+    strategies = [
+        desinfo.AppliedStrategy(strategy=strategy[0], content="Ein bekannter Physiker sagt"),
+        desinfo.AppliedStrategy(strategy=strategy[0], content="Ein bekannter Physiker lacht"),
+    ]
+    desinfo.AppliedStrategy.locate(strategies, PassageLocator(text))
+
+    # the same words at two places of the text are two passages
+    assert len(desinfo.merge_strategies(strategies)) == 2
+
+
+def test_findings_in_the_overlap_are_reported_once(desinfo):
+    passage = "Die Regierung verschweigt die wahren Daten."
+    sentences = SENTENCES[:6] + [passage] + SENTENCES[6:12]
+    text = " ".join(sentences)
+    client = FakeClient(findings={passage: list(desinfo.Strategy)[4].value})
+
+    strategies = asyncio.run(
+        desinfo.identify_strategies_chunked(text, openai_client=client, chunk_size=300, chunk_overlap=120)
+    )
+
+    # both chunks around the passage contain it
+    assert len(client.calls) > 1
+    assert sum(passage in call["messages"][-1]["content"] for call in client.calls) == 2
+    assert [strategy.content for strategy in strategies] == [passage]
+    assert text[strategies[0].location.start : strategies[0].location.end] == passage
@@ -0,0 +1,184 @@
+import asyncio
+
+TEXT = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+PASSAGE = "Ein bekannter Physiker sagt"
+
+
+def collect(pipeline, messages, body=None):
+    async def run():
+        pieces = [piece async for piece in pipeline.pipe(messages[-1]["content"], "desinfo", messages, body or {"stream": True})]
+        # the summaries are updated after the answer was sent
+        await asyncio.gather(*pipeline._summary_tasks)
+        return "".join(pieces)
+
+    return asyncio.run(run())
+
+
+def test_conversation_id_prefers_chat_id(desinfo):
+    messages = [{"role": "user", "content": TEXT}, {"role": "assistant", "content": "Bericht"}]
+
+    assert desinfo.conversation_id({"chat_id": "a"}, messages) == "chat:a"
+    assert desinfo.conversation_id({"metadata": {"chat_id": "b"}}, messages) == "chat:b"
+    assert desinfo.conversation_id({"__metadata__": {"chat_id": "c"}}, messages) == "chat:c"
+
+
+def test_conversation_id_falls_back_to_text_and_report(desinfo):
+    first = [{"role": "user", "content": TEXT}]
+    answered = first + [{"role": "assistant", "content": "Bericht"}]
+
+    assert desinfo.conversation_id({}, first) is None
+    assert desinfo.conversation_id({}, first, report="Bericht") == desinfo.conversation_id({}, answered)
+    assert desinfo.conversation_id({}, answered) != desinfo.conversation_id(
+        {}, [first[0], {"role": "assistant", "content": "Anderer Bericht"}]
+    )
+
+
+def test_chats_with_the_same_text_keep_separate_conversations(desinfo, pipeline):
+    pipeline.conversations.set("chat:a", desinfo.Conversation(text=TEXT, findings=[]))
+    pipeline.conversations.set("chat:b", desinfo.Conversation(text=TEXT, findings=[]))
+    conversation = pipeline.conversations.get("chat:a")
+    conversation.summary = "Zusammenfassung von A"
+    conversation.summarized_messages = 2
+    pipeline.conversations.set("chat:a", conversation)
+
+    assert pipeline.conversations.get("chat:b").summary == ""
+
+
+def test_summary_is_only_used_for_the_messages_it_summarizes(desinfo):
+    history = [
+        {"role": "user", "content": "Frage von A"},
+        {"role": "assistant", "content": "Antwort an A"},
+    ]
+    conversation = desinfo.Conversation(
+        text=TEXT,
+        findings=[],
+        summary="Zusammenfassung von A",
+        summarized_messages=2,
+        summarized_key=desinfo.messages_key(history),
+    )
+    other = [
+        {"role": "user", "content": "Frage von B"},
+        {"role": "assistant", "content": "Antwort an B"},
+    ]
+
+    assert conversation.summary_of(history + other) == ("Zusammenfassung von A", 2)
+    assert conversation.summary_of(other + history) == ("", 0)
+
+    messages = [{"role": "user", "content": TEXT}, {"role": "assistant", "content": "Bericht"}, *other, *other]
+    follow_up = desinfo.build_follow_up_messages(conversation, messages, recent_messages=2)
+    assert "Zusammenfassung von A" not in follow_up[1]["content"]
+    # the older messages of B are sent verbatim instead of being dropped
+    assert follow_up[2:4] == other
+
+
+def test_follow_up_after_a_cached_report_sends_the_stored_findings(desinfo, pipeline, client):
+    client.findings = {PASSAGE: list(desinfo.Strategy)[0].value}
+    report = collect(pipeline, [{"role": "user", "content": TEXT}], {"stream": True, "chat_id": "a"})
+    # another chat submitting the same text is answered from the report cache
+    assert collect(pipeline, [{"role": "user", "content": TEXT}], {"stream": True, "chat_id": "b"}) == report
+    assert pipeline.cache_stats()["results"]["hits"] == 1
+
+    messages = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": report},
+        {"role": "user", "content": "Warum?"},
+    ]
+    client.calls.clear()
+    collect(pipeline, messages, {"stream": True, "chat_id": "b"})
+
+    sent = client.calls[0]["messages"]
+    assert PASSAGE in sent[1]["content"]
+    assert all(report not in message["content"] for message in sent)
+    assert sent[2:] == messages[2:]
+
+
+def test_follow_up_uses_the_conversation_of_its_chat(pipeline, client):
+    report = collect(pipeline, [{"role": "user", "content": TEXT}], {"stream": True, "chat_id": "a"})
+    assert pipeline.conversations.get("chat:a").text == TEXT
+    assert pipeline.conversations.get("chat:b") is None
+
+    messages = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": report},
+        {"role": "user", "content": "Warum?"},
+    ]
+    client.calls.clear()
+    collect(pipeline, messages, {"stream": True, "chat_id": "b"})
+    # chat b has no stored findings, so the whole history is sent
+    assert client.calls[0]["messages"] == messages
+
+
+def test_conversation_without_chat_id_is_stored_under_text_and_report(desinfo, pipeline):
+    report = collect(pipeline, [{"role": "user", "content": TEXT}])
+    messages = [{"role": "user", "content": TEXT}, {"role": "assistant", "content": report}]
+
+    assert pipeline.conversations.get(desinfo.conversation_id({}, messages)).text == TEXT
+
+
+def test_follow_up_sends_the_findings_instead_of_the_report(desinfo, pipeline, client):
+    client.findings = {PASSAGE: list(desinfo.Strategy)[0].value}
+    report = collect(pipeline, [{"role": "user", "content": TEXT}])
+    messages = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": report},
+        {"role": "user", "content": "Warum?"},
+    ]
+    client.calls.clear()
+
+    assert collect(pipeline, messages) == "Antwort."
+
+    sent = client.calls[0]["messages"]
+    assert sent[0]["role"] == "system"
+    assert TEXT in sent[1]["content"] and PASSAGE in sent[1]["content"]
+    assert all(report not in message["content"] for message in sent)
+    assert sent[2:] == messages[2:]
+    assert client.calls[0]["stream"]
+
+
+def test_unknown_conversation_sends_the_whole_history(pipeline, client):
+    messages = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": "Bericht"},
+        {"role": "user", "content": "Warum?"},
+    ]
+
+    collect(pipeline, messages)
+
+    assert client.calls[0]["messages"] == messages
+
+
+def test_older_messages_are_replaced_by_the_summary(desinfo):
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Nachricht {i}"} for i in range(6)]
+    conversation = desinfo.Conversation(
+        text=TEXT,
+        findings=[],
+        summary="Zusammenfassung",
+        summarized_messages=2,
+        summarized_key=desinfo.messages_key(history[:2]),
+    )
+    messages = [{"role": "user", "content": TEXT}, {"role": "assistant", "content": "Bericht"}, *history]
+
+    follow_up = desinfo.build_follow_up_messages(conversation, messages, recent_messages=2)
+
+    assert "Zusammenfassung" in follow_up[1]["content"]
+    assert "Keine" in follow_up[1]["content"]
+    # the messages not summarized yet are sent verbatim
+    assert follow_up[2:] == history[2:]
+
+
+def test_messages_dropping_out_of_the_recent_ones_are_summarized(pipeline, client):
+    pipeline.valves.FOLLOW_UP_RECENT_MESSAGES = 1
+    report = collect(pipeline, [{"role": "user", "content": TEXT}], {"stream": True, "chat_id": "a"})
+    messages = [
+        {"role": "user", "content": TEXT},
+        {"role": "assistant", "content": report},
+        {"role": "user", "content": "Warum?"},
+    ]
+    client.calls.clear()
+
+    collect(pipeline, messages, {"stream": True, "chat_id": "a"})
+
+    # the question dropped out of the recent messages once the answer was added
+    assert "Nutzer: Warum?" in client.calls[-1]["messages"][0]["content"]
+    conversation = pipeline.conversations.get("chat:a")
+    assert (conversation.summary, conversation.summarized_messages) == ("Antwort.", 1)
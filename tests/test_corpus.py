@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from utils.pipelines.corpus import Checkpoint, JsonlWriter, read_rows, run
+
+TEXT = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+
+
+class FakePipeline:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.texts = []
+
+    async def analyze(self, text, report=True):
+        self.texts.append(text)
+        if text in self.fail:
+            raise RuntimeError("analysis failed")
+        return {"ampel": "green", "length": len(text)}
+
+
+def run_corpus(pipeline, path, tmp_path, **kwargs):
+    writer = JsonlWriter(str(tmp_path / "results.jsonl"))
+    checkpoint = Checkpoint(str(tmp_path / "results.jsonl.checkpoint"))
+    try:
+        return asyncio.run(
+            run(pipeline, read_rows(str(path), id_column="id"), writer, checkpoint, str(tmp_path / "errors.jsonl"), **kwargs)
+        )
+    finally:
+        writer.close()
+        checkpoint.close()
+
+
+def results(tmp_path):
+    with open(tmp_path / "results.jsonl", encoding="utf-8") as file:
+        return {record["id"]: record for record in map(json.loads, file)}
+
+
+def test_rows_are_read_from_csv_and_jsonl(tmp_path):
+    csv_path = tmp_path / "posts.csv"
+    csv_path.write_text('text,source\n"a, b",x\nc,y\n', encoding="utf-8")
+    jsonl_path = tmp_path / "posts.jsonl"
+    jsonl_path.write_text('{"id": 7, "text": "a"}\n\n{"id": 8, "text": null}\n', encoding="utf-8")
+
+    assert [(row_id, text) for row_id, text, _ in read_rows(str(csv_path))] == [("0", "a, b"), ("1", "c")]
+    assert [(row_id, text) for row_id, text, _ in read_rows(str(jsonl_path), id_column="id")] == [("7", "a"), ("8", "")]
+
+
+def test_failed_rows_are_analysed_again_when_resumed(tmp_path):
+    path = tmp_path / "posts.jsonl"
+    path.write_text("".join(json.dumps({"id": i, "text": f"Text {i}", "source": "s"}) + "\n" for i in range(6)))
+
+    progress = run_corpus(FakePipeline(fail={"Text 3"}), path, tmp_path, concurrency=3, keep_columns=["source"])
+
+    assert progress.errors == 1
+    assert set(results(tmp_path)) == {"0", "1", "2", "4", "5"}
+    assert results(tmp_path)["0"]["source"] == "s"
+    assert json.loads((tmp_path / "errors.jsonl").read_text())["id"] == "3"
+
+    pipeline = FakePipeline()
+    progress = run_corpus(pipeline, path, tmp_path, concurrency=3)
+
+    assert pipeline.texts == ["Text 3"]
+    assert progress.skipped == 5
+    assert set(results(tmp_path)) == {str(i) for i in range(6)}
+
+
+def test_pipeline_analyses_a_single_text(desinfo, pipeline, client):
+    strategy = list(desinfo.Strategy)[0]
+    client.findings = {"Ein bekannter Physiker sagt": strategy.value}
+
+    result = asyncio.run(pipeline.analyze(TEXT, report=False))
+
+    assert result["findings"] == [
+        {"strategy": strategy.name, "content": "Ein bekannter Physiker sagt", "start": 0, "end": 27}
+    ]
+    assert result["triaged"] is False
+    assert "report" not in result
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    path = tmp_path / "Beispiele.xlsx"
+    path.write_bytes(b"")
+    return path
+
+
+@pytest.fixture
+def reads(desinfo, monkeypatch):
+    reads = []
+
+    def read_strategy_examples(path):
+        reads.append(path)
+        return {strategy: [f"Beispiel {len(reads)}"] for strategy in desinfo.Strategy}
+
+    monkeypatch.setattr(desinfo, "read_strategy_examples", read_strategy_examples)
+    return reads
+
+
+def test_workbook_is_parsed_once(desinfo, workbook, reads):
+    provider = desinfo.StrategyExampleProvider(str(workbook))
+
+    examples = provider.examples()
+    assert provider.examples() is examples
+    assert "Beispiel 1" in provider.get()
+    assert len(reads) == 1
+
+
+def test_changed_workbook_is_parsed_again(desinfo, workbook, reads):
+    provider = desinfo.StrategyExampleProvider(str(workbook), check_interval=0)
+    provider.examples()
+
+    stat = os.stat(workbook)
+    os.utime(workbook, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    assert "Beispiel 2" in provider.get()
+    assert len(reads) == 2
+
+
+def test_workbook_is_checked_once_per_interval(desinfo, workbook, reads, monkeypatch):
+    provider = desinfo.StrategyExampleProvider(str(workbook), check_interval=60)
+    provider.examples()
+    stats = []
+    stat = os.stat
+    monkeypatch.setattr(desinfo.os, "stat", lambda path: stats.append(path) or stat(path))
+
+    for _ in range(3):
+        provider.examples()
+
+    assert stats == []
+    assert len(reads) == 1
+
+
+def test_reload_can_be_forced(desinfo, workbook, reads):
+    provider = desinfo.StrategyExampleProvider(str(workbook))
+    provider.load()
+    provider.load(force=True)
+
+    assert len(reads) == 2
+
+
+def test_examples_are_read_from_the_workbook(desinfo):
+    examples = desinfo.read_strategy_examples(os.path.join(os.path.dirname(__file__), "..", "Beispiele.xlsx"))
+
+    assert set(examples) <= set(desinfo.Strategy)
+    assert all(isinstance(example, str) for category in examples.values() for example in category)
@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeClient
+from utils.pipelines.cache import MemoryCache
+
+TEXT = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+
+
+@pytest.fixture
+def finding(desinfo):
+    return desinfo.AppliedStrategy(strategy=list(desinfo.Strategy)[0], content="Ein bekannter Physiker sagt")
+
+
+@pytest.fixture
+def explanation_cache(desinfo):
+    return desinfo.ExplanationCache(MemoryCache(max_size=16))
+
+
+def stream(finding, client, explanation_cache):
+    async def join():
+        return "".join([piece async for piece in finding.stream_action(TEXT, client, explanation_cache=explanation_cache)])
+
+    return asyncio.run(join())
+
+
+def test_complete_explanation_is_cached(finding, explanation_cache):
+    client = FakeClient(answer="Hier wird ein Experte vorgeschoben.")
+
+    assert stream(finding, client, explanation_cache) == "Hier wird ein Experte vorgeschoben."
+    assert explanation_cache.get(finding, TEXT) == "Hier wird ein Experte vorgeschoben."
+
+    # the second report is answered from the cache
+    assert stream(finding, client, explanation_cache) == "Hier wird ein Experte vorgeschoben."
+    assert len(client.calls) == 1
+
+
+@pytest.mark.parametrize("finish_reason", ["length", "content_filter", None])
+def test_truncated_explanation_is_not_cached(finding, explanation_cache, finish_reason):
+    client = FakeClient(answer="Hier wird ein", finish_reason=finish_reason)
+
+    assert stream(finding, client, explanation_cache) == "Hier wird ein"
+    assert explanation_cache.get(finding, TEXT) is None
+
+
+def test_empty_explanation_is_not_cached(finding, explanation_cache):
+    client = FakeClient(answer="")
+
+    stream(finding, client, explanation_cache)
+    assert explanation_cache.get(finding, TEXT) is None
+
+
+def test_truncated_explanation_without_streaming_is_not_cached(finding, explanation_cache):
+    client = FakeClient(answer="Hier wird ein", finish_reason="length")
+
+    action = asyncio.run(finding.create_action(TEXT, client, explanation_cache=explanation_cache))
+    assert action == "Hier wird ein"
+    assert explanation_cache.get(finding, TEXT) is None
+
+
+def test_explanation_without_streaming_is_cached(finding, explanation_cache):
+    client = FakeClient(answer="Hier wird ein Experte vorgeschoben.")
+
+    asyncio.run(finding.create_action(TEXT, client, explanation_cache=explanation_cache))
+    action = asyncio.run(finding.create_action(TEXT, client, explanation_cache=explanation_cache))
+
+    assert action == "Hier wird ein Experte vorgeschoben."
+    assert len(client.calls) == 1
+
+
+def test_passage_only_keys_ignore_the_surrounding_text(desinfo, finding):
+    by_text = desinfo.ExplanationCache(MemoryCache())
+    by_passage = desinfo.ExplanationCache(MemoryCache(), passage_only=True)
+    edited = TEXT.replace("keinen", "gar keinen")
+
+    assert by_text.key(finding, TEXT) != by_text.key(finding, edited)
+    assert by_passage.key(finding, TEXT) == by_passage.key(finding, edited)
+
+
+def test_merged_explanation_looks_up_the_cache_once(desinfo, finding, explanation_cache, monkeypatch):
+    client = FakeClient(answer="Hier wird ein Experte vorgeschoben.")
+    other = desinfo.AppliedStrategy(strategy=list(desinfo.Strategy)[1], content=finding.content)
+    explanation_cache.set(other, TEXT, "Schon erklärt.")
+    lookups = []
+    aget = explanation_cache.aget
+
+    async def counted_aget(applied_strategy, original_text):
+        lookups.append(applied_strategy.strategy)
+        return await aget(applied_strategy, original_text)
+
+    monkeypatch.setattr(explanation_cache, "aget", counted_aget)
+
+    actions = asyncio.run(
+        desinfo.AppliedStrategy.create_actions_merged(
+            [finding, other], TEXT, client, explanation_cache=explanation_cache
+        )
+    )
+
+    assert actions == ["Hier wird ein Experte vorgeschoben.", "Schon erklärt."]
+    assert lookups == [finding.strategy, other.strategy]
+    assert explanation_cache.get(finding, TEXT) == "Hier wird ein Experte vorgeschoben."
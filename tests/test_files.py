@@ -0,0 +1,53 @@
+import importlib
+import os
+
+import pytest
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.setenv("BATCHES_DIR", str(tmp_path / "batches"))
+    monkeypatch.setenv("PIPELINES_DIR", str(tmp_path / "pipelines"))
+    from fastapi.testclient import TestClient
+
+    import config
+    import main
+
+    importlib.reload(config)
+    main = importlib.reload(main)
+    # without the lifespan, no pipelines are loaded and no batch is run
+    return TestClient(main.app), main
+
+
+def test_upload_is_stored_as_batch_file(api):
+    client, main = api
+    content = b'{"custom_id": "1", "method": "POST", "url": "/v1/chat/completions", "body": {}}\n' * 1000
+
+    response = client.post(
+        "/v1/files",
+        files={"file": ("requests.jsonl", content)},
+        data={"purpose": "batch"},
+        headers={"Authorization": f"Bearer {main.API_KEY}"},
+    )
+
+    assert response.status_code == 200
+    file = response.json()
+    assert file["bytes"] == len(content)
+    assert client.get(
+        f"/v1/files/{file['id']}/content", headers={"Authorization": f"Bearer {main.API_KEY}"}
+    ).content == content
+    # the temporary upload was moved, not copied
+    assert not [name for name in os.listdir(main.BATCHES_DIR) if name.startswith("upload-")]
+
+
+def test_upload_needs_the_batch_purpose(api):
+    client, main = api
+
+    response = client.post(
+        "/v1/files",
+        files={"file": ("notes.txt", b"text")},
+        data={"purpose": "assistants"},
+        headers={"Authorization": f"Bearer {main.API_KEY}"},
+    )
+
+    assert response.status_code == 400
@@ -0,0 +1,71 @@
+import asyncio
+
+import httpx
+import pytest
+
+from fastapi.testclient import TestClient
+from openai import AsyncAzureOpenAI
+
+from benchmarks.mock_azure import LatencyDistribution, MockSettings, create_app
+
+TEXT = (
+    "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt. "
+    "Die Regierung verschweigt die wahren Daten zum Wetter."
+)
+URL = "/openai/deployments/test/chat/completions?api-version=2024-06-01"
+
+
+def test_latency_distributions_are_parsed():
+    assert LatencyDistribution.parse("fixed:0.5") == LatencyDistribution("fixed", (0.5,))
+    assert LatencyDistribution.parse("lognormal:0.4:0.5").params == (0.4, 0.5)
+    with pytest.raises(ValueError):
+        LatencyDistribution.parse("normal:1")
+
+
+def test_requests_are_rate_limited():
+    client = TestClient(create_app(MockSettings(rate_limit_rate=1.0, retry_after=2.0)))
+
+    response = client.post(URL, json={"messages": [{"role": "user", "content": "Hallo"}]})
+
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "2.0"
+    assert client.get("/stats").json()["rate_limited"] == 1
+
+
+def test_streamed_answers_end_with_usage():
+    client = TestClient(create_app(MockSettings(seed=1)))
+
+    response = client.post(
+        URL,
+        json={"messages": [{"role": "user", "content": "Hallo"}], "stream": True, "stream_options": {"include_usage": True}},
+    )
+
+    events = [line for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[-1] == "data: [DONE]"
+    assert '"usage"' in events[-2]
+
+
+def test_pipeline_runs_against_the_mock(desinfo):
+    # a seed whose extraction has findings, the number of strategies the mock returns is random
+    app = create_app(MockSettings(seed=3, max_items=2))
+    pipeline = desinfo.Pipeline()
+    pipeline.valves.RESULT_CACHE_BACKEND = "none"
+    for router in pipeline.routers.values():
+        for deployment in router.deployments:
+            deployment.client = AsyncAzureOpenAI(
+                api_key="test",
+                api_version="2024-06-01",
+                azure_endpoint="http://mock",
+                http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=app)),
+            )
+
+    try:
+        result = asyncio.run(pipeline.analyze(TEXT))
+    finally:
+        pipeline._close_caches()
+
+    # the structured responses validate and quote the sentences of the text
+    assert result["findings"]
+    assert all(finding["content"] in TEXT for finding in result["findings"])
+    assert all(finding["start"] is not None for finding in result["findings"])
+    assert result["report"]
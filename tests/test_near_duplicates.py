@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from utils.pipelines import near_duplicates
+from utils.pipelines.near_duplicates import NearDuplicateIndex, lsh_bands
+
+WORDS = (
+    "Ein bekannter Physiker sagt dass es keinen Klimawandel gibt und die Regierung verschweigt seit Jahren "
+    "die wahren Daten über das Wetter weil sie mit den Steuern auf Benzin und Heizöl sehr viel Geld verdient "
+    "während die Medien nur noch berichten was ihnen die Politik vorgibt und kritische Stimmen unterdrückt werden"
+).split()
+TEXT = " ".join(WORDS)
+EDITED = TEXT.replace("sehr viel", "sehr, sehr viel") + "!"
+OTHER = "Heute war das Wetter schön und wir gingen im Park spazieren, danach gab es Kuchen und Kaffee."
+
+
+def test_bands_fit_into_the_signature():
+    bands, rows = lsh_bands(0.9, 128)
+
+    assert bands * rows <= 128
+    # texts above the threshold are almost always candidates, texts far below it almost never
+    assert 1 - (1 - 0.95**rows) ** bands > 0.95
+    assert 1 - (1 - 0.5**rows) ** bands < 0.01
+
+
+def test_edited_texts_are_found_in_their_scope():
+    index = NearDuplicateIndex(threshold=0.7)
+    index.add(TEXT, "analysis", scope="v1")
+
+    match = index.query(EDITED, scope="v1")
+
+    assert match is not None and match.value == "analysis"
+    assert 0.7 <= match.similarity < 1
+    assert index.query(EDITED, scope="v2") is None
+    assert index.query(OTHER, scope="v1") is None
+    assert index.query("...", scope="v1") is None
+    assert index.snapshot()["hits"] == 1
+
+
+def test_rejected_matches_are_counted_as_misses():
+    index = NearDuplicateIndex(threshold=0.7)
+    index.add(TEXT, "analysis")
+
+    index.reject(index.query(EDITED))
+
+    assert index.snapshot()["hits"] == 0
+    assert index.snapshot()["rejections"] == 1
+
+
+def test_least_recently_used_entries_are_evicted():
+    index = NearDuplicateIndex(threshold=0.7, max_size=2)
+    index.add(TEXT, "first")
+    index.add(OTHER, "second")
+    index.query(EDITED)
+    index.add("Ein ganz anderer Text über Katzen, Hunde und andere Haustiere im Garten.", "third")
+
+    assert len(index) == 2
+    assert index.query(EDITED).value == "first"
+    assert index.query(OTHER) is None
+    assert index.snapshot()["evictions"] == 1
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(near_duplicates.time, "time", lambda: now[0])
+    index = NearDuplicateIndex(threshold=0.7, ttl=60)
+    index.add(TEXT, "analysis")
+
+    now[0] += 61
+
+    assert index.query(EDITED) is None
+    assert len(index) == 0
+    assert index.snapshot()["expirations"] == 1
+
+
+def test_entries_are_loaded_from_sqlite(tmp_path):
+    path = str(tmp_path / "near_duplicates.sqlite")
+    index = NearDuplicateIndex(threshold=0.7, path=path)
+    index.add(TEXT, "analysis", scope="v1")
+    index.close()
+
+    reopened = NearDuplicateIndex(threshold=0.7, path=path)
+    try:
+        assert reopened.blocking
+        assert reopened.query(EDITED, scope="v1").value == "analysis"
+    finally:
+        reopened.close()
+
+    # signatures of another number of permutations are not comparable
+    other = NearDuplicateIndex(threshold=0.7, num_perm=64, path=path)
+    try:
+        assert len(other) == 0
+    finally:
+        other.close()
+
+
+@pytest.fixture
+def near_duplicate_pipeline(pipeline):
+    # the edit of the test texts changes a larger share of their few shingles than a typical edit would
+    pipeline.valves.NEAR_DUPLICATE_THRESHOLD = 0.7
+    pipeline._setup_caches()
+    return pipeline
+
+
+def test_near_duplicate_submissions_reuse_the_analysis(desinfo, near_duplicate_pipeline, client):
+    client.findings = {"Ein bekannter Physiker sagt": list(desinfo.Strategy)[0].value}
+
+    async def submit(text):
+        messages = [{"role": "user", "content": text}]
+        return "".join(
+            [piece async for piece in near_duplicate_pipeline.pipe(text, "desinfo", messages, {"stream": True})]
+        )
+
+    report = asyncio.run(submit(TEXT))
+    calls = len(client.calls)
+    edited_report = asyncio.run(submit(EDITED))
+
+    assert len(client.calls) == calls
+    assert near_duplicate_pipeline.near_duplicates.snapshot()["hits"] == 1
+    assert near_duplicate_pipeline.stats()["caches"]["near_duplicates"]["hit_rate"] == 0.5
+    assert "Ein bekannter Physiker sagt" in edited_report
+    assert edited_report.split("Ein bekannter Physiker sagt")[1] == report.split("Ein bekannter Physiker sagt")[1]
@@ -0,0 +1,102 @@
+import asyncio
+
+from utils.pipelines.paragraphs import contiguous_runs, diff_paragraphs, is_revision, split_paragraphs
+
+P1 = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt. Das steht in vielen Blogs."
+P2 = "Heute war das Wetter schön und wir gingen im Park spazieren."
+P3 = "Die Regierung verschweigt die wahren Daten, weil sie davon profitiert."
+FINDINGS = {
+    "Ein bekannter Physiker sagt": "Pseudo-Experten",
+    "Die Regierung verschweigt die wahren Daten": "Verschwörungsmythen",
+}
+
+
+def test_split_paragraphs_at_blank_lines():
+    text = f"  {P1}\n\n{P2}\n \n\n{P3}\n"
+
+    assert [text[span.start : span.end] for span in split_paragraphs(text)] == [P1, P2, P3]
+
+
+def test_split_paragraphs_at_line_breaks_without_blank_lines():
+    text = f"{P1}\n{P2}"
+
+    assert [text[span.start : span.end] for span in split_paragraphs(text)] == [P1, P2]
+
+
+def test_diff_paragraphs_ignores_whitespace_and_case():
+    previous = "\n\n".join([P1, P2])
+    text = "\n\n".join([P1.upper(), P2 + " Es war warm.", P3])
+
+    assert diff_paragraphs(previous, text) == [True, False, False]
+
+
+def test_is_revision():
+    text = "\n\n".join([P1, P2, P3])
+
+    assert is_revision(text, "\n\n".join([P1, P2 + " Es war warm.", P3]))
+    assert is_revision(text, "\n\n".join([P1, P3]))
+    assert not is_revision(text, "Warum ist der Physiker ein Pseudo-Experte?")
+    assert not is_revision("", text)
+
+
+def test_contiguous_runs():
+    assert contiguous_runs([5, 1, 2]) == [(1, 2), (5, 5)]
+    assert contiguous_runs([]) == []
+
+
+def test_revision_only_classifies_changed_paragraphs(desinfo, pipeline, client):
+    client.findings = FINDINGS
+    text = "\n\n".join([P1, P2, P3])
+    body = {"stream": True, "chat_id": "a"}
+
+    async def run(messages):
+        return "".join([piece async for piece in pipeline.pipe(messages[-1]["content"], "desinfo", messages, body)])
+
+    report = asyncio.run(run([{"role": "user", "content": text}]))
+    conversation = pipeline.conversations.get("chat:a")
+    conversation.summary = "Zusammenfassung der alten Fassung"
+    conversation.summarized_messages = 2
+    pipeline.conversations.set("chat:a", conversation)
+
+    revision = "\n\n".join([P1, P2 + " Es war sehr warm.", P3])
+    client.calls.clear()
+    answer = asyncio.run(
+        run([{"role": "user", "content": text}, {"role": "assistant", "content": report}, {"role": "user", "content": revision}])
+    )
+
+    classified = [call["messages"][-1]["content"] for call in client.calls if call.get("tools")]
+    assert len(classified) == 1
+    assert "Es war sehr warm" in classified[0] and P1 not in classified[0]
+    assert "1 von 3 Absätzen sind neu oder geändert, 1 wurden neu analysiert" in answer
+
+    conversation = pipeline.conversations.get("chat:a")
+    assert conversation.text == revision
+    assert sorted(finding.content for finding in conversation.findings) == sorted(FINDINGS)
+    # the summary was about the old version
+    assert conversation.summary == "" and conversation.summarized_messages == 0
+
+
+def test_revision_reuses_the_stored_findings_of_unchanged_paragraphs(desinfo, pipeline, client):
+    client.findings = FINDINGS
+    text = "\n\n".join([P1, P2, P3])
+    body = {"stream": True, "chat_id": "a"}
+
+    async def run(messages):
+        return "".join([piece async for piece in pipeline.pipe(messages[-1]["content"], "desinfo", messages, body)])
+
+    report = asyncio.run(run([{"role": "user", "content": text}]))
+    # the paragraph cache is only an extra source, the diff against the stored conversation is enough
+    pipeline.paragraph_cache.close()
+    pipeline.paragraph_cache = None
+
+    revision = "\n\n".join([P1, P2 + " Es war sehr warm.", P3])
+    client.calls.clear()
+    answer = asyncio.run(
+        run([{"role": "user", "content": text}, {"role": "assistant", "content": report}, {"role": "user", "content": revision}])
+    )
+
+    classified = [call["messages"][-1]["content"] for call in client.calls if call.get("tools")]
+    assert len(classified) == 1
+    assert "Es war sehr warm" in classified[0]
+    assert "1 von 3 Absätzen sind neu oder geändert, 1 wurden neu analysiert" in answer
+    assert sorted(finding.content for finding in pipeline.conversations.get("chat:a").findings) == sorted(FINDINGS)
@@ -0,0 +1,63 @@
+from utils.pipelines.passages import AhoCorasick, PassageLocator, normalize_with_offsets
+
+TEXT = (
+    "Ein  bekannter Physiker sagt, dass es keinen Klimawandel gibt.\n"
+    "„Die Regierung verschweigt die wahren Daten“ – schreibt ein Blog, der seit Jahren gegen die "
+    "Energiewende kämpft und viele Leser hat."
+)
+
+
+def test_normalized_characters_point_to_the_original_text():
+    text = "Ein  „Zitat“\n– Ende"
+
+    normalized, offsets = normalize_with_offsets(text)
+
+    assert normalized == 'ein "zitat" - ende'
+    assert len(offsets) == len(normalized)
+    assert offsets[3] == 3
+    assert offsets[normalized.index('"')] == text.index("„")
+    assert offsets[normalized.index("-")] == text.index("–")
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick(["he", "she", "his", "hers", ""])
+
+    assert sorted(automaton.iter("ushers")) == [(4, 0), (4, 1), (6, 3)]
+
+
+def test_quotes_are_located_despite_whitespace_case_and_typography():
+    locator = PassageLocator(TEXT)
+
+    spans = locator.locate_all(["ein bekannter physiker sagt", '"Die Regierung verschweigt die wahren Daten" - schreibt'])
+
+    assert TEXT[spans[0].start : spans[0].end] == "Ein  bekannter Physiker sagt"
+    assert TEXT[spans[1].start : spans[1].end] == "„Die Regierung verschweigt die wahren Daten“ – schreibt"
+    assert all(span.exact for span in spans)
+
+
+def test_paraphrased_quotes_are_aligned():
+    locator = PassageLocator(TEXT)
+
+    span = locator.locate("ein Blog der seit vielen Jahren gegen die Energiewende kämpft")
+
+    assert TEXT[span.start : span.end] == "ein Blog, der seit Jahren gegen die Energiewende kämpft"
+    assert 0.6 <= span.score < 1
+
+
+def test_quotes_that_are_not_in_the_text_are_not_located():
+    locator = PassageLocator(TEXT)
+
+    assert locator.locate_all(["Ein völlig anderer Satz über Fußball und Tennis", ""]) == [None, None]
+
+
+def test_findings_quote_the_passage_as_written(desinfo):
+    strategies = [
+        desinfo.AppliedStrategy(strategy=list(desinfo.Strategy)[0], content="ein bekannter physiker sagt"),
+        desinfo.AppliedStrategy(strategy=list(desinfo.Strategy)[1], content="Nicht im Text enthalten, gar nicht"),
+    ]
+
+    desinfo.AppliedStrategy.locate(strategies, PassageLocator(TEXT))
+
+    assert strategies[0].quote(TEXT) == "Ein bekannter Physiker sagt"
+    assert strategies[1].location is None
+    assert strategies[1].quote(TEXT) == "Nicht im Text enthalten, gar nicht"
@@ -0,0 +1,83 @@
+import pytest
+
+from utils.pipelines.prompts import PromptRegistry, PromptTemplate
+
+
+@pytest.fixture
+def templates(desinfo):
+    strategies = list(desinfo.Strategy)[:2]
+    examples = {strategy: [f"Beispiel {strategy.name} {i}" for i in range(100)] for strategy in strategies}
+    return desinfo.build_prompt_templates(examples)
+
+
+def examples_in(template):
+    return template.render(TEXT="").count("\tBeispiel ") // 2
+
+
+def test_full_template_is_used_without_limits(desinfo, templates):
+    chosen = desinfo.select_identify_template(templates, "Text")
+
+    assert chosen is templates["identify_strategies"]
+    assert examples_in(chosen) == 100
+
+
+@pytest.mark.parametrize("limit, expected", [(1, 1), (32, 32), (40, 40), (45, 40), (99, 96), (100, 100), (500, 100)])
+def test_examples_per_category_is_kept_above_the_precompiled_variants(desinfo, templates, limit, expected):
+    chosen = desinfo.select_identify_template(templates, "Text", examples_per_category=limit)
+
+    assert examples_in(chosen) == expected
+
+
+def test_token_budget_prunes_examples(desinfo, templates):
+    full_tokens = desinfo.count_template_tokens(templates["identify_strategies"])
+    chosen = desinfo.select_identify_template(templates, "Text", token_budget=full_tokens // 2)
+
+    assert 0 < examples_in(chosen) < 100
+    assert desinfo.count_template_tokens(chosen) <= full_tokens // 2
+
+
+def test_token_budget_below_every_variant_uses_the_smallest(desinfo, templates):
+    chosen = desinfo.select_identify_template(templates, "Text", token_budget=1)
+
+    assert examples_in(chosen) == 1
+
+
+def test_classification_prompt_keeps_the_examples_before_the_text(desinfo):
+    templates = desinfo.build_prompt_templates({strategy: ["Beispiel 1"] for strategy in desinfo.Strategy})
+    prompt = templates["identify_strategies"].render(TEXT="$PLACEHOLDER_STRATEGY_EXAMPLES")
+
+    # the examples are part of the static prefix, the user text is never scanned for placeholders
+    assert "Beispiel 1" in templates["identify_strategies"].prefix
+    assert prompt.index("Beispiel 1") < prompt.index("$PLACEHOLDER_STRATEGY_EXAMPLES")
+
+
+def test_template_fills_static_values_once():
+    template = PromptTemplate("test", "Hallo $PLACEHOLDER_NAME, $PLACEHOLDER_TEXT!", NAME="$PLACEHOLDER_TEXT")
+
+    assert template.fields == ["TEXT"]
+    assert template.prefix == "Hallo $PLACEHOLDER_TEXT, "
+    # values are never searched for placeholders again
+    assert template.render(TEXT="$PLACEHOLDER_NAME") == "Hallo $PLACEHOLDER_TEXT, $PLACEHOLDER_NAME!"
+
+
+def test_template_id_changes_with_its_text():
+    assert PromptTemplate("test", "A $PLACEHOLDER_TEXT").id == PromptTemplate("test", "A $PLACEHOLDER_TEXT").id
+    assert PromptTemplate("test", "A $PLACEHOLDER_TEXT").id != PromptTemplate("test", "B $PLACEHOLDER_TEXT").id
+
+
+def test_registry_builds_again_only_when_the_inputs_change():
+    builds = []
+
+    def builder(greeting):
+        builds.append(greeting)
+        return {"greet": PromptTemplate("greet", f"{greeting} $PLACEHOLDER_TEXT")}
+
+    registry = PromptRegistry(builder)
+    templates = registry.templates(greeting="Hallo")
+    version = registry.version
+
+    assert registry.templates(greeting="Hallo") is templates
+    assert registry.version == version
+    assert registry.templates(greeting="Moin")["greet"].render(TEXT="Welt") == "Moin Welt"
+    assert registry.version != version
+    assert builds == ["Hallo", "Moin"]
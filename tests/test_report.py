@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeClient
+
+PASSAGES = [
+    "Ein bekannter Physiker sagt",
+    "Die Regierung verschweigt die wahren Daten",
+    "Das Klima hat sich schon immer verändert",
+]
+TEXT = f"{PASSAGES[0]}, dass es keinen Klimawandel gibt. {PASSAGES[1]}. {PASSAGES[2]}."
+
+
+@pytest.fixture
+def strategies(desinfo):
+    strategy = list(desinfo.Strategy)
+    return [
+        desinfo.AppliedStrategy(strategy=strategy[0], content=PASSAGES[0]),
+        desinfo.AppliedStrategy(strategy=strategy[4], content=PASSAGES[1]),
+        desinfo.AppliedStrategy(strategy=strategy[1], content=PASSAGES[2]),
+    ]
+
+
+def explain_passage(messages):
+    """explains a passage with the passage itself, to check that every explanation ends up under its passage"""
+    return "Erklärung: " + messages[-1]["content"].split("identifiziert wurde: ")[1].split("\n")[0].strip()
+
+
+async def join(pieces):
+    return "".join([piece async for piece in pieces])
+
+
+def test_gather_with_concurrency_keeps_the_order(desinfo):
+    async def value(i):
+        await asyncio.sleep(0.01 * (3 - i))
+        return i
+
+    assert asyncio.run(desinfo.gather_with_concurrency([value(i) for i in range(3)], max_concurrency=3)) == [0, 1, 2]
+
+
+def test_explanations_are_requested_concurrently(desinfo, strategies):
+    client = FakeClient(delay=0.05)
+
+    actions = asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client, max_concurrency=2))
+
+    assert len(actions) == 3
+    assert client.max_active == 2
+
+
+def test_explanations_are_sequential_without_concurrency(desinfo, strategies):
+    client = FakeClient(delay=0.01)
+
+    asyncio.run(desinfo.AppliedStrategy.create_actions(strategies, TEXT, client, max_concurrency=1))
+
+    assert client.max_active == 1
+
+
+def test_explanations_keep_the_order_of_the_passages(desinfo, strategies):
+    client = FakeClient(answer=explain_passage, delay=0.01)
+
+    report = asyncio.run(desinfo.AppliedStrategy.stringify_long(strategies, TEXT, client, max_concurrency=3))
+
+    for passage in PASSAGES:
+        assert f"> {passage}\n\nErklärung: {passage}" in report
+
+
+def test_header_is_streamed_before_the_explanations(desinfo, strategies):
+    client = FakeClient(answer="Hier wird ein Experte vorgeschoben.")
+
+    async def run():
+        pieces = desinfo.AppliedStrategy.iter_answer_from_list(strategies, TEXT, client, stream=True)
+        header = await anext(pieces)
+        calls = len(client.calls)
+        return header, calls, header + "".join([piece async for piece in pieces])
+
+    header, calls_before_header, streamed = asyncio.run(run())
+
+    assert header.startswith("# Ampel")
+    assert "## Es liegen ggf. folgende Strategien von Desinformation vor" in header
+    assert calls_before_header == 0
+    # streaming only changes when the pieces arrive, not the report
+    assert streamed == asyncio.run(desinfo.AppliedStrategy.construct_answer_from_list(strategies, TEXT, client))
+
+
+def test_streamed_explanations_keep_the_order_of_the_passages(desinfo, strategies):
+    client = FakeClient(answer=explain_passage, delay=0.01)
+
+    pieces = desinfo.AppliedStrategy.iter_long(strategies, TEXT, client, max_concurrency=3, stream=True)
+    report = asyncio.run(join(pieces))
+
+    for passage in PASSAGES:
+        assert f"> {passage}\n\nErklärung: {passage}" in report
+    assert all(call["stream"] for call in client.calls)
+
+
+def test_report_without_strategies(desinfo):
+    report = asyncio.run(desinfo.AppliedStrategy.construct_answer_from_list([], TEXT, FakeClient()))
+
+    assert report.startswith("# Ampel grün")
+
+
+def test_pipeline_reports_the_findings(desinfo, pipeline, client):
+    client.findings = {PASSAGES[1]: desinfo.Strategy.CONSPIRACY_THEORIES.value}
+    messages = [{"role": "user", "content": TEXT}]
+
+    report = asyncio.run(join(pipeline.pipe(TEXT, "desinfo", messages, {"stream": True})))
+
+    assert report.startswith("# Ampel gelb")
+    assert f"> {PASSAGES[1]}\n\nAntwort." in report
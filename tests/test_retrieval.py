@@ -0,0 +1,71 @@
+import pytest
+
+from utils.pipelines.retrieval import BM25Index, tokenize
+
+DOCUMENTS = [
+    "Die Impfung verändert angeblich die DNA.",
+    "Der Klimawandel ist eine Erfindung der Regierung.",
+    "Ein Experte sagt, das Klima habe sich schon immer verändert, der Klimawandel sei natürlich.",
+    "Das Wetter ist heute schön.",
+]
+
+
+def test_tokenize_folds_case_and_drops_single_characters():
+    assert tokenize("Die DNA, a ÄRZTE!") == ["die", "dna", "ärzte"]
+
+
+def test_top_k_ranks_by_matching_terms():
+    index = BM25Index(DOCUMENTS)
+
+    assert index.top_k("Klimawandel natürlich", 2) == [2, 1]
+    assert index.top_k("DNA Impfung", 1) == [0]
+
+
+def test_top_k_fills_up_with_unmatched_documents_in_order():
+    index = BM25Index(DOCUMENTS)
+
+    assert index.top_k("Wetter", 3) == [3, 0, 1]
+    assert index.top_k("nichts passt", 10) == [0, 1, 2, 3]
+
+
+def test_rare_terms_weigh_more():
+    index = BM25Index(DOCUMENTS)
+    scores = index.scores("Klimawandel Impfung")
+
+    # both terms occur once in their document, the rarer one more than the one of two documents
+    assert scores[0] > scores[1]
+
+
+@pytest.fixture
+def provider(desinfo, tmp_path, monkeypatch):
+    path = tmp_path / "Beispiele.xlsx"
+    path.write_bytes(b"")
+    strategies = list(desinfo.Strategy)
+    monkeypatch.setattr(
+        desinfo,
+        "read_strategy_examples",
+        lambda path: {strategies[0]: DOCUMENTS, strategies[1]: DOCUMENTS[::-1]},
+    )
+    return desinfo.StrategyExampleProvider(str(path))
+
+
+def test_similar_examples_per_strategy(desinfo, provider):
+    strategies = list(desinfo.Strategy)
+
+    similar = provider.similar("Klimawandel, natürlich?", 2)
+
+    assert similar[strategies[0]] == [DOCUMENTS[2], DOCUMENTS[1]]
+    assert similar[strategies[1]] == [DOCUMENTS[2], DOCUMENTS[1]]
+    assert provider.index() is provider.index()
+
+
+def test_similar_examples_prompt_renders_the_selected_examples(desinfo, provider):
+    templates = desinfo.build_prompt_templates(provider.examples())
+
+    prompt = desinfo.render_similar_examples_prompt(
+        templates, "Die Impfung verändert die DNA", strategy_examples=provider, examples_per_category=1
+    )
+
+    assert DOCUMENTS[0] in prompt
+    assert DOCUMENTS[3] not in prompt
+    assert "Die Impfung verändert die DNA" in prompt
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from utils.pipelines.router import Deployment, DeploymentRouter, is_retryable
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://localhost"))
+
+
+class Client:
+    """answers with its name after delay seconds, or raises the next of errors"""
+
+    def __init__(self, name, delay=0.0, errors=()):
+        self.name = name
+        self.delay = delay
+        self.errors = list(errors)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(content=self.name, usage=None)
+
+    async def close(self):
+        pass
+
+
+def router(*clients, **kwargs):
+    return DeploymentRouter([Deployment(client.name, client, model=client.name) for client in clients], **kwargs)
+
+
+def create(router):
+    return asyncio.run(router.chat.completions.create(messages=[{"role": "user", "content": "Text"}]))
+
+
+def test_retryable_errors():
+    assert is_retryable(connection_error())
+    assert not is_retryable(ValueError())
+
+
+def test_fails_over_to_the_next_deployment():
+    first, second = Client("a", errors=[connection_error()]), Client("b")
+
+    assert create(router(first, second)).content == "b"
+    assert (first.calls, second.calls) == (1, 1)
+
+
+def test_other_errors_are_raised_without_failover():
+    first, second = Client("a", errors=[ValueError("invalid")]), Client("b")
+
+    with pytest.raises(ValueError):
+        create(router(first, second))
+    assert second.calls == 0
+
+
+def test_circuit_opens_after_consecutive_failures():
+    first, second = Client("a", errors=[connection_error()] * 2), Client("b")
+    deployments = router(first, second, failure_threshold=2, cooldown=60)
+
+    create(deployments)
+    assert not deployments.deployments[0].is_open(time.monotonic())
+    create(deployments)
+    assert deployments.deployments[0].is_open(time.monotonic())
+
+    # the open deployment is ranked last and not called anymore
+    assert [deployment.name for deployment in deployments.ranked()] == ["b", "a"]
+    create(deployments)
+    assert first.calls == 2
+
+
+def test_success_closes_the_circuit():
+    deployment = Deployment("a", Client("a"), model="a")
+    deployment.record_failure(failure_threshold=1, cooldown=60)
+    assert deployment.is_open(time.monotonic())
+
+    deployment.record_success(0.1)
+    assert not deployment.is_open(time.monotonic())
+
+
+def test_every_deployment_failing_raises_the_last_error():
+    with pytest.raises(openai.APIConnectionError):
+        create(router(Client("a", errors=[connection_error()]), Client("b", errors=[connection_error()])))
+
+
+def hedging_router(*clients):
+    deployments = router(*clients, hedge=True, hedge_min_samples=1, hedge_min_delay=0.01)
+    deployments.deployments[0].latencies.append(0.01)
+    return deployments
+
+
+def test_slow_call_is_hedged_on_the_next_deployment():
+    slow, fast = Client("a", delay=1.0), Client("b")
+    deployments = hedging_router(slow, fast)
+    # a is ranked first although it is slow
+    deployments.deployments[1].latencies.append(0.05)
+
+    started = time.monotonic()
+    assert create(deployments).content == "b"
+    assert time.monotonic() - started < 0.5
+    assert (slow.calls, fast.calls) == (1, 1)
+
+
+def test_cancelling_the_caller_cancels_the_hedged_calls():
+    deployments = hedging_router(Client("a", delay=1.0), Client("b", delay=1.0))
+    deployments.deployments[1].latencies.append(0.05)
+
+    async def run():
+        call = asyncio.ensure_future(deployments.chat.completions.create(messages=[{"role": "user", "content": "Text"}]))
+        await asyncio.sleep(0.05)
+        assert [deployment.in_flight for deployment in deployments.deployments] == [1, 1]
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        return [deployment.in_flight for deployment in deployments.deployments]
+
+    assert asyncio.run(run()) == [0, 0]
+
+
+def test_single_deployment_is_not_hedged_on_itself():
+    slow = Client("a", delay=0.05)
+
+    assert create(hedging_router(slow)).content == "a"
+    assert slow.calls == 1
+
+
+def test_open_deployment_is_not_used_for_hedging():
+    slow, broken = Client("a", delay=0.05), Client("b")
+    deployments = hedging_router(slow, broken)
+    deployments.deployments[1].open_until = time.monotonic() + 60
+
+    assert create(deployments).content == "a"
+    assert broken.calls == 0
+
+
+def test_usage_is_estimated_without_usage_in_the_response():
+    deployments = router(Client("a"))
+    create(deployments)
+
+    assert deployments.metrics.snapshot()["calls"] == 1
+    assert deployments.metrics.snapshot()["prompt_tokens"] == 1
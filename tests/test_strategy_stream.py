@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from conftest import FakeClient
+from utils.pipelines.router import Deployment, DeploymentRouter
+
+
+def arguments(desinfo, *contents):
+    strategy = list(desinfo.Strategy)[0].value
+    return json.dumps({"strategies": [{"strategy": strategy, "content": content} for content in contents]})
+
+
+def test_strategies_are_returned_once_their_object_is_complete(desinfo):
+    text = arguments(desinfo, "Ein bekannter Physiker sagt", "Die Daten")
+    parser = desinfo.StrategyStreamParser()
+
+    found = []
+    for position, character in enumerate(text):
+        for strategy in parser.feed(character):
+            found.append((position, strategy.content))
+
+    first_end = text.index("}")
+    assert found == [(first_end, "Ein bekannter Physiker sagt"), (len(text) - 3, "Die Daten")]
+    assert parser.complete
+
+
+def test_braces_and_quotes_in_passages_are_not_structure(desinfo):
+    content = 'Er sagte: "Das {Klima} \\ ist egal}"'
+    parser = desinfo.StrategyStreamParser()
+
+    strategies = parser.feed(arguments(desinfo, content))
+
+    assert [strategy.content for strategy in strategies] == [content]
+
+
+def test_invalid_strategies_are_skipped(desinfo):
+    parser = desinfo.StrategyStreamParser()
+    valid = json.loads(arguments(desinfo, "Die Daten"))["strategies"][0]
+
+    strategies = parser.feed(json.dumps({"strategies": [{"strategy": "Unbekannt", "content": "x"}, valid]}))
+
+    assert [strategy.content for strategy in strategies] == ["Die Daten"]
+
+
+def test_cut_off_arguments_are_incomplete(desinfo):
+    parser = desinfo.StrategyStreamParser()
+    text = arguments(desinfo, "Ein bekannter Physiker sagt", "Die Daten")
+
+    strategies = parser.feed(text[: text.index("Die Daten")])
+
+    assert len(strategies) == 1
+    assert not parser.complete
+
+
+def test_strategies_are_yielded_while_the_extraction_streams(desinfo):
+    passage = "Ein bekannter Physiker sagt"
+    client = FakeClient(findings={passage: list(desinfo.Strategy)[0].value, "Die Daten": list(desinfo.Strategy)[1].value})
+    router = DeploymentRouter([Deployment("test", client, model="test")])
+    read = []
+
+    async def stream_tool_call(arguments):
+        for start in range(0, len(arguments), 8):
+            read.append(start)
+            async for piece in FakeClient.stream_tool_call(client, arguments[start : start + 8]):
+                yield piece
+
+    client.stream_tool_call = stream_tool_call
+
+    async def run():
+        strategies = []
+        async for strategy in desinfo.iter_strategies(f"{passage}, sagt Die Daten.", openai_client=router):
+            strategies.append((len(read), strategy.content))
+        return strategies
+
+    strategies = asyncio.run(run())
+
+    assert [content for _, content in strategies] == [passage, "Die Daten"]
+    # the first strategy arrives before the rest of the tool call is read
+    assert strategies[0][0] < strategies[1][0]
+    assert len(client.calls) == 1
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+
+from utils.pipelines.tasks import (
+    AUTOCOMPLETE_GENERATION,
+    QUERY_GENERATION,
+    TAGS_GENERATION,
+    TITLE_GENERATION,
+    detect_task,
+    get_chat_history,
+)
+
+REPORT = "# Ampel rot\n\n## Es liegen ggf. folgende Strategien von Desinformation vor\n\t- Pseudo-Experten (1x)\n"
+TITLE_PROMPT = (
+    "### Task:\nGenerate a concise, 3-5 word title with an emoji summarizing the chat history.\n"
+    '### Output:\nJSON format: { "title": "your concise title here" }\n'
+    f"### Chat History:\n<chat_history>\nUSER: {'Ein langer Text. ' * 500}\nASSISTANT: {REPORT}\n</chat_history>"
+)
+
+
+def test_task_is_taken_from_the_metadata():
+    assert detect_task({"metadata": {"task": TAGS_GENERATION}}, "Ein Text") == TAGS_GENERATION
+    assert detect_task({"task": QUERY_GENERATION}, "Ein Text") == QUERY_GENERATION
+    assert detect_task({"title": True}, "Ein Text") == TITLE_GENERATION
+
+
+def test_task_template_is_recognized_without_metadata():
+    assert detect_task({}, TITLE_PROMPT) == TITLE_GENERATION
+    assert detect_task({}, "### Task:\nYou are an autocompletion system. Continue the text.") == AUTOCOMPLETE_GENERATION
+    # older templates have no header
+    assert detect_task({}, "Create a concise, 3-5 word title with an emoji as a title for the prompt.") == TITLE_GENERATION
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        # a pasted article quoting a task phrase
+        "Ein Artikel über Chatbots. Wer sie bittet, 'generate search queries' zu erzeugen, bekommt Unsinn.",
+        # a long text starting with a phrase is not a template
+        "Generate 1-3 broad tags for this article. " + "Die Regierung verschweigt die wahren Daten. " * 100,
+        "Ein ganz normaler Text ohne Aufgabe.",
+    ],
+)
+def test_ordinary_messages_are_not_tasks(message):
+    assert detect_task({}, message) is None
+
+
+def test_chat_history_is_extracted():
+    assert get_chat_history("a <chat_history>b</chat_history> c") == "b"
+    assert get_chat_history("kein Verlauf") == "kein Verlauf"
+
+
+def test_task_is_answered_from_the_report_without_the_model(desinfo, pipeline, client):
+    async def run():
+        messages = [{"role": "user", "content": TITLE_PROMPT}]
+        return "".join([piece async for piece in pipeline.pipe(TITLE_PROMPT, "desinfo", messages, {"stream": False})])
+
+    pipeline.routers.pop("small", None)
+    title = json.loads(asyncio.run(run()))["title"]
+
+    assert "Pseudo-Experten" in title
+    assert client.calls == []
@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import FakeClient
+from utils.pipelines.triage import TriageModel
+
+TEXT = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+DEPLOYMENTS = [
+    {"endpoint": "http://localhost", "deployment": "gpt-4o-mini", "tier": "small"},
+    {"endpoint": "http://localhost", "deployment": "gpt-4o"},
+    {"endpoint": "http://localhost", "deployment": "o1", "tier": "large"},
+]
+
+
+@pytest.fixture
+def clients():
+    return {tier: FakeClient(answer=f"Antwort von {tier}.") for tier in ("small", "default", "large")}
+
+
+@pytest.fixture
+def tiered(desinfo, clients, monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_DEPLOYMENTS", json.dumps(DEPLOYMENTS))
+    pipeline = desinfo.Pipeline()
+    for tier, router in pipeline.routers.items():
+        for deployment in router.deployments:
+            deployment.client = clients[tier]
+    yield pipeline
+    pipeline._close_caches()
+
+
+def test_deployments_are_grouped_into_tiers(desinfo):
+    routers = desinfo.create_routers(DEPLOYMENTS)
+
+    assert {tier: [d.model for d in router.deployments] for tier, router in routers.items()} == {
+        "small": ["gpt-4o-mini"],
+        "default": ["gpt-4o"],
+        "large": ["o1"],
+    }
+
+
+def test_unknown_tiers_fall_back_to_the_default_router(tiered):
+    assert tiered.tier("missing") is tiered.routers["default"]
+    assert tiered.tier_models("large") == "o1"
+
+
+def test_long_and_ambiguous_texts_are_classified_by_the_large_tier(tiered):
+    tiered.valves.TIER_CLASSIFICATION_LARGE = "large"
+    assert tiered.classification_tier(TEXT) == "default"
+
+    tiered.valves.TIER_LARGE_MIN_TOKENS = 5
+    assert tiered.classification_tier(TEXT) == "large"
+
+    tiered.valves.TIER_LARGE_MIN_TOKENS = 0
+    tiered.valves.TIER_AMBIGUOUS_BAND = 0.1
+    tiered.triage_model = TriageModel({}, bias=0.0)
+    assert tiered.classification_tier(TEXT) == "large"
+    tiered.triage_model = TriageModel({}, bias=5.0)
+    assert tiered.classification_tier(TEXT) == "default"
+
+
+def test_stages_use_their_tiers(desinfo, tiered, clients):
+    tiered.valves.TIER_CLASSIFICATION = "large"
+    tiered.valves.TIER_EXPLANATION = "small"
+    clients["large"].findings = {"Ein bekannter Physiker sagt": list(desinfo.Strategy)[0].value}
+
+    result = asyncio.run(tiered.analyze(TEXT))
+
+    assert [call.get("tools") is not None for call in clients["large"].calls] == [True]
+    assert clients["small"].calls
+    assert "Antwort von small." in result["report"]
+    assert clients["default"].calls == []
+    usage = tiered.stats()["usage"]
+    assert (usage["large"]["calls"], usage["default"]["calls"]) == (1, 0)
+    assert usage["small"]["calls"] == len(clients["small"].calls)
+
+
+def test_triage_scores_a_message_once(desinfo, tiered, monkeypatch):
+    tiered.valves.TIER_AMBIGUOUS_BAND = 0.1
+    tiered.triage_model = TriageModel({}, bias=0.0)
+    scored = []
+    monkeypatch.setattr(tiered.triage_model, "score", lambda text: scored.append(text) or 0.5)
+    text = f"{TEXT}\n\nDie Regierung verschweigt die wahren Daten."
+    messages = [{"role": "user", "content": text}]
+
+    async def run():
+        return "".join([piece async for piece in tiered.pipe(text, "desinfo", messages, {"stream": True})])
+
+    asyncio.run(run())
+
+    # the paragraphs are cached with tiers of their own
+    assert scored.count(text) == 1
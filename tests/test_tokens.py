@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import sys
+
+from types import SimpleNamespace
+
+import pytest
+
+from utils.pipelines import tokens
+from utils.pipelines.tokens import TokenMetrics, estimate_tokens, get_token_counter, is_encoding_cached
+
+
+@pytest.fixture(autouse=True)
+def fresh_counters(monkeypatch, tmp_path):
+    monkeypatch.setattr(tokens, "_counters", {})
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", str(tmp_path))
+
+
+@pytest.fixture
+def fake_tiktoken(monkeypatch):
+    loaded = []
+
+    def get_encoding(name):
+        loaded.append(name)
+        return SimpleNamespace(encode=lambda text, disallowed_special=(): text.split())
+
+    monkeypatch.setitem(sys.modules, "tiktoken", SimpleNamespace(get_encoding=get_encoding))
+    return loaded
+
+
+def cache_encoding(directory, encoding):
+    url = tokens.ENCODING_URL.format(encoding=encoding)
+    (directory / hashlib.sha1(url.encode()).hexdigest()).write_bytes(b"")
+
+
+def test_estimate_splits_long_words():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Ein Satz.") == 3
+    assert estimate_tokens("Desinformationskampagne") == 6
+
+
+def test_uncached_encoding_is_estimated_without_loading_it(fake_tiktoken):
+    assert get_token_counter("o200k_base") is estimate_tokens
+    assert fake_tiktoken == []
+
+
+def test_cached_encoding_is_loaded(fake_tiktoken, tmp_path):
+    cache_encoding(tmp_path, "o200k_base")
+
+    assert is_encoding_cached("o200k_base")
+    assert get_token_counter("o200k_base")("drei kurze Wörter") == 3
+    assert fake_tiktoken == ["o200k_base"]
+
+
+def test_download_has_to_be_allowed(fake_tiktoken):
+    assert get_token_counter("o200k_base", allow_download=True)("zwei Wörter") == 2
+    assert fake_tiktoken == ["o200k_base"]
+
+
+def test_empty_encoding_or_disabled_cache_is_estimated(fake_tiktoken, monkeypatch):
+    assert get_token_counter("") is estimate_tokens
+
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", "")
+    assert not is_encoding_cached("o200k_base")
+
+
+def test_unavailable_encoding_is_estimated(monkeypatch):
+    def get_encoding(name):
+        raise OSError("offline")
+
+    monkeypatch.setitem(sys.modules, "tiktoken", SimpleNamespace(get_encoding=get_encoding))
+
+    assert get_token_counter("o200k_base", allow_download=True) is estimate_tokens
+
+
+def test_token_metrics_count_the_saved_tokens():
+    metrics = TokenMetrics()
+    metrics.record(prompt_tokens=60, unpruned_tokens=100)
+    metrics.record(prompt_tokens=100, unpruned_tokens=100)
+
+    assert metrics.snapshot() == {"requests": 2, "prompt_tokens": 160, "tokens_saved": 40}
+
+
+def test_pipeline_stats_report_the_saved_tokens(desinfo, pipeline):
+    text = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+    pipeline.valves.EXAMPLES_PER_CATEGORY = 1
+
+    asyncio.run(pipeline.analyze(text, report=False))
+
+    tokens = pipeline.stats()["tokens"]
+    assert tokens["requests"] == 1
+    assert tokens["tokens_saved"] > 0
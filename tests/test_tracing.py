@@ -0,0 +1,111 @@
+import asyncio
+import importlib
+
+from conftest import FakeClient
+from utils.pipelines import tracing
+from utils.pipelines.router import Deployment, DeploymentRouter
+
+TEXT = "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt."
+
+
+def test_spans_record_nothing_without_a_trace():
+    with tracing.span("identify") as current:
+        assert current is tracing.NOOP_SPAN
+        current.add_usage(10, 5)
+    assert tracing.start_span("explain") is tracing.NOOP_SPAN
+    assert tracing.NOOP_SPAN.calls == 0
+
+
+def test_llm_calls_add_their_tokens_to_the_current_span():
+    router = DeploymentRouter([Deployment("test", FakeClient(answer="eins zwei drei"), model="test")])
+
+    async def run():
+        with tracing.trace("desinfo") as active:
+            with tracing.span("explain", passages=1):
+                stream = await router.create(
+                    model="test", messages=[{"role": "user", "content": "Erkläre das bitte"}], stream=True
+                )
+                async for _ in stream:
+                    pass
+            with tracing.span("explain"):
+                pass
+        return active
+
+    active = asyncio.run(run())
+
+    assert [span.name for span in active.spans] == ["explain", "explain"]
+    assert active.spans[0].calls == 1
+    assert active.spans[0].prompt_tokens > 0 and active.spans[0].completion_tokens > 0
+    assert active.spans[0].record()["passages"] == 1
+    summary = active.summary()["explain"]
+    assert summary["count"] == 2
+    assert summary["tokens"] == active.spans[0].prompt_tokens + active.spans[0].completion_tokens
+
+
+def test_server_timing_has_every_stage_and_the_total():
+    with tracing.trace() as active:
+        with tracing.span("identify"):
+            pass
+        started = tracing.start_span("explain")
+        started.end()
+        started.end()
+
+    timing = active.server_timing()
+
+    assert timing.startswith('identify;dur=')
+    assert 'explain;dur=' in timing and '"1x, 0 tokens"' in timing
+    assert ", total;dur=" in timing
+
+
+def test_pipeline_stages_are_traced(desinfo, pipeline, client):
+    client.findings = {"Ein bekannter Physiker sagt": list(desinfo.Strategy)[0].value}
+
+    async def run():
+        with tracing.trace("desinfo") as active:
+            await pipeline.analyze(TEXT)
+        return active
+
+    stages = asyncio.run(run()).summary()
+
+    assert {"identify", "extract_strategies"} <= set(stages)
+    assert stages["extract_strategies"]["tokens"] > 0
+
+
+PIPELINE = '''
+from utils.pipelines.tracing import span
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Traced"
+
+    async def pipe(self, user_message, model_id, messages, body):
+        with span("answer"):
+            return "Antwort"
+'''
+
+
+def test_chat_completions_report_their_server_timing(tmp_path, monkeypatch):
+    pipelines = tmp_path / "pipelines"
+    pipelines.mkdir()
+    (pipelines / "traced.py").write_text(PIPELINE)
+    monkeypatch.setenv("PIPELINES_DIR", str(pipelines))
+    monkeypatch.setenv("BATCHES_DIR", str(tmp_path / "batches"))
+    monkeypatch.setenv("PIPELINES_TRACING", "true")
+    from fastapi.testclient import TestClient
+
+    import config
+    import main
+
+    importlib.reload(config)
+    main = importlib.reload(main)
+    headers = {"Authorization": f"Bearer {main.API_KEY}"}
+    body = {"model": "traced", "messages": [{"role": "user", "content": "Hallo"}]}
+
+    with TestClient(main.app) as client:
+        response = client.post("/v1/chat/completions", json={**body, "stream": False}, headers=headers)
+        streamed = client.post("/v1/chat/completions", json={**body, "stream": True}, headers=headers)
+
+    assert response.json()["choices"][0]["message"]["content"] == "Antwort"
+    assert response.headers["Server-Timing"].startswith('answer;dur=')
+    assert ": server-timing answer;dur=" in streamed.text
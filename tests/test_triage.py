@@ -0,0 +1,71 @@
+import asyncio
+
+from utils.pipelines.triage import ResultLog, TriageModel, evaluate, features, read_result_log
+
+POSITIVES = [
+    "Die Regierung verschweigt die wahren Daten zum Klimawandel.",
+    "Ein bekannter Physiker sagt, dass es keinen Klimawandel gibt.",
+    "Die Medien verschweigen die Wahrheit über die Impfung.",
+]
+NEGATIVES = [
+    "Heute war das Wetter schön und wir gingen spazieren.",
+    "Das Rezept braucht drei Eier und etwas Mehl.",
+    "Der Zug kommt um acht Uhr am Bahnhof an.",
+]
+
+
+def trained():
+    return TriageModel.train(POSITIVES + NEGATIVES, [True] * 3 + [False] * 3, epochs=50, learning_rate=0.5)
+
+
+def test_features_are_words_and_word_pairs():
+    assert features("Die Regierung lügt") == {"die", "regierung", "lügt", "die regierung", "regierung lügt"}
+
+
+def test_trained_model_separates_the_samples():
+    model = trained()
+
+    assert min(model.score(text) for text in POSITIVES) > max(model.score(text) for text in NEGATIVES)
+    assert model.metadata["samples"] == 6
+    assert model.metadata["positives"] == 3
+
+
+def test_model_is_saved_and_loaded(tmp_path):
+    model = trained()
+    path = str(tmp_path / "triage.json")
+
+    model.save(path)
+    loaded = TriageModel.load(path)
+
+    assert loaded.score(POSITIVES[0]) == model.score(POSITIVES[0])
+
+
+def test_result_log_is_evaluated(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    log = ResultLog(path)
+    log.append(POSITIVES[0], [{"strategy": "CONSPIRACY_THEORIES", "content": "verschweigt"}])
+    log.append(NEGATIVES[0], [])
+
+    records = read_result_log(path)
+    assert [record["text"] for record in records] == [POSITIVES[0], NEGATIVES[0]]
+
+    # a model considering every text benign avoids every call and misses every finding
+    stats = evaluate(TriageModel({}, bias=-10.0), records, threshold=0.95)
+    assert stats["llm_calls_avoided"] == 2
+    assert stats["texts_with_findings_missed"] == 1
+    assert stats["findings_missed"] == 1
+
+
+def test_benign_texts_skip_the_llm(pipeline, client):
+    pipeline.triage_model = TriageModel({}, bias=-10.0)
+
+    async def run():
+        messages = [{"role": "user", "content": NEGATIVES[0]}]
+        body = {"stream": True, "chat_id": "a"}
+        return "".join([piece async for piece in pipeline.pipe(NEGATIVES[0], "desinfo", messages, body)])
+
+    assert asyncio.run(run())
+    assert client.calls == []
+    # follow-ups refer to the triaged text without findings
+    conversation = pipeline.conversations.get("chat:a")
+    assert (conversation.text, conversation.findings) == (NEGATIVES[0], [])
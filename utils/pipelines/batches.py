@@ -0,0 +1,435 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional
+
+
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+def parse_completion_window(window: str) -> int:
+    """seconds of an OpenAI completion window like "24h" """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    try:
+        return int(window[:-1]) * units[window[-1]]
+    except (KeyError, ValueError, IndexError):
+        raise ValueError(f"Invalid completion window {window}")
+
+
+class BatchStore:
+    """
+    Files and batches of the OpenAI Batch API, stored as JSON next to the file contents,
+    so that batches survive a restart of the server.
+    """
+
+    def __init__(self, directory: str = "./batches"):
+        self.files_directory = os.path.join(directory, "files")
+        self.batches_directory = os.path.join(directory, "batches")
+        os.makedirs(self.files_directory, exist_ok=True)
+        os.makedirs(self.batches_directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _write(self, path: str, data: dict) -> None:
+        # written to a temporary file first, a crash never leaves a truncated object
+        with self._lock:
+            with open(f"{path}.tmp", "w") as file:
+                json.dump(data, file)
+            os.replace(f"{path}.tmp", path)
+
+    def _read(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def content_path(self, file_id: str) -> str:
+        return os.path.join(self.files_directory, f"{os.path.basename(file_id)}.jsonl")
+
+    def create_file(self, filename: str, purpose: str, content: Optional[bytes] = None, path: Optional[str] = None) -> dict:
+        """stores the content, or moves the file at path, and returns the file object"""
+        file_id = f"file-{uuid.uuid4().hex}"
+        if path is not None:
+            os.replace(path, self.content_path(file_id))
+        else:
+            with open(self.content_path(file_id), "wb") as file:
+                file.write(content or b"")
+        file = {
+            "id": file_id,
+            "object": "file",
+            "bytes": os.path.getsize(self.content_path(file_id)),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        self._write(os.path.join(self.files_directory, f"{file_id}.json"), file)
+        return file
+
+    def get_file(self, file_id: str) -> Optional[dict]:
+        return self._read(os.path.join(self.files_directory, f"{os.path.basename(file_id)}.json"))
+
+    def list_files(self, purpose: Optional[str] = None) -> list[dict]:
+        files = [
+            self._read(os.path.join(self.files_directory, name))
+            for name in os.listdir(self.files_directory)
+            if name.endswith(".json")
+        ]
+        files = [file for file in files if file and (purpose is None or file["purpose"] == purpose)]
+        return sorted(files, key=lambda file: file["created_at"], reverse=True)
+
+    def delete_file(self, file_id: str) -> bool:
+        if self.get_file(file_id) is None:
+            return False
+        os.remove(os.path.join(self.files_directory, f"{os.path.basename(file_id)}.json"))
+        if os.path.exists(self.content_path(file_id)):
+            os.remove(self.content_path(file_id))
+        return True
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[dict] = None) -> dict:
+        now = int(time.time())
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "errors": None,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": now,
+            "in_progress_at": None,
+            "expires_at": now + parse_completion_window(completion_window),
+            "finalizing_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "expired_at": None,
+            "cancelling_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": metadata,
+        }
+        self.save_batch(batch)
+        return batch
+
+    def save_batch(self, batch: dict) -> None:
+        self._write(os.path.join(self.batches_directory, f"{batch['id']}.json"), batch)
+
+    def get_batch(self, batch_id: str) -> Optional[dict]:
+        return self._read(os.path.join(self.batches_directory, f"{os.path.basename(batch_id)}.json"))
+
+    def results_path(self, batch_id: str) -> str:
+        return os.path.join(self.batches_directory, f"{os.path.basename(batch_id)}.results.jsonl")
+
+    def append_result(self, batch_id: str, result: dict, failed: bool) -> None:
+        """journals the result of a request line as soon as it is known, so a restart doesn't run it again"""
+        line = json.dumps({"failed": failed, "result": result}, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.results_path(batch_id), "a", encoding="utf-8") as file:
+                file.write(line)
+                file.flush()
+
+    def read_results(self, batch_id: str) -> tuple[list[dict], list[dict]]:
+        """the outputs and failures journaled for a batch"""
+        outputs, failures = [], []
+        try:
+            with open(self.results_path(batch_id), "r", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the line written when the server stopped, its request is run again
+                        continue
+                    (failures if entry["failed"] else outputs).append(entry["result"])
+        except FileNotFoundError:
+            pass
+        return outputs, failures
+
+    def delete_results(self, batch_id: str) -> None:
+        if os.path.exists(self.results_path(batch_id)):
+            os.remove(self.results_path(batch_id))
+
+    def list_batches(self) -> list[dict]:
+        batches = [
+            self._read(os.path.join(self.batches_directory, name))
+            for name in os.listdir(self.batches_directory)
+            if name.endswith(".json")
+        ]
+        return sorted([batch for batch in batches if batch], key=lambda batch: batch["created_at"], reverse=True)
+
+
+class InteractiveTraffic:
+    """
+    Counts the interactive requests in flight. Background work waits until the
+    interactive load is below a threshold, but at most max_delay seconds, so it is never starved.
+    """
+
+    def __init__(self, threshold: int = 1, max_delay: float = 30.0):
+        self.threshold = threshold
+        self.max_delay = max_delay
+        self.active = 0
+        self._idle: Optional[asyncio.Condition] = None
+
+    def _condition(self) -> asyncio.Condition:
+        if self._idle is None:
+            self._idle = asyncio.Condition()
+        return self._idle
+
+    @contextmanager
+    def track(self):
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._condition():
+            self._condition().notify_all()
+
+    async def wait_for_capacity(self) -> None:
+        if self.threshold <= 0 or self.active < self.threshold:
+            return
+        try:
+            async with self._condition():
+                await asyncio.wait_for(
+                    self._condition().wait_for(lambda: self.active < self.threshold),
+                    timeout=self.max_delay,
+                )
+        except asyncio.TimeoutError:
+            pass
+
+
+class InteractiveTrafficMiddleware:
+    """ASGI middleware tracking requests to the given paths until their (streamed) response is sent."""
+
+    def __init__(self, app, traffic: InteractiveTraffic, paths: tuple[str, ...]):
+        self.app = app
+        self.traffic = traffic
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.paths:
+            with self.traffic.track():
+                await self.app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+class BatchRunner:
+    """
+    Runs batches in the background with its own concurrency budget.
+    Every request waits for the interactive traffic first.
+
+    The result of every line is journaled when it arrives. A batch continued after a restart only
+    runs the lines without a result, so only the lines in flight when the server stopped are sent
+    twice (at-least-once for those, exactly once for all others).
+
+    The handler receives the url and body of a request line and returns (status_code, response body).
+    """
+
+    def __init__(
+        self,
+        store: BatchStore,
+        handler: Callable[[str, dict], Awaitable[tuple[int, dict]]],
+        concurrency: int = 4,
+        traffic: Optional[InteractiveTraffic] = None,
+    ):
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency
+        self.traffic = traffic or InteractiveTraffic(threshold=0)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: dict[str, asyncio.Task] = {}
+        # set by cancel, so the running batch doesn't read its file for every line
+        self._cancelled: dict[str, asyncio.Event] = {}
+
+    def start(self) -> None:
+        """continues the batches that were running when the server stopped"""
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        for batch in self.store.list_batches():
+            if batch["status"] in ACTIVE_STATUSES:
+                self.submit(batch["id"])
+
+    async def stop(self) -> None:
+        # the batches stay in progress and are run again after a restart
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, batch_id: str) -> None:
+        self._cancelled[batch_id] = asyncio.Event()
+        task = asyncio.create_task(self._run(batch_id))
+        self._tasks[batch_id] = task
+
+        def done(_):
+            self._tasks.pop(batch_id, None)
+            self._cancelled.pop(batch_id, None)
+
+        task.add_done_callback(done)
+
+    def cancel(self, batch_id: str) -> Optional[dict]:
+        batch = self.store.get_batch(batch_id)
+        if batch is None:
+            return None
+        if batch["status"] in ("validating", "in_progress"):
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+            self.store.save_batch(batch)
+            if batch_id in self._cancelled:
+                self._cancelled[batch_id].set()
+        return batch
+
+    def _read_requests(self, batch: dict) -> tuple[list[dict], list[dict]]:
+        requests, errors = [], []
+        custom_ids = set()
+        with open(self.store.content_path(batch["input_file_id"]), "r", encoding="utf-8") as file:
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    errors.append({"code": "invalid_json_line", "message": str(e), "param": None, "line": line_number})
+                    continue
+                if request.get("url") != batch["endpoint"]:
+                    errors.append(
+                        {
+                            "code": "mismatched_endpoint",
+                            "message": f"The url {request.get('url')} does not match the batch endpoint {batch['endpoint']}",
+                            "param": "url",
+                            "line": line_number,
+                        }
+                    )
+                elif request.get("custom_id") in custom_ids:
+                    errors.append(
+                        {"code": "duplicate_custom_id", "message": "custom_id must be unique", "param": "custom_id", "line": line_number}
+                    )
+                else:
+                    custom_ids.add(request.get("custom_id"))
+                    requests.append(request)
+        return requests, errors
+
+    async def _run(self, batch_id: str) -> None:
+        # the files are read and written in a worker thread, input files can be large
+        batch = await asyncio.to_thread(self.store.get_batch, batch_id)
+        if batch["status"] == "cancelling":
+            return await self._finish(batch, "cancelled", [], [])
+
+        try:
+            requests, errors = await asyncio.to_thread(self._read_requests, batch)
+        except OSError as e:
+            requests, errors = [], [{"code": "invalid_file", "message": str(e), "param": None, "line": None}]
+        if errors:
+            batch["errors"] = {"object": "list", "data": errors}
+            return await self._finish(batch, "failed", [], [])
+
+        # the lines answered before a restart are kept
+        outputs, failures = await asyncio.to_thread(self.store.read_results, batch["id"])
+        answered = {result["custom_id"] for result in outputs + failures}
+        requests = [request for request in requests if request.get("custom_id") not in answered]
+
+        batch["status"] = "in_progress"
+        batch["in_progress_at"] = batch["in_progress_at"] or int(time.time())
+        batch["request_counts"] = {
+            "total": len(requests) + len(answered),
+            "completed": len(outputs),
+            "failed": len(failures),
+        }
+        await self._save(batch)
+
+        saved_at = time.monotonic()
+
+        async def run_request(request: dict):
+            nonlocal saved_at
+            async with self._semaphore:
+                await self.traffic.wait_for_capacity()
+                if self._stopping(batch):
+                    return
+                request_id = f"batch_req_{uuid.uuid4().hex}"
+                try:
+                    status_code, body = await self.handler(request["url"], request.get("body") or {})
+                    result = {
+                        "id": request_id,
+                        "custom_id": request.get("custom_id"),
+                        "response": {"status_code": status_code, "request_id": request_id, "body": body},
+                        "error": None,
+                    }
+                except Exception as e:
+                    logging.exception(f"batch {batch['id']}: request {request.get('custom_id')} failed")
+                    status_code = 500
+                    result = {
+                        "id": request_id,
+                        "custom_id": request.get("custom_id"),
+                        "response": None,
+                        "error": {"code": "server_error", "message": str(e)},
+                    }
+
+            await asyncio.to_thread(self.store.append_result, batch["id"], result, status_code >= 400)
+            if status_code < 400:
+                outputs.append(result)
+                batch["request_counts"]["completed"] += 1
+            else:
+                failures.append(result)
+                batch["request_counts"]["failed"] += 1
+            if time.monotonic() - saved_at > 1:
+                saved_at = time.monotonic()
+                # keeps a cancellation that arrived in the meantime
+                self._stopping(batch)
+                await self._save(batch)
+
+        async def work(pending):
+            for request in pending:
+                await run_request(request)
+
+        # a fixed number of workers instead of one task per line, batches can have many thousand lines
+        pending = iter(requests)
+        await asyncio.gather(*[work(pending) for _ in range(self.concurrency)])
+
+        if self._stopping(batch):
+            status = "expired" if batch["status"] != "cancelling" else "cancelled"
+        else:
+            status = "completed"
+        await self._finish(batch, status, outputs, failures)
+
+    async def _save(self, batch: dict) -> None:
+        # a copy is written, the workers keep counting while the file is written
+        await asyncio.to_thread(self.store.save_batch, copy.deepcopy(batch))
+
+    def _stopping(self, batch: dict) -> bool:
+        cancelled = self._cancelled.get(batch["id"])
+        if batch["status"] != "cancelling" and cancelled is not None and cancelled.is_set():
+            batch["status"] = "cancelling"
+            batch["cancelling_at"] = int(time.time())
+        return batch["status"] == "cancelling" or time.time() > batch["expires_at"]
+
+    async def _finish(self, batch: dict, status: str, outputs: list[dict], failures: list[dict]) -> None:
+        await asyncio.to_thread(self._write_results, batch, status, outputs, failures)
+
+    def _write_results(self, batch: dict, status: str, outputs: list[dict], failures: list[dict]) -> None:
+        if status in ("completed", "cancelled", "expired"):
+            batch["status"] = "finalizing"
+            batch["finalizing_at"] = int(time.time())
+            self.store.save_batch(batch)
+            for results, key in ((outputs, "output_file_id"), (failures, "error_file_id")):
+                if results:
+                    content = "".join(json.dumps(result, ensure_ascii=False) + "\n" for result in results)
+                    file = self.store.create_file(
+                        f"{batch['id']}_{key.split('_')[0]}.jsonl", "batch_output", content.encode("utf-8")
+                    )
+                    batch[key] = file["id"]
+
+        batch["status"] = status
+        batch[f"{status}_at"] = int(time.time())
+        self.store.save_batch(batch)
+        self.store.delete_results(batch["id"])
@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+import re
+
+from collections import OrderedDict
+from typing import Optional
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a text so that submissions which only differ in unicode
+    representation or whitespace share the same cache key.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_key(*parts: str) -> str:
+    """Returns a stable hash over all parts, usable as cache key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        # separator, so that ("ab", "c") and ("a", "bc") differ
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Base class of the cache backends. Keys and values are strings,
+    serializing structured results is up to the caller.
+
+    Async code uses aget and aset, which call backends doing I/O (blocking = True)
+    in a worker thread, so a slow disk or Redis server doesn't block the event loop.
+    """
+
+    blocking = False
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: str) -> None:
+        self._set(key, value)
+
+    async def aget(self, key: str) -> Optional[str]:
+        if self.blocking:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def aset(self, key: str, value: str) -> None:
+        if self.blocking:
+            await asyncio.to_thread(self.set, key, value)
+        else:
+            self.set(key, value)
+
+    def _get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+
+class MemoryCache(ResultCache):
+    """In-process LRU cache with optional TTL."""
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, value = entry
+            if self._expired(created_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache(ResultCache):
+    """On-disk LRU cache with optional TTL, survives restarts of the server."""
+
+    blocking = True
+
+    def __init__(
+        self,
+        path: str = "./cache.sqlite3",
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        table: str = "results",
+    ):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at "
+                f"ON {self.table} (accessed_at)"
+            )
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self._expired(created_at):
+                self._connection.execute(
+                    f"DELETE FROM {self.table} WHERE key = ?", (key,)
+                )
+                return None
+            self._connection.execute(
+                f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            return value
+
+    def _set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} "
+                "(key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            # evict the least recently used entries above max_size
+            self._connection.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY accessed_at DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class RedisCache(ResultCache):
+    """
+    Cache in a Redis-compatible store (Redis, Valkey, KeyDB, ...).
+    Expiry is handled by the server via the TTL; the size bound and LRU eviction
+    are left to the server's maxmemory policy (e.g. allkeys-lru).
+    """
+
+    blocking = True
+
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        ttl: Optional[float] = None,
+        prefix: str = "results:",
+    ):
+        super().__init__(max_size=0, ttl=ttl)
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError(
+                "The redis cache backend requires the redis package (pip install redis)."
+            ) from e
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def _get(self, key: str) -> Optional[str]:
+        return self._client.get(f"{self.prefix}{key}")
+
+    def _set(self, key: str, value: str) -> None:
+        self._client.set(
+            f"{self.prefix}{key}",
+            value,
+            ex=int(self.ttl) if self.ttl is not None else None,
+        )
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_cache(
+    backend: str,
+    max_size: int = 1024,
+    ttl: Optional[float] = None,
+    url: str = "",
+    namespace: str = "results",
+) -> Optional[ResultCache]:
+    """
+    Creates a cache for the backend name "memory", "sqlite" or "redis".
+    "none" or an empty name disables caching and returns None.
+    For sqlite the url is the path of the database file, for redis the connection url.
+    The namespace separates several caches sharing one database.
+    """
+    backend = backend.lower().strip()
+    ttl = ttl if ttl else None
+
+    if backend in ("", "none"):
+        return None
+    elif backend == "memory":
+        return MemoryCache(max_size=max_size, ttl=ttl)
+    elif backend == "sqlite":
+        return SQLiteCache(
+            path=url or "./cache.sqlite3", max_size=max_size, ttl=ttl, table=namespace
+        )
+    elif backend == "redis":
+        return RedisCache(
+            url=url or "redis://localhost:6379/0", ttl=ttl, prefix=f"{namespace}:"
+        )
+    else:
+        logging.warning(f"Unknown cache backend {backend}, caching is disabled.")
+        return None
@@ -0,0 +1,304 @@
+"""
+Runs a pipeline over a corpus of texts outside of the chat, e.g. to score a dump of posts.
+
+The pipeline must have an async analyze(text, report=...) method returning a JSON serializable dict.
+Rows are streamed from CSV, JSON lines or Parquet and analysed by a bounded pool of concurrent
+workers. Results are written incrementally to JSON lines or Parquet. A checkpoint file records the
+ids of all written rows, so an interrupted run continues where it stopped when started again.
+
+    python -m utils.pipelines.corpus --pipeline pipelines/desinfo.py --input posts.csv \\
+        --text-column text --id-column id --output results.jsonl --concurrency 16
+"""
+
+import argparse
+import asyncio
+import csv
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from collections import deque
+from typing import Iterator, Optional
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet files require the pyarrow package (pip install pyarrow).") from e
+    return pyarrow
+
+
+def file_format(path: str) -> str:
+    extension = os.path.splitext(path.rstrip("/"))[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    elif extension in (".csv", ".parquet"):
+        return extension[1:]
+    raise ValueError(f"Unknown file format of {path}, expected .csv, .jsonl or .parquet")
+
+
+def read_rows(
+    path: str, text_column: str = "text", id_column: Optional[str] = None
+) -> Iterator[tuple[str, str, dict]]:
+    """streams (id, text, row) from a CSV, JSON lines or Parquet file; the row number is the id without id_column"""
+
+    def rows() -> Iterator[dict]:
+        format = file_format(path)
+        if format == "csv":
+            with open(path, newline="", encoding="utf-8") as file:
+                yield from csv.DictReader(file)
+        elif format == "jsonl":
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        yield json.loads(line)
+        else:
+            pyarrow = import_pyarrow()
+            for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=1024):
+                yield from batch.to_pylist()
+
+    for number, row in enumerate(rows()):
+        text = row.get(text_column)
+        row_id = str(row[id_column]) if id_column else str(number)
+        yield row_id, "" if text is None else str(text), row
+
+
+class JsonlWriter:
+    """Appends every result as a line, written rows are flushed at once."""
+
+    def __init__(self, path: str):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, row_id: str, record: dict) -> list[str]:
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        return [row_id]
+
+    def flush(self) -> list[str]:
+        return []
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """
+    Writes the results into a directory of Parquet files, one file per flush_rows results.
+    A resumed run adds new files, so nothing that was written is rewritten.
+    """
+
+    def __init__(self, path: str, flush_rows: int = 1000):
+        self.pyarrow = import_pyarrow()
+        self.path = path
+        self.flush_rows = flush_rows
+        os.makedirs(path, exist_ok=True)
+        self._part = len([name for name in os.listdir(path) if name.endswith(".parquet")])
+        self._ids: list[str] = []
+        self._records: list[dict] = []
+
+    def write(self, row_id: str, record: dict) -> list[str]:
+        self._ids.append(row_id)
+        # nested values are stored as JSON, so that all files share one simple schema
+        self._records.append(
+            {
+                key: json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+                for key, value in record.items()
+            }
+        )
+        if len(self._records) >= self.flush_rows:
+            return self.flush()
+        return []
+
+    def flush(self) -> list[str]:
+        if not self._records:
+            return []
+        table = self.pyarrow.Table.from_pylist(self._records)
+        self.pyarrow.parquet.write_table(table, os.path.join(self.path, f"part-{self._part:05d}.parquet"))
+        self._part += 1
+        ids, self._ids, self._records = self._ids, [], []
+        return ids
+
+    def close(self) -> None:
+        self.flush()
+
+
+class Checkpoint:
+    """The ids of all rows whose results are written, one per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: set[str] = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                self.done = {line.rstrip("\n") for line in file if line.strip()}
+        self.file = open(path, "a", encoding="utf-8")
+
+    def add(self, row_ids: list[str]) -> None:
+        if row_ids:
+            self.file.write("".join(f"{row_id}\n" for row_id in row_ids))
+            self.file.flush()
+            self.done.update(row_ids)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Progress:
+    """Prints the number of analysed texts and the throughput in texts per minute."""
+
+    def __init__(self, skipped: int = 0, interval: float = 1.0, window: float = 60.0):
+        self.skipped = skipped
+        self.interval = interval
+        self.window = window
+        self.done = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self._finished: deque[float] = deque()
+        self._printed = 0.0
+
+    def add(self, error: bool = False) -> None:
+        now = time.monotonic()
+        self.done += 1
+        self.errors += error
+        self._finished.append(now)
+        while self._finished[0] < now - self.window:
+            self._finished.popleft()
+        if now - self._printed >= self.interval:
+            self.print()
+
+    def rates(self) -> tuple[float, float]:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return self.done / elapsed * 60, len(self._finished) / min(self.window, elapsed) * 60
+
+    def print(self, end: str = "\r") -> None:
+        self._printed = time.monotonic()
+        total, recent = self.rates()
+        print(
+            f"{self.done} analysed, {self.errors} errors, {self.skipped} skipped (done before), "
+            f"{recent:.1f} texts/min (last minute), {total:.1f} texts/min (total)",
+            end=end,
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+async def run(
+    pipeline,
+    rows: Iterator[tuple[str, str, dict]],
+    writer,
+    checkpoint: Checkpoint,
+    errors_path: str,
+    concurrency: int = 8,
+    keep_columns: Optional[list[str]] = None,
+    report: bool = True,
+) -> Progress:
+    """analyses all rows not in the checkpoint with at most concurrency texts in flight"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    progress = Progress()
+    pending: set[str] = set()
+
+    async def produce():
+        for row_id, text, row in rows:
+            if row_id in checkpoint.done or row_id in pending:
+                progress.skipped += row_id in checkpoint.done
+                continue
+            pending.add(row_id)
+            await queue.put((row_id, text, row))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def work():
+        while (item := await queue.get()) is not None:
+            row_id, text, row = item
+            try:
+                result = await pipeline.analyze(text, report=report) if text.strip() else {}
+            except Exception as e:
+                # failed rows are not checkpointed, a resumed run tries them again
+                with open(errors_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps({"id": row_id, "error": repr(e)}, ensure_ascii=False) + "\n")
+                progress.add(error=True)
+                continue
+            record = {"id": row_id, **{column: row.get(column) for column in keep_columns or []}, **result}
+            checkpoint.add(writer.write(row_id, record))
+            progress.add()
+
+    try:
+        await asyncio.gather(produce(), *[work() for _ in range(concurrency)])
+    finally:
+        checkpoint.add(writer.flush())
+        progress.print(end="\n")
+    return progress
+
+
+def load_pipeline(path: str, valves: Optional[str] = None):
+    """loads a pipeline like main.py does, including the valves.json next to it"""
+    module_name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    pipeline = module.Pipeline()
+
+    valves = valves or os.path.join(os.path.dirname(path), module_name, "valves.json")
+    if hasattr(pipeline, "valves") and os.path.exists(valves):
+        with open(valves, "r") as file:
+            pipeline.valves = pipeline.valves.__class__(**{**pipeline.valves.model_dump(), **json.load(file)})
+    return pipeline
+
+
+async def main_async(args) -> None:
+    pipeline = load_pipeline(args.pipeline, args.valves)
+    if not hasattr(pipeline, "analyze"):
+        raise SystemExit(f"{args.pipeline} has no analyze method and cannot be run over a corpus")
+
+    writer = ParquetWriter(args.output, args.flush_rows) if file_format(args.output) == "parquet" else JsonlWriter(args.output)
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output.rstrip('/')}.checkpoint")
+    if checkpoint.done:
+        print(f"resuming, {len(checkpoint.done)} rows are already done", file=sys.stderr)
+
+    if hasattr(pipeline, "on_startup"):
+        await pipeline.on_startup()
+    try:
+        await run(
+            pipeline,
+            read_rows(args.input, args.text_column, args.id_column),
+            writer,
+            checkpoint,
+            errors_path=f"{args.output.rstrip('/')}.errors.jsonl",
+            concurrency=args.concurrency,
+            keep_columns=args.keep_column,
+            report=not args.findings_only,
+        )
+    finally:
+        writer.close()
+        checkpoint.close()
+        if hasattr(pipeline, "on_shutdown"):
+            await pipeline.on_shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", default="pipelines/desinfo.py")
+    parser.add_argument("--valves", help="valves.json, defaults to the one next to the pipeline")
+    parser.add_argument("--input", required=True, help=".csv, .jsonl or .parquet")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--id-column", help="unique id of a row, the row number if not given")
+    parser.add_argument("--keep-column", action="append", default=[], help="input column copied to the output")
+    parser.add_argument("--output", required=True, help=".jsonl file or .parquet directory")
+    parser.add_argument("--checkpoint", help="defaults to <output>.checkpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="texts analysed at the same time")
+    parser.add_argument("--flush-rows", type=int, default=1000, help="rows per Parquet file")
+    parser.add_argument("--findings-only", action="store_true", help="skip the explanations of the report")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main_async(args))
+    except KeyboardInterrupt:
+        print("\ninterrupted, run the same command again to resume", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Index of recently analysed texts that finds near duplicates of a new text.
+
+Texts are split into overlapping word shingles, whose MinHash signature estimates the Jaccard
+similarity of two texts. Signatures are split into bands and stored in a locality sensitive hash
+table, so a query only compares the texts sharing at least one band with it instead of every entry.
+
+    index = NearDuplicateIndex(threshold=0.9, max_size=2048, ttl=86400)
+    index.add(text, json.dumps(analysis))
+    match = index.query(edited_text)  # NearDuplicate(key, similarity, value) or None
+
+The index keeps at most max_size entries (least recently used are evicted first) and forgets entries
+after ttl seconds. With a path, the entries are also stored in a sqlite database and loaded again
+after a restart; the band table is always rebuilt in memory.
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# a Mersenne prime larger than every 32 bit shingle hash, as modulus of the permutations
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+    """32 bit hashes of the overlapping word shingles of a text, ignoring case, punctuation and whitespace"""
+    words = WORD_PATTERN.findall(unicodedata.normalize("NFKC", text).casefold())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {" ".join(words[i : i + size]) for i in range(max(1, len(words) - size + 1))}
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles],
+        dtype=np.uint64,
+    )
+
+
+def lsh_bands(threshold: float, num_perm: int, false_negative_weight: float = 0.9, steps: int = 100) -> tuple[int, int]:
+    """
+    Bands and rows per band that minimize the weighted probabilities of a false positive (a text
+    below the threshold becoming a candidate) and of a false negative (one above it being missed),
+    integrated over all similarities. False positives only cost a comparison of the signatures,
+    so false negatives weigh more by default.
+    """
+    similarities = (np.arange(steps) + 0.5) / steps
+    below = similarities < threshold
+
+    def error(bands: int, rows: int) -> float:
+        candidate = 1 - (1 - similarities**rows) ** bands
+        return float(
+            (1 - false_negative_weight) * np.sum(candidate[below])
+            + false_negative_weight * np.sum(1 - candidate[~below])
+        )
+
+    # the bands may leave some values of the signature unused
+    options = [(bands, rows) for rows in range(1, num_perm + 1) for bands in range(1, num_perm // rows + 1)]
+    return min(options, key=lambda option: error(*option))
+
+
+@dataclass
+class NearDuplicate:
+    key: str
+    similarity: float
+    value: str
+
+
+class NearDuplicateIndex:
+    """
+    MinHash LSH index over recently analysed texts with bounded size, TTL and optional sqlite backing.
+
+    Entries are scoped: a query only matches entries added with the same scope (e.g. the prompt
+    version and the deployments), so an analysis made with other settings is never returned.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        max_size: int = 2048,
+        ttl: Optional[float] = None,
+        path: str = "",
+        table: str = "near_duplicates",
+        seed: int = 1,
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_size = max_size
+        self.ttl = ttl if ttl else None
+        self.table = table
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+
+        # the permutations are fixed by the seed, so signatures stored on disk stay comparable
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+        self._lock = threading.Lock()
+        # key -> (created_at, scope, signature, value), least recently used first
+        self._entries: OrderedDict[str, tuple[float, str, np.ndarray, str]] = OrderedDict()
+        self._buckets: dict[tuple[int, bytes], set[str]] = {}
+
+        self.lookups = 0
+        self.hits = 0
+        self.rejections = 0
+        self.candidates = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._connection: Optional[sqlite3.Connection] = None
+        if path:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._lock, self._connection:
+                self._connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    "key TEXT PRIMARY KEY, scope TEXT NOT NULL, signature BLOB NOT NULL, "
+                    "value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                self._load()
+
+    @property
+    def blocking(self) -> bool:
+        """whether add and query write to the database, async callers run them in a worker thread"""
+        return self._connection is not None
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature of a text, None for a text without words"""
+        hashes = shingle_hashes(text, self.shingle_size)
+        if not len(hashes):
+            return None
+        # one universal hash (a * x + b) per permutation, the products may wrap around 64 bits
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(self._a, hashes) + self._b[:, None]) % MERSENNE_PRIME
+        return np.bitwise_and(permuted, MAX_HASH).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> list[tuple[int, bytes]]:
+        return [
+            (band, signature[band * self.rows : (band + 1) * self.rows].tobytes()) for band in range(self.bands)
+        ]
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def query(self, text: str, scope: str = "") -> Optional[NearDuplicate]:
+        """the most similar entry of the scope with an estimated Jaccard similarity of at least threshold"""
+        signature = self.signature(text)
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            if signature is None:
+                return None
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates.update(self._buckets.get(band_key, ()))
+
+            best: Optional[NearDuplicate] = None
+            for key in candidates:
+                created_at, entry_scope, entry_signature, value = self._entries[key]
+                if entry_scope != scope:
+                    continue
+                if self._expired(created_at, now):
+                    self._remove(key)
+                    self.expirations += 1
+                    continue
+                self.candidates += 1
+                similarity = float(np.mean(entry_signature == signature))
+                if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                    best = NearDuplicate(key, similarity, value)
+
+            if best is not None:
+                self.hits += 1
+                self._entries.move_to_end(best.key)
+            return best
+
+    def reject(self, match: NearDuplicate) -> None:
+        """counts a match the caller couldn't use as a miss, e.g. because the edit changed a finding"""
+        with self._lock:
+            self.hits -= 1
+            self.rejections += 1
+
+    def add(self, text: str, value: str, scope: str = "", key: Optional[str] = None) -> None:
+        signature = self.signature(text)
+        if signature is None:
+            return
+        key = key or hashlib.sha256(f"{scope}\x1f{' '.join(text.split())}".encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._insert(key, now, scope, signature, value)
+            self._evict(now)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        f"INSERT OR REPLACE INTO {self.table} (key, scope, signature, value, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (key, scope, signature.astype("<u8").tobytes(), value, now),
+                    )
+
+    def _insert(self, key: str, created_at: float, scope: str, signature: np.ndarray, value: str) -> None:
+        self._entries[key] = (created_at, scope, signature, value)
+        for band_key in self._band_keys(signature):
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def _remove(self, key: str) -> None:
+        _, _, signature, _ = self._entries.pop(key)
+        for band_key in self._band_keys(signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+        if self._connection is not None:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def _evict(self, now: float) -> None:
+        # expired entries are usually among the least recently used ones, so only the front is checked
+        while self._entries:
+            key, (created_at, *_) = next(iter(self._entries.items()))
+            if not self._expired(created_at, now):
+                break
+            self._remove(key)
+            self.expirations += 1
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _load(self) -> None:
+        """loads the most recent entries of the database that haven't expired, oldest first"""
+        now = time.time()
+        rows = self._connection.execute(
+            f"SELECT key, scope, signature, value, created_at FROM {self.table} ORDER BY created_at DESC LIMIT ?",
+            (self.max_size,),
+        ).fetchall()
+        for key, scope, blob, value, created_at in reversed(rows):
+            signature = np.frombuffer(blob, dtype="<u8").astype(np.uint64)
+            # signatures of another number of permutations can't be compared
+            if len(signature) == self.num_perm and not self._expired(created_at, now):
+                self._insert(key, created_at, scope, signature, value)
+        self._connection.execute(
+            f"DELETE FROM {self.table} WHERE key NOT IN (SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT ?)"
+            + (" OR created_at < ?" if self.ttl is not None else ""),
+            (self.max_size, now - self.ttl) if self.ttl is not None else (self.max_size,),
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else None,
+                "rejections": self.rejections,
+                "candidates": self.candidates,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,71 @@
+"""
+Paragraphs of a submitted text, to re-analyse only what changed when a text is pasted again in an
+edited or extended version.
+"""
+
+import re
+
+from difflib import SequenceMatcher
+
+from utils.pipelines.cache import normalize_text
+from utils.pipelines.passages import PassageSpan
+
+BLANK_LINE_PATTERN = re.compile(r"\n[ \t]*\n\s*")
+LINE_PATTERN = re.compile(r"\n\s*")
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def split_paragraphs(text: str) -> list[PassageSpan]:
+    """
+    Spans of the paragraphs of a text, separated by blank lines. A text without blank lines is
+    split at its line breaks instead. Whitespace around the paragraphs is not part of the spans.
+    """
+    pattern = BLANK_LINE_PATTERN if BLANK_LINE_PATTERN.search(text) else LINE_PATTERN
+    paragraphs = []
+    start = 0
+    for separator in [*pattern.finditer(text), None]:
+        end = separator.start() if separator is not None else len(text)
+        paragraph = text[start:end]
+        if paragraph.strip():
+            leading = len(paragraph) - len(paragraph.lstrip())
+            paragraphs.append(PassageSpan(start + leading, start + len(paragraph.rstrip())))
+        if separator is not None:
+            start = separator.end()
+    return paragraphs
+
+
+def paragraph_key(paragraph: str) -> str:
+    """paragraphs that only differ in whitespace and case are unchanged"""
+    return normalize_text(paragraph).casefold()
+
+
+def is_revision(previous: str, text: str, min_retained: float = 0.5, min_length: float = 0.5) -> bool:
+    """
+    Whether text is a new version of previous (edited, shortened or extended) rather than a message
+    about it: it has at least min_length of the words of previous, and at least min_retained of
+    the words of previous are found again in the same order.
+    """
+    previous_words = WORD_PATTERN.findall(previous.casefold())
+    words = WORD_PATTERN.findall(text.casefold())
+    if not previous_words or len(words) < min_length * len(previous_words):
+        return False
+    matcher = SequenceMatcher(None, previous_words, words, autojunk=False)
+    retained = sum(block.size for block in matcher.get_matching_blocks())
+    return retained >= min_retained * len(previous_words)
+
+
+def diff_paragraphs(previous: str, text: str) -> list[bool]:
+    """for every paragraph of text, whether it is unchanged from a paragraph of previous"""
+    previous_keys = {paragraph_key(previous[span.start : span.end]) for span in split_paragraphs(previous)}
+    return [paragraph_key(text[span.start : span.end]) in previous_keys for span in split_paragraphs(text)]
+
+
+def contiguous_runs(indices: list[int]) -> list[tuple[int, int]]:
+    """(first, last) of every run of consecutive indices, e.g. [1, 2, 5] -> [(1, 2), (5, 5)]"""
+    runs: list[tuple[int, int]] = []
+    for index in sorted(indices):
+        if runs and index == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], index)
+        else:
+            runs.append((index, index))
+    return runs
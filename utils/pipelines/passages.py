@@ -0,0 +1,283 @@
+"""
+Locates the passages the model quotes in its findings in the analysed text.
+
+The quotes are copied by the model, so they may differ from the text in whitespace, case and
+typographic characters, or be paraphrased and shortened. All quotes are searched at once with an
+Aho-Corasick automaton over the normalized text; the ones without an exact match are aligned word
+by word in the few regions that share the most rare words with them.
+
+    locator = PassageLocator(text)
+    spans = locator.locate_all([finding.content for finding in findings])
+"""
+
+import math
+import re
+import unicodedata
+
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+# characters the model tends to replace when copying a quote
+TYPOGRAPHIC_CHARACTERS = str.maketrans(
+    {
+        "„": '"', "“": '"', "”": '"', "«": '"', "»": '"',
+        "‚": "'", "‘": "'", "’": "'", "‹": "'", "›": "'", "`": "'",
+        "–": "-", "—": "-", "‐": "-", "‑": "-", "­": "",
+    }
+)
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+@dataclass(frozen=True)
+class PassageSpan:
+    """Character offsets of a passage in the original text, score is 1.0 for an exact match."""
+
+    start: int
+    end: int
+    score: float = 1.0
+
+    @property
+    def exact(self) -> bool:
+        return self.score >= 1.0
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def overlap(self, other: "PassageSpan") -> int:
+        """Number of characters both spans cover."""
+        return max(0, min(self.end, other.end) - max(self.start, other.start))
+
+    def contains(self, other: "PassageSpan") -> bool:
+        return self.start <= other.start and other.end <= self.end
+
+
+def normalize_with_offsets(text: str) -> tuple[str, list[int]]:
+    """
+    Normalizes a text like normalize_text (unicode, whitespace) and additionally folds case and
+    typographic characters. Returns the normalized text and, for each of its characters, the
+    offset of the character of the original text it was produced from.
+    """
+    characters: list[str] = []
+    offsets: list[int] = []
+    space = -1
+    for offset, character in enumerate(text):
+        if character.isspace():
+            if characters and space == -1:
+                space = offset
+            continue
+        if space != -1:
+            characters.append(" ")
+            offsets.append(space)
+            space = -1
+        if character.isascii():
+            folded = character.lower()
+        else:
+            folded = unicodedata.normalize("NFKC", character).translate(TYPOGRAPHIC_CHARACTERS).casefold()
+        for folded_character in folded:
+            characters.append(folded_character)
+            offsets.append(offset)
+    return "".join(characters), offsets
+
+
+def normalize_passage(text: str) -> str:
+    return normalize_with_offsets(text)[0]
+
+
+class AhoCorasick:
+    """Automaton that finds all occurrences of several patterns in a single pass over a text."""
+
+    def __init__(self, patterns: list[str]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[int]] = [[]]
+
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                continue
+            node = 0
+            for character in pattern:
+                child = self._goto[node].get(character)
+                if child is None:
+                    child = len(self._goto)
+                    self._goto[node][character] = child
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = child
+            self._output[node].append(index)
+
+        # breadth first, so the failure link of a node's parent is known before the node's
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for character, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and character not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(character, 0)
+                if self._output[self._fail[child]]:
+                    self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def iter(self, text: str) -> Iterator[tuple[int, int]]:
+        """(end offset, pattern index) of every occurrence of a pattern in the text."""
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for position, character in enumerate(text):
+            while node and character not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(character, 0)
+            if output[node]:
+                for index in output[node]:
+                    yield position + 1, index
+
+
+class PassageLocator:
+    """
+    Finds quoted passages in a text.
+
+    A quote that doesn't occur exactly is aligned word by word, allowing insertions, deletions and
+    substitutions of words; it is located if at most 1 - min_score of its words had to be changed.
+    Only the max_candidates regions sharing the most words with the quote are aligned, and words
+    occurring more than max_postings times in the text are not used to find them.
+    """
+
+    def __init__(self, text: str, min_score: float = 0.6, max_candidates: int = 3, max_postings: int = 64):
+        self.text = text
+        self.min_score = min_score
+        self.max_candidates = max_candidates
+        self.max_postings = max_postings
+        self._normalized, self._offsets = normalize_with_offsets(text)
+        # built when the first quote has to be aligned
+        self._words: Optional[list[str]] = None
+        self._word_spans: list[tuple[int, int]] = []
+        self._postings: dict[str, list[int]] = {}
+
+    def _span(self, start: int, end: int, score: float = 1.0) -> PassageSpan:
+        """span in the original text of the normalized characters start to end"""
+        return PassageSpan(self._offsets[start], self._offsets[end - 1] + 1, score)
+
+    def locate(self, snippet: str) -> Optional[PassageSpan]:
+        return self.locate_all([snippet])[0]
+
+    def locate_all(self, snippets: list[str]) -> list[Optional[PassageSpan]]:
+        """The first occurrence of every snippet, None for snippets that aren't in the text."""
+        patterns = [normalize_passage(snippet) for snippet in snippets]
+        spans: list[Optional[PassageSpan]] = [None] * len(patterns)
+
+        if len(patterns) == 1:
+            start = self._normalized.find(patterns[0]) if patterns[0] else -1
+            if start != -1:
+                spans[0] = self._span(start, start + len(patterns[0]))
+        else:
+            missing = sum(1 for pattern in patterns if pattern)
+            for end, index in AhoCorasick(patterns).iter(self._normalized):
+                if spans[index] is None:
+                    spans[index] = self._span(end - len(patterns[index]), end)
+                    missing -= 1
+                    if not missing:
+                        break
+
+        for index, pattern in enumerate(patterns):
+            if spans[index] is None and pattern:
+                spans[index] = self._align(pattern)
+        return spans
+
+    def _index_words(self) -> None:
+        self._words = []
+        for match in WORD_PATTERN.finditer(self._normalized):
+            self._postings.setdefault(match.group(), []).append(len(self._words))
+            self._words.append(match.group())
+            self._word_spans.append(match.span())
+
+    def _candidates(self, words: list[str]) -> list[int]:
+        """word offsets in the text where the quote may start, by the number of its words that agree"""
+        votes: Counter[int] = Counter()
+        voters = 0
+        for position, word in enumerate(words):
+            postings = self._postings.get(word, ())
+            if len(postings) > self.max_postings:
+                continue
+            voters += 1
+            for occurrence in postings:
+                votes[occurrence - position] += 1
+
+        # frequent words don't vote, so only the others have to agree
+        required = max(1, math.ceil(voters * self.min_score / 2))
+        candidates: list[int] = []
+        for start, count in votes.most_common():
+            if count < required or len(candidates) == self.max_candidates:
+                break
+            if all(abs(start - candidate) > len(words) // 2 for candidate in candidates):
+                candidates.append(start)
+        return candidates
+
+    def _align(self, pattern: str) -> Optional[PassageSpan]:
+        if self._words is None:
+            self._index_words()
+        words = WORD_PATTERN.findall(pattern)
+        if not words or not self._words:
+            return None
+
+        # no alignment with more edits than this can reach min_score
+        slack = int(len(words) * (1 - self.min_score))
+        best: Optional[tuple[int, int, int]] = None
+        for candidate in self._candidates(words):
+            window_start = max(0, candidate - slack)
+            alignment = self._align_window(words, window_start, slack)
+            if alignment is not None and (best is None or alignment[0] < best[0]):
+                best = alignment
+        if best is None:
+            return None
+
+        distance, first, last = best
+        score = 1 - distance / len(words)
+        if score < self.min_score:
+            return None
+        return self._span(self._word_spans[first][0], self._word_spans[last][1], round(score, 3))
+
+    def _align_window(self, words: list[str], window_start: int, slack: int) -> Optional[tuple[int, int, int]]:
+        """
+        Banded word edit distance between the quote and the text from window_start on, where the
+        alignment may start at any of the first 2 * slack + 1 words of the window.
+        Returns the distance and the first and last word of the text it covers.
+        """
+        text_words = self._words
+        width = 2 * slack + 1
+        infinity = len(words) + width
+        # row i holds the cells j = i + k (words of the window consumed) for k in 0 .. width - 1
+        distances = [0] * width
+        starts = list(range(width))
+        for i, word in enumerate(words, start=1):
+            row = [infinity] * width
+            row_starts = [0] * width
+            for k in range(width):
+                j = i + k
+                if window_start + j > len(text_words):
+                    break
+                # match or substitution of the j-th word of the window
+                cost = distances[k] + (text_words[window_start + j - 1] != word)
+                start = starts[k]
+                # the quote has a word the text doesn't, ties keep the earlier start
+                if k + 1 < width and (distances[k + 1] + 1, starts[k + 1]) < (cost, start):
+                    cost, start = distances[k + 1] + 1, starts[k + 1]
+                # the text has a word the quote doesn't
+                if k and (row[k - 1] + 1, row_starts[k - 1]) < (cost, start):
+                    cost, start = row[k - 1] + 1, row_starts[k - 1]
+                row[k], row_starts[k] = cost, start
+            distances, starts = row, row_starts
+
+        # of equally good alignments the longest one, words of the text it doesn't match are trimmed below
+        k = min(range(width), key=lambda k: (distances[k], -k))
+        if distances[k] >= infinity:
+            return None
+        first = window_start + starts[k]
+        last = window_start + len(words) + k - 1
+        # an alignment starting or ending with skipped words of the quote covers fewer text words
+        while first < last and text_words[first] not in words:
+            first += 1
+        while last > first and text_words[last] not in words:
+            last -= 1
+        return distances[k], first, last
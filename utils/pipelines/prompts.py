@@ -0,0 +1,93 @@
+import hashlib
+import re
+import threading
+
+from typing import Callable, Optional
+
+
+PLACEHOLDER_PATTERN = re.compile(r"\$PLACEHOLDER_([A-Z_]+)")
+
+
+class PromptTemplate:
+    """
+    A prompt with $PLACEHOLDER_<NAME> fields.
+
+    The static values are filled in once when the template is built; the remaining
+    placeholders are compiled into a list of segments, so rendering a request only
+    joins strings. Values are never searched for placeholders again.
+    """
+
+    def __init__(self, name: str, template: str, **static_values: str):
+        self.name = name
+        self._segments: list[str] = []
+        self._fields: list[str] = []
+
+        position = 0
+        static_text = ""
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            field = match.group(1)
+            static_text += template[position : match.start()]
+            if field in static_values:
+                static_text += static_values[field]
+            else:
+                self._segments.append(static_text)
+                self._fields.append(field)
+                static_text = ""
+            position = match.end()
+        self._segments.append(static_text + template[position:])
+
+        digest = hashlib.sha256()
+        for segment in self._segments:
+            digest.update(segment.encode("utf-8"))
+            digest.update(b"\x1f")
+        self.id = f"{name}@{digest.hexdigest()[:12]}"
+
+    @property
+    def fields(self) -> list[str]:
+        return list(self._fields)
+
+    @property
+    def prefix(self) -> str:
+        """The static text before the first field, identical for every request."""
+        return self._segments[0]
+
+    def render(self, **values: str) -> str:
+        parts = [self._segments[0]]
+        for field, segment in zip(self._fields, self._segments[1:]):
+            parts.append(values[field])
+            parts.append(segment)
+        return "".join(parts)
+
+
+class PromptRegistry:
+    """
+    Holds the prompt templates of a pipeline and builds them again only when
+    the inputs of the builder (e.g. examples loaded from a file or valves) change.
+    """
+
+    def __init__(self, builder: Callable[..., dict[str, PromptTemplate]]):
+        self._builder = builder
+        self._lock = threading.Lock()
+        self._inputs: Optional[dict] = None
+        self._templates: dict[str, PromptTemplate] = {}
+        self._version = ""
+
+    def templates(self, **inputs) -> dict[str, PromptTemplate]:
+        # the inputs are usually the same objects, so the comparison is cheap
+        if inputs != self._inputs:
+            with self._lock:
+                if inputs != self._inputs:
+                    templates = self._builder(**inputs)
+                    self._version = hashlib.sha256(
+                        "\x1f".join(
+                            sorted(template.id for template in templates.values())
+                        ).encode("utf-8")
+                    ).hexdigest()[:12]
+                    self._templates = templates
+                    self._inputs = inputs
+        return self._templates
+
+    @property
+    def version(self) -> str:
+        """Changes whenever any template changes, usable as part of cache keys."""
+        return self._version
@@ -0,0 +1,77 @@
+import heapq
+import math
+import re
+import unicodedata
+
+from collections import Counter, defaultdict
+
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words of a text, single characters are dropped."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return [word for word in WORD_PATTERN.findall(text) if len(word) > 1]
+
+
+class BM25Index:
+    """
+    In-memory Okapi BM25 index over a list of short documents.
+
+    Built once; a query only touches the postings of its own terms, so the cost
+    grows with the number of matching documents rather than the size of the corpus.
+    """
+
+    def __init__(self, documents: list[str], k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+
+        frequencies: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        lengths = []
+        for document_id, document in enumerate(documents):
+            terms = tokenize(document)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                frequencies[term].append((document_id, frequency))
+
+        # the weight of a term in a document does not depend on the query, so it is computed once
+        average_length = (sum(lengths) / len(lengths) if lengths else 0.0) or 1.0
+        count = len(documents)
+        self._postings: dict[str, list[tuple[int, float]]] = {}
+        for term, postings in frequencies.items():
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            self._postings[term] = [
+                (
+                    document_id,
+                    idf * frequency * (k1 + 1)
+                    / (frequency + k1 * (1 - b + b * lengths[document_id] / average_length)),
+                )
+                for document_id, frequency in postings
+            ]
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def scores(self, query: str) -> dict[int, float]:
+        """BM25 score of every document sharing at least one term with the query."""
+        scores: dict[int, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            for document_id, weight in self._postings.get(term, ()):
+                scores[document_id] += weight
+        return scores
+
+    def top_k(self, query: str, k: int) -> list[int]:
+        """
+        Ids of the k best matching documents, best first. Documents without any
+        matching term are used to fill up the result in their original order.
+        """
+        scores = self.scores(query)
+        ranked = heapq.nsmallest(k, scores, key=lambda document_id: (-scores[document_id], document_id))
+        if len(ranked) < k:
+            matched = set(ranked)
+            ranked += [
+                document_id for document_id in range(len(self.documents)) if document_id not in matched
+            ][: k - len(ranked)]
+        return ranked
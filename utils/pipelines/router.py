@@ -0,0 +1,314 @@
+import asyncio
+import logging
+import threading
+import time
+
+from collections import deque
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+from utils.pipelines.tokens import estimate_tokens
+from utils.pipelines.tracing import Span, current_span
+
+
+def is_retryable(error: Exception) -> bool:
+    """rate limits, server errors, timeouts and connection errors are worth trying on another deployment"""
+    try:
+        import openai
+    except ImportError:
+        return False
+
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class Deployment:
+    """One model deployment with its client, rolling latency and error statistics and a circuit breaker."""
+
+    def __init__(self, name: str, client, model: str, window: int = 50):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.in_flight = 0
+
+    @property
+    def error_rate(self) -> float:
+        return (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0
+
+    def latency(self, quantile: float = 0.5) -> Optional[float]:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * quantile), len(latencies) - 1)]
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def score(self) -> float:
+        """lower is better; deployments without measurements are tried first"""
+        latency = self.latency() or 0.0
+        return latency * (1 + self.in_flight) * (1 + 4 * self.error_rate)
+
+    def record_success(self, latency: float) -> None:
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, failure_threshold: int, cooldown: float) -> None:
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= failure_threshold:
+            # after the cooldown the circuit is half-open, the next call decides
+            self.open_until = time.monotonic() + cooldown
+            logging.warning(f"router: circuit of {self.name} open for {cooldown}s")
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "p50": self.latency(0.5),
+            "p95": self.latency(0.95),
+            "error_rate": self.error_rate,
+            "circuit_open": self.is_open(time.monotonic()),
+            "in_flight": self.in_flight,
+        }
+
+
+class UsageMetrics:
+    """Latency and token usage of all calls through a router."""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.latencies.append(latency)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = sorted(self.latencies)
+
+        def quantile(q: float) -> Optional[float]:
+            return latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else None
+
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_p50": quantile(0.5),
+            "latency_p95": quantile(0.95),
+        }
+
+
+class MeteredStream:
+    """
+    Passes the chunks of a streamed completion through and records its usage once it is exhausted.
+    Streams usually carry no usage, then the completion tokens are counted from the deltas.
+    """
+
+    def __init__(self, stream, on_finished: Callable[[Optional[Any], str], None]):
+        self.stream = stream
+        self.on_finished = on_finished
+
+    async def __aiter__(self):
+        usage = None
+        deltas = []
+        async for chunk in self.stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if chunk.choices:
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    deltas.append(delta.content)
+                # streamed structured outputs arrive as the arguments of a tool call
+                for tool_call in getattr(delta, "tool_calls", None) or []:
+                    if tool_call.function and tool_call.function.arguments:
+                        deltas.append(tool_call.function.arguments)
+            yield chunk
+        self.on_finished(usage, "".join(deltas))
+
+    async def close(self) -> None:
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            await close()
+
+
+class DeploymentRouter:
+    """
+    Spreads chat completions over several deployments, usable in place of an AsyncOpenAI client
+    (router.chat.completions.create). Every call goes to the healthiest deployment and fails over
+    to the next one on rate limits and server errors. Deployments failing repeatedly are skipped
+    for a cooldown. With hedging, a duplicate is sent to the next deployment when the first has
+    not answered within its p95 latency, and the faster answer wins.
+    """
+
+    def __init__(
+        self,
+        deployments: list[Deployment],
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.5,
+        name: str = "default",
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        if not deployments:
+            raise ValueError("The router needs at least one deployment")
+        self.name = name
+        self.deployments = deployments
+        self.metrics = UsageMetrics()
+        self.count_tokens = count_tokens
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def ranked(self) -> list[Deployment]:
+        """closed circuits by score, then open ones by the time their circuit closes"""
+        now = time.monotonic()
+        closed = sorted(
+            (deployment for deployment in self.deployments if not deployment.is_open(now)),
+            key=lambda deployment: deployment.score(),
+        )
+        opened = sorted(
+            (deployment for deployment in self.deployments if deployment.is_open(now)),
+            key=lambda deployment: deployment.open_until,
+        )
+        return closed + opened
+
+    async def _call(self, deployment: Deployment, kwargs: dict) -> Any:
+        start = time.monotonic()
+        deployment.in_flight += 1
+        try:
+            response = await deployment.client.chat.completions.create(**{**kwargs, "model": deployment.model})
+        except Exception as e:
+            if is_retryable(e):
+                deployment.record_failure(self.failure_threshold, self.cooldown)
+            raise
+        finally:
+            deployment.in_flight -= 1
+        # for streams this is the time until the response started
+        deployment.record_success(time.monotonic() - start)
+        return response
+
+    def _hedge_delay(self, deployment: Deployment) -> Optional[float]:
+        if not self.hedge or len(deployment.latencies) < self.hedge_min_samples:
+            return None
+        return max(deployment.latency(self.hedge_quantile), self.hedge_min_delay)
+
+    async def _hedged_call(self, primary: Deployment, secondary: Optional[Deployment], kwargs: dict) -> Any:
+        """calls primary, hedged on secondary if there is one; a duplicate on primary itself would only add load"""
+        if secondary is None or secondary is primary:
+            return await self._call(primary, kwargs)
+        delay = self._hedge_delay(primary)
+        first = asyncio.ensure_future(self._call(primary, kwargs))
+        if delay is None:
+            return await first
+
+        attempts = {first}
+        winner = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if done:
+                winner = first
+                return first.result()
+
+            logging.info(f"router: {primary.name} slower than {delay:.2f}s, hedging on {secondary.name}")
+            attempts.add(asyncio.ensure_future(self._call(secondary, kwargs)))
+            pending = set(attempts)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # also when the caller is cancelled, no attempt may keep running (and holding a deployment)
+            await self._discard(attempts - {winner})
+
+    async def _discard(self, losers: set) -> None:
+        """cancels the calls that lost and closes responses that arrived too late (e.g. open streams)"""
+        for task in losers:
+            task.cancel()
+        await asyncio.gather(*losers, return_exceptions=True)
+        for task in losers:
+            if not task.cancelled() and task.exception() is None:
+                close = getattr(task.result(), "close", None)
+                if close is not None and asyncio.iscoroutinefunction(close):
+                    await close()
+
+    def _record_usage(
+        self, start: float, kwargs: dict, usage: Optional[Any], completion: str = "", span: Optional[Span] = None
+    ) -> None:
+        latency = time.monotonic() - start
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = sum(
+                self.count_tokens(message.get("content") or "")
+                for message in kwargs.get("messages", [])
+                if isinstance(message.get("content"), str)
+            )
+            completion_tokens = self.count_tokens(completion)
+        self.metrics.record(latency, prompt_tokens, completion_tokens)
+        if span is not None:
+            span.add_usage(prompt_tokens, completion_tokens)
+        logging.info(
+            f"router {self.name}: {latency:.2f}s, {prompt_tokens} prompt and {completion_tokens} completion tokens"
+        )
+
+    async def create(self, **kwargs) -> Any:
+        start = time.monotonic()
+        span = current_span()
+        response = await self._create(**kwargs)
+        if kwargs.get("stream"):
+            return MeteredStream(
+                response, lambda usage, completion: self._record_usage(start, kwargs, usage, completion, span)
+            )
+        self._record_usage(start, kwargs, getattr(response, "usage", None), span=span)
+        return response
+
+    async def _create(self, **kwargs) -> Any:
+        ranked = self.ranked()
+        now = time.monotonic()
+        error = None
+        for index, deployment in enumerate(ranked):
+            # only a distinct deployment with a closed circuit is worth a duplicate
+            secondary = ranked[index + 1] if index + 1 < len(ranked) else None
+            if secondary is not None and secondary.is_open(now):
+                secondary = None
+            try:
+                return await self._hedged_call(deployment, secondary, kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                logging.warning(f"router: {deployment.name} failed ({type(e).__name__}), trying the next deployment")
+                error = e
+        raise error
+
+    def snapshot(self) -> list[dict]:
+        return [deployment.snapshot() for deployment in self.deployments]
+
+    async def close(self) -> None:
+        for deployment in self.deployments:
+            await deployment.client.close()
@@ -0,0 +1,76 @@
+import re
+
+from typing import Optional
+
+TITLE_GENERATION = "title_generation"
+TAGS_GENERATION = "tags_generation"
+AUTOCOMPLETE_GENERATION = "autocomplete_generation"
+QUERY_GENERATION = "query_generation"
+EMOJI_GENERATION = "emoji_generation"
+
+# Phrases of the default task prompts of Open WebUI, for versions that don't send the task in the metadata.
+TASK_PROMPT_PHRASES = {
+    TITLE_GENERATION: (
+        "generate a concise, 3-5 word title",
+        "create a concise, 3-5 word title",
+    ),
+    TAGS_GENERATION: ("generate 1-3 broad tags",),
+    AUTOCOMPLETE_GENERATION: ("you are an autocompletion system",),
+    QUERY_GENERATION: (
+        "determine the necessity of generating search queries",
+        "generate search queries",
+    ),
+    EMOJI_GENERATION: (
+        "reply with an emoji",
+        "your task is to reflect the speaker's likely facial expression",
+    ),
+}
+
+CHAT_HISTORY_PATTERN = re.compile(r"<chat_history>(.*?)</chat_history>", re.DOTALL | re.IGNORECASE)
+TASK_HEADER_PATTERN = re.compile(r"^\s*#+\s*task:\s*", re.IGNORECASE)
+
+# the task templates are short apart from the embedded chat history, and start with their phrase,
+# current ones after a "### Task:" header. A pasted text mentioning a phrase is analysed as usual
+TASK_PHRASE_WINDOW = 120
+TASK_PROMPT_MAX_LENGTH = 3000
+
+
+def detect_task(body: dict, user_message: Optional[str] = None) -> Optional[str]:
+    """
+    Returns the task of a background request of Open WebUI (chat title, tags, autocompletion, ...),
+    or None for an ordinary chat message.
+
+    The task is taken from the metadata Open WebUI sends. Only for older versions without it, a
+    message is recognized as task prompt if it is as short as the templates (without the chat history)
+    and starts with the phrase of a template, or has the task header with the phrase right after it.
+    """
+    metadata = body.get("metadata") or {}
+    task = metadata.get("task") or body.get("task")
+    if task:
+        return str(task)
+    if body.get("title", False):
+        return TITLE_GENERATION
+
+    if user_message and is_task_prompt_length(user_message):
+        header = TASK_HEADER_PATTERN.match(user_message)
+        start = " ".join(user_message[header.end() if header else 0 :][: 2 * TASK_PHRASE_WINDOW].split()).casefold()
+        for task, phrases in TASK_PROMPT_PHRASES.items():
+            # after the header the phrase may follow a few words, e.g. "Analyze the chat history to ..."
+            if any(start.startswith(phrase) or (header and phrase in start[:TASK_PHRASE_WINDOW]) for phrase in phrases):
+                return task
+    return None
+
+
+def is_task_prompt_length(message: str) -> bool:
+    return len(CHAT_HISTORY_PATTERN.sub("", message)) <= TASK_PROMPT_MAX_LENGTH
+
+
+def wants_json(prompt: str) -> bool:
+    """newer task prompts ask for a JSON object, older ones for plain text"""
+    return "json" in prompt.casefold()
+
+
+def get_chat_history(prompt: str) -> str:
+    """the chat history embedded in a task prompt, the whole prompt if it has none"""
+    match = CHAT_HISTORY_PATTERN.search(prompt)
+    return match.group(1) if match else prompt
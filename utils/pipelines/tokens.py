@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+
+from typing import Callable
+
+
+# roughly the pre-tokenization of the OpenAI encodings: words, numbers and single symbols
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# where tiktoken downloads the files of the OpenAI encodings from
+ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/{encoding}.tiktoken"
+
+_counters: dict[tuple[str, bool], Callable[[str], int]] = {}
+_counters_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Offline estimate of the token count, used when tiktoken or its encoding files are not available.
+    Long words are split into several tokens, about one per four characters.
+    """
+    return sum(
+        max(1, math.ceil(len(piece) / 4)) for piece in TOKEN_PATTERN.findall(text)
+    )
+
+
+def is_encoding_cached(encoding: str) -> bool:
+    """
+    Whether tiktoken finds the file of the encoding in its cache directory, so loading it needs no
+    network access. Uses the same location as tiktoken: TIKTOKEN_CACHE_DIR, DATA_GYM_CACHE_DIR or
+    data-gym-cache in the temporary directory.
+    """
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["TIKTOKEN_CACHE_DIR"]
+    elif "DATA_GYM_CACHE_DIR" in os.environ:
+        cache_dir = os.environ["DATA_GYM_CACHE_DIR"]
+    else:
+        cache_dir = os.path.join(tempfile.gettempdir(), "data-gym-cache")
+    if not cache_dir:
+        return False
+    url = ENCODING_URL.format(encoding=encoding)
+    return os.path.exists(os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest()))
+
+
+def get_token_counter(encoding: str = "o200k_base", allow_download: bool = False) -> Callable[[str], int]:
+    """
+    Returns a function counting the tokens of a text with the tiktoken encoding.
+
+    tiktoken downloads the encoding on first use, which blocks the caller and fails in air-gapped
+    deployments. So the encoding is only used if it is already in the tiktoken cache (e.g. fetched
+    while building the image, or copied into TIKTOKEN_CACHE_DIR), or if allow_download is set.
+    Otherwise, and if tiktoken is not installed or the encoding cannot be loaded, the estimate is
+    used instead. An empty encoding name always uses the estimate.
+    """
+    if not encoding:
+        return estimate_tokens
+
+    with _counters_lock:
+        key = (encoding, allow_download)
+        if key not in _counters:
+            if not allow_download and not is_encoding_cached(encoding):
+                logging.info(f"tiktoken encoding {encoding} is not cached locally, estimating tokens")
+                _counters[key] = estimate_tokens
+                return _counters[key]
+            try:
+                import tiktoken
+
+                tokenizer = tiktoken.get_encoding(encoding)
+                _counters[key] = lambda text: len(
+                    tokenizer.encode(text, disallowed_special=())
+                )
+            except Exception as e:
+                logging.info(
+                    f"tiktoken encoding {encoding} not available, estimating tokens: {e}"
+                )
+                _counters[key] = estimate_tokens
+        return _counters[key]
+
+
+class TokenMetrics:
+    """Counts the prompt tokens sent and the tokens saved by pruning prompts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.tokens_saved = 0
+
+    def record(self, prompt_tokens: int, unpruned_tokens: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.tokens_saved += max(unpruned_tokens - prompt_tokens, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "tokens_saved": self.tokens_saved,
+            }
@@ -0,0 +1,194 @@
+"""
+Lightweight spans for the stages of a pipeline.
+
+main.py starts a trace per chat completion (PIPELINES_TRACING=true). Pipelines wrap their stages
+in spans, and the router adds the tokens of every LLM call to the current span. When the request
+is done, every span is logged as a JSON record and the trace is summarized as a Server-Timing header
+(or an SSE comment for streamed answers).
+
+    with span("identify", tier="small"):
+        ...
+
+Without an active trace, span returns a shared no-op context, so disabled tracing costs a context
+variable lookup per stage.
+"""
+
+import json
+import logging
+import time
+import uuid
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """Wall time, LLM calls and tokens of a stage."""
+
+    __slots__ = ("trace", "name", "attributes", "start", "duration", "calls", "prompt_tokens", "completion_tokens")
+
+    def __init__(self, trace: Optional["Trace"], name: str, attributes: Optional[dict] = None):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes or {}
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int) -> None:
+        if self.trace is None:
+            return
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    def set(self, **attributes) -> None:
+        if self.trace is not None:
+            self.attributes.update(attributes)
+
+    def end(self) -> None:
+        if self.duration is None and self.trace is not None:
+            self.duration = time.perf_counter() - self.start
+            self.trace.spans.append(self)
+
+    def record(self) -> dict:
+        return {
+            "span": self.name,
+            "duration_ms": round((self.duration or 0.0) * 1000, 2),
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            **self.attributes,
+        }
+
+
+# shared by all stages while no trace is active, records nothing
+NOOP_SPAN = Span(None, "noop")
+
+
+class Trace:
+    """The spans of a single request."""
+
+    def __init__(self, name: str = "", **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+
+    def summary(self) -> dict[str, dict]:
+        """duration, calls and tokens per span name, spans of the same stage (e.g. every explanation) are added up"""
+        stages: dict[str, dict] = {}
+        for span in self.spans:
+            stage = stages.setdefault(span.name, {"count": 0, "duration": 0.0, "tokens": 0})
+            stage["count"] += 1
+            stage["duration"] += span.duration or 0.0
+            stage["tokens"] += span.prompt_tokens + span.completion_tokens
+        return stages
+
+    def server_timing(self) -> str:
+        entries = [
+            f'{name};dur={stage["duration"] * 1000:.1f};desc="{stage["count"]}x, {stage["tokens"]} tokens"'
+            for name, stage in self.summary().items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+    def log(self) -> None:
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        for span in self.spans:
+            logger.info(json.dumps({"trace": self.id, "name": self.name, **self.attributes, **span.record()}))
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("pipelines_trace", default=None)
+_span: ContextVar[Optional[Span]] = ContextVar("pipelines_span", default=None)
+
+
+@contextmanager
+def trace(name: str = "", **attributes) -> Iterator[Trace]:
+    """starts a trace for the enclosed code and the tasks it creates, logs its spans at the end"""
+    active = Trace(name, **attributes)
+    trace_token = _trace.set(active)
+    span_token = _span.set(None)
+    try:
+        yield active
+    finally:
+        try:
+            _span.reset(span_token)
+            _trace.reset(trace_token)
+        except ValueError:
+            # an async generator closed by the garbage collector runs in another context
+            pass
+        active.log()
+
+
+def start_span(name: str, **attributes) -> Span:
+    """
+    starts a span without making it the current one, for stages inside async generators, where a
+    context variable set across a yield would leak into the consumer. Calls are added to it inside
+    activate(span), the span is recorded with span.end().
+    """
+    active = _trace.get()
+    if active is None:
+        return NOOP_SPAN
+    return Span(active, name, attributes)
+
+
+class _CurrentSpan:
+    """makes a span the current one while entered, and ends it on exit if end is set"""
+
+    __slots__ = ("span", "end", "token")
+
+    def __init__(self, current: Span, end: bool):
+        self.span = current
+        self.end = end
+
+    def __enter__(self) -> Span:
+        self.token = _span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info) -> None:
+        _span.reset(self.token)
+        if self.end:
+            self.span.end()
+
+
+# returned while no trace is active, so a disabled span costs one context variable lookup
+_NOOP_CONTEXT = nullcontext(NOOP_SPAN)
+
+
+def activate(current: Span):
+    """makes a span the current one for the enclosed code, which must not yield"""
+    if current is NOOP_SPAN:
+        return _NOOP_CONTEXT
+    return _CurrentSpan(current, end=False)
+
+
+def span(name: str, **attributes):
+    """times the enclosed stage, LLM calls inside it add their tokens to it"""
+    active = _trace.get()
+    if active is None:
+        return _NOOP_CONTEXT
+    return _CurrentSpan(Span(active, name, attributes), end=True)
+
+
+def current_span() -> Optional[Span]:
+    """the span LLM calls add their tokens to, captured when the call starts (streams finish later)"""
+    return _span.get()
+
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """prints the span records, one JSON object per line"""
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        # the records are already printed, not again by a handler of the root logger
+        logger.propagate = False
+    logger.setLevel(level)
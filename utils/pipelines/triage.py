@@ -0,0 +1,181 @@
+"""
+Local triage before the LLM: a small logistic regression over words and word pairs
+that estimates whether a text contains any finding at all.
+
+Train and evaluate it offline from the examples workbook and the result log of a pipeline:
+
+    python -m utils.pipelines.triage train --log results.jsonl --workbook Beispiele.xlsx --out triage.json
+    python -m utils.pipelines.triage evaluate --model triage.json --log results.jsonl --threshold 0.9 0.95 0.99
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import threading
+import time
+
+from typing import Iterable, Optional
+
+from utils.pipelines.retrieval import tokenize
+
+
+def features(text: str) -> set[str]:
+    """words and pairs of neighbouring words of a text"""
+    words = tokenize(text)
+    return set(words) | {f"{first} {second}" for first, second in zip(words, words[1:])}
+
+
+def sigmoid(value: float) -> float:
+    if value < -30:
+        return 0.0
+    return 1 / (1 + math.exp(-value))
+
+
+class TriageModel:
+    """Logistic regression estimating the probability that a text contains a finding."""
+
+    def __init__(self, weights: dict[str, float], bias: float = 0.0, metadata: Optional[dict] = None):
+        self.weights = weights
+        self.bias = bias
+        self.metadata = metadata or {}
+
+    def score(self, text: str) -> float:
+        return sigmoid(self.bias + sum(self.weights.get(feature, 0.0) for feature in features(text)))
+
+    @classmethod
+    def train(
+        cls,
+        texts: list[str],
+        labels: list[bool],
+        epochs: int = 20,
+        learning_rate: float = 0.1,
+        l2: float = 1e-4,
+        seed: int = 0,
+    ) -> "TriageModel":
+        """stochastic gradient descent on the log loss, positive samples are texts with findings"""
+        samples = [(features(text), 1.0 if label else 0.0) for text, label in zip(texts, labels)]
+        weights: dict[str, float] = {}
+        positives = sum(label for _, label in samples)
+        # start at the base rate, so an untrained feature does not move the score
+        bias = math.log((positives + 1) / (len(samples) - positives + 1))
+        rng = random.Random(seed)
+        for _ in range(epochs):
+            rng.shuffle(samples)
+            for sample_features, label in samples:
+                prediction = sigmoid(bias + sum(weights.get(feature, 0.0) for feature in sample_features))
+                gradient = prediction - label
+                bias -= learning_rate * gradient
+                for feature in sample_features:
+                    weight = weights.get(feature, 0.0)
+                    weights[feature] = weight - learning_rate * (gradient + l2 * weight)
+        return cls(
+            weights={feature: weight for feature, weight in weights.items() if abs(weight) > 1e-6},
+            bias=bias,
+            metadata={"samples": len(samples), "positives": int(positives), "trained_at": time.time()},
+        )
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"bias": self.bias, "weights": self.weights, "metadata": self.metadata}, file)
+
+    @classmethod
+    def load(cls, path: str) -> "TriageModel":
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        return cls(weights=data["weights"], bias=data["bias"], metadata=data.get("metadata"))
+
+
+class ResultLog:
+    """Appends the findings of every analyzed text to a JSON lines file, the training data of the triage model."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, text: str, findings: list[dict], **fields) -> None:
+        record = {"timestamp": time.time(), "text": text, "findings": findings, **fields}
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+
+def read_result_log(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def read_workbook_texts(path: str, column: str = "Aussage") -> list[str]:
+    import pandas as pd
+
+    return [text for text in pd.read_excel(path)[column].dropna().astype(str).to_list() if text.strip()]
+
+
+def evaluate(model: TriageModel, records: Iterable[dict], threshold: float) -> dict:
+    """counts the LLM calls the triage would have avoided and the findings it would have missed"""
+    texts = calls_avoided = texts_missed = findings_missed = 0
+    for record in records:
+        texts += 1
+        if 1 - model.score(record["text"]) >= threshold:
+            calls_avoided += 1
+            if record["findings"]:
+                texts_missed += 1
+                findings_missed += len(record["findings"])
+    return {
+        "threshold": threshold,
+        "texts": texts,
+        "llm_calls_avoided": calls_avoided,
+        "texts_with_findings_missed": texts_missed,
+        "findings_missed": findings_missed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = commands.add_parser("train", help="train a model from the result log and the examples workbook")
+    train_parser.add_argument("--log", action="append", default=[], help="result log, can be given several times")
+    train_parser.add_argument("--workbook", help="every example of the workbook is a text with findings")
+    train_parser.add_argument("--column", default="Aussage")
+    train_parser.add_argument("--holdout", type=float, default=0.2, help="share of the log kept for evaluation")
+    train_parser.add_argument("--threshold", type=float, nargs="+", default=[0.9, 0.95, 0.99])
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--out", required=True)
+
+    evaluate_parser = commands.add_parser("evaluate", help="evaluate a model on a result log")
+    evaluate_parser.add_argument("--model", required=True)
+    evaluate_parser.add_argument("--log", action="append", required=True)
+    evaluate_parser.add_argument("--threshold", type=float, nargs="+", default=[0.9, 0.95, 0.99])
+
+    args = parser.parse_args()
+    records = [record for path in args.log for record in read_result_log(path)]
+
+    if args.command == "train":
+        random.Random(0).shuffle(records)
+        holdout = int(len(records) * args.holdout)
+        evaluation, training = records[:holdout], records[holdout:]
+        texts = [record["text"] for record in training]
+        labels = [bool(record["findings"]) for record in training]
+        if args.workbook:
+            examples = read_workbook_texts(args.workbook, args.column)
+            texts += examples
+            labels += [True] * len(examples)
+        if not any(labels) or all(labels):
+            parser.error("training needs texts with and without findings, log some benign results first")
+
+        model = TriageModel.train(texts, labels, epochs=args.epochs)
+        model.save(args.out)
+        print(f"trained on {len(texts)} texts ({sum(labels)} with findings), saved to {os.path.abspath(args.out)}")
+        if evaluation:
+            for threshold in args.threshold:
+                print(json.dumps(evaluate(model, evaluation, threshold)))
+    else:
+        model = TriageModel.load(args.model)
+        for threshold in args.threshold:
+            print(json.dumps(evaluate(model, records, threshold)))
+
+
+if __name__ == "__main__":
+    main()